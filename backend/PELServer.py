@@ -17,23 +17,48 @@ from logging.handlers import RotatingFileHandler
 import os
 from pathlib import Path
 from queue import Queue
-import shutil
+import signal
+import socket
+import sys
 import time
 import threading
-from typing import Any
+from typing import Any, Callable, Iterator
 import webbrowser
 
-from flask import Flask, make_response, render_template, send_from_directory, jsonify, request
+from flask import Flask, Response, make_response, render_template, send_from_directory, jsonify, request
 from flask_socketio import SocketIO
 from flask_caching import Cache
-from flask_wtf.csrf import CSRFProtect, CSRFError
+from flask_wtf.csrf import CSRFProtect, CSRFError, validate_csrf
+from werkzeug.utils import secure_filename
+from wtforms import ValidationError
 
 from backend.utils.load_json import load_json_data
-from backend.utils.path_utils import get_full_path, directory_check, custom_secure_filename
-from backend.processor import process_engagement_letter
-from backend.extractor import process_document
-from backend.converter import convert_word_to_pdf
-from backend.pdf_signature import find_signature_position, extract_name, add_signature
+from backend.utils.path_utils import get_full_path, directory_check, unique_path, upload_filename
+from backend.utils.upload_stream import StreamingUpload, UploadError
+from backend.utils.chunked_upload import UPLOADS_DIR, ChunkError, UploadSession, UploadSessions
+from backend.utils.zip_stream import extract_members, stream_zip
+from backend.utils.table_stream import stream_csv, stream_xlsx
+from backend.utils.lazy_import import LazyFunction, import_module, import_times
+from backend import tracing
+from backend.broker import RemoteTask, open_broker
+from backend.journal import JOBS_DIR, Journal, ResultIndex, settings_fingerprint
+from backend.reconcile import reconcile
+from backend.rules import RuleError, compile_rules
+from backend.scheduler import CANCELLED, Job, Scheduler, Task
+from backend.tasks import optimization_reports
+from backend.workers import PoolTask, WorkerPool
+
+# Document backends pull in python-docx, docx2pdf, PyPDF2 and pdfplumber. Tasks import them on first use, or they
+# are warmed in the background once the server is listening, so the first page is served without waiting on them.
+BACKEND_MODULES = ['backend.processor', 'backend.extractor', 'backend.docx_signature', 'backend.pdf_signature', 'backend.pdf_optimizer', 'backend.converter']
+configure_documents = LazyFunction('backend.doc_cache', 'configure_documents')
+document_cache_stats = LazyFunction('backend.doc_cache', 'document_cache_stats')
+template_stats = LazyFunction('backend.fingerprint', 'template_stats')
+collect_snapshot = LazyFunction('backend.snapshot', 'collect')
+merge_snapshots = LazyFunction('backend.snapshot', 'merge')
+load_snapshot = LazyFunction('backend.snapshot', 'load_snapshot')
+restore_snapshot = LazyFunction('backend.snapshot', 'restore')
+save_snapshot = LazyFunction('backend.snapshot', 'save_snapshot')
 
 
 class Server:
@@ -45,8 +70,14 @@ class Server:
     TEMPLATES_DIR = 'frontend/templates'
     CACHE_CONFIG_PATH = "_cache_config.json"
     USER_CONFIG_PATH = "user-config.json"
+    RATE_OPTIONS = ['COMPLIANCE_PARTNER_RATES', 'COMPLIANCE_ASSOCIATE_RATES', 'COMPLIANCE_BOOKKEEPING_RATES', 'CONSULTING_PARTNER_RATES', 'CONSULTING_ASSOCIATE_RATES']
+    # Columns of entity check exports, see /jobs/<job_id>/export
+    EXPORT_HEADER = ['Filename', 'Address', 'Entity', 'Return Type', 'Error']
+    # Seconds /shutdown waits for its response to be sent before the process is terminated
+    SHUTDOWN_EXIT_DELAY = 0.5
 
     def __init__(self):
+        self.created_at = time.perf_counter()
         static_dir = get_full_path(self.STATIC_DIR)
         template_dir = get_full_path(self.TEMPLATES_DIR)
         # init flask app
@@ -58,6 +89,21 @@ class Server:
         # SocketIO
         self.socketio = SocketIO(self.app)
         self.messages = Queue()
+        # Scheduler for per-file work shared by all running batches
+        self.scheduler = Scheduler(
+            workers=self.app.config.get('SCHEDULER_WORKERS', 4),
+            aging=self.app.config.get('SCHEDULER_AGING', 5.0),
+            logger=self.app.logger
+        )
+        # Earlier results by input hash, so unchanged files don't need to be uploaded again
+        self.results = ResultIndex()
+        # Chunked uploads in progress, see /uploads
+        self.uploads = UploadSessions(get_full_path(UPLOADS_DIR), self.app.config.get('UPLOAD_IDLE_TIMEOUT', 300))
+        # Worker processes that run tasks when WORKER_PROCESSES is set, started by `warm_start`
+        self.worker_pool: WorkerPool|None = None
+        # Set once the server starts shutting down, see `drain`
+        self.draining = False
+        self._drain_lock = threading.Lock()
 
         # Setup caching
         cache_type = self.app.config.get('CACHE_TYPE', "FileSystemCache")
@@ -123,15 +169,20 @@ class Server:
 
     # Async producer
     def sync(self, event, data):
-        self.messages.put((event, data))
+        # Emits made while running a traced job's task are recorded in its trace
+        self.messages.put((event, data, tracing.current(), time.perf_counter()))
     
     # Async consumer
     def publish(self):
         while True:
             try:
                 message = self.messages.get()
-                event, data = message
+                event, data, trace, queued_at = message
+                started = time.perf_counter()
                 self.socketio.emit(event, data)
+                if trace is not None:
+                    name = data.get('type', event) if isinstance(data, dict) else event
+                    trace.add(f'emit {name}', 'emit', started, time.perf_counter(), {"queued_ms": round((started - queued_at) * 1000, 3)})
             except Exception as e:
                 self.app.logger.exception(f'Error in publish: {e}', stack_info=True)
 
@@ -162,7 +213,44 @@ class Server:
             - POST: Process settings request to update settings in Flask and save user settings to user-config.json.
 
         [POST] /engagementLetters/document-rollover
-            - POST: Process engagement letters using form fields as configurations
+            - POST: Process engagement letters using form fields as configurations. With `?dry_run=1`, return the changes each letter would get and the letters that would not be updated, without writing anything.
+
+        [POST] /entityChecker/reconcile
+            - POST: Match the letters of two entity check jobs by client name and address and return the entities added, removed and changed between them.
+
+        [GET] /jobs
+            - GET: Return queue wait and progress statistics for active and recently finished jobs.
+
+        [GET] /jobs/<job_id>
+            - GET: Return queue wait and progress statistics for a job.
+
+        [POST] /jobs/known-hashes
+            - POST: Return which of the posted input hashes already have results under the current settings.
+
+        [POST] /jobs/<job_id>/cancel
+            - POST: Cancel the job. Queued files are dropped and running files are stopped. Also sent as the 'cancel' socketio event.
+
+        [GET] /jobs/<job_id>/download
+            - GET: Stream a zip archive of the job's output files, including files still being produced.
+
+        [GET] /jobs/<job_id>/export
+            - GET: Stream an entity check job's results as CSV, or XLSX with `?format=xlsx`, including files still being checked.
+
+        [GET] /jobs/<job_id>/trace
+            - GET: Return the job's timeline in Chrome trace format, for jobs that were traced.
+
+        [GET] /workers
+            - GET: Return tasks run and current and peak memory of each worker process, and the workers recycled for going over WORKER_MAX_TASKS or WORKER_MAX_RSS_MB.
+
+        [POST] /uploads
+            - POST: Start a chunked upload of the listed files. Pass `?upload=<upload_id>` to a process route to process its files.
+
+        [GET, DELETE] /uploads/<upload_id>
+            - GET: Return the chunks still missing from each file of the upload, for resuming it.
+            - DELETE: Cancel the upload, its job finishes with the files that were complete.
+
+        [PUT] /uploads/<upload_id>/<index>/<chunk>
+            - PUT: Write one chunk of a file, checked against the sha256 in the 'X-Chunk-SHA256' header.
         """
         @self.app.route('/styles.css')
         def styles():
@@ -204,6 +292,13 @@ class Server:
                 self.app.logger.exception(f'An unexpected error has occurred while shutting down the server: {e}', stack_info=True)
                 return f'An unexpected error has occurred while shutting down the server. Check logs for more information.'
         
+        @self.app.before_request
+        def reject_while_draining():
+            # Running files are finishing before a shutdown, new work waits for the restart. Jobs can still be
+            # cancelled, so their running files stop instead of holding up the drain
+            if self.draining and request.method != 'GET' and request.endpoint != 'cancel_job':
+                return jsonify({'status': 'error', 'message': 'The server is shutting down, try again once it has restarted.'}), 503
+
         @self.app.errorhandler(Exception)
         def handle_exception(e):
             self.app.logger.exception(f'Unhandled Exception: {e}', stack_info=True)
@@ -286,13 +381,17 @@ class Server:
                     for form_setting in form_data:
                         matching_setting = next((s for s in settings if  s['config_name'] == form_setting['config_name']), None)
                         if matching_setting:
-                            if matching_setting['type'] == 'list':
-                                # Handle list type setting
+                            if matching_setting['type'] in ('list', 'json'):
+                                # Handle list and json type settings
                                 matching_setting['value'] = form_setting['value']
                             else:
                                 # Handle other types (string, number)
                                 matching_setting['value'] = int(form_setting['value']) if matching_setting['type'] == 'number' else form_setting['value']
 
+                    # Compile rollover rules to reject invalid rules before saving them
+                    config = {setting['config_name']: setting['value'] for setting in settings}
+                    compile_rules(config.get('ROLLOVER_RULES'), {rate: config[rate] for rate in self.RATE_OPTIONS if rate in config})
+
                     # Save updated settings
                     with open(user_config_path, 'w') as config_file:
                         json.dump(settings, config_file, indent=4)
@@ -311,6 +410,7 @@ class Server:
                     return jsonify({'status': 'error', 'message': f"An error occurred while saving user settings: {e}"}), 500
 
         @self.app.route('/engagementLetters/document-rollover', methods=['POST'])
+        @self.csrf.exempt
         def process_engagement_letters():
             """
             form: path to directory containing engagement letters
@@ -322,9 +422,11 @@ class Server:
             self.send_message("process-start", "Processing engagement letters!")
             if request.method == 'POST':
                 method = 'POST'
-                
-                current_year_files = request.files.getlist('currentYearDirectory')
-                processed_files_directory = self.app.config.get('PROCESSED_FILES_DIRECTORY', get_full_path('temp/complete'))
+                self._validate_csrf_header()
+
+                # A dry run reads each letter's text and returns the changes the rollover would make
+                dry_run = request.args.get('dry_run') == '1'
+                task, processed_files_directory, options = self._job_settings(process, dry_run=dry_run)
                 
                 # Send processing event for POST method
                 self.send_message('processing', {
@@ -333,7 +435,7 @@ class Server:
                     "message": f'Processing...'
                 })
 
-                if not directory_check(processed_files_directory, True):
+                if not dry_run and not directory_check(processed_files_directory, True):
                     self.send_message('process-error', {
                         "error": "Letter Processing Error",
                         "message": f'The specified directory ( {processed_files_directory} ) does not exist. Configure in settings or in config file.',
@@ -342,54 +444,104 @@ class Server:
                     })
                     return jsonify({"status": "error", "message": f'The specified directory ( {processed_files_directory} ) does not exist. Configure in settings or in config file.'}), 400
                 
-                temp_dir = get_full_path('temp/processing')
-                directory_check(temp_dir, True)
+                # Rollover rules and rate options are part of the task options
+                job, journal = self._create_job(process, task, processed_files_directory, **options)
+
+                def on_result(task: Task):
+                    filename = task.args[0]
+                    processed_result, error = task.result if task.error is None else (None, task.error)
+                    if processed_result is not None:
+                        task.job.add_output(processed_result)
+                    # Log errors
+                    if (error is not None):
+                        # Send process-error event
+                        self.send_message('process-error', {
+                            "error": "Letter Processing Error",
+                            "message": error,
+                            "process": process,
+                            "method": method
+                        })
+                        self.app.logger.error(error)
+                    # Send results event to frontend
+                    self.send_message('process-results',{
+                        "process": process,
+                        "status": "success" if processed_result is not None else "failed",
+                        "filename": processed_result if processed_result is not None else " ".join(os.path.basename(filename).split("_"))
+                    })
+                    # Send progress event to frontend
+                    self.send_message('progress', {
+                        'process': process,
+                        'value': task.job.progress()
+                    })
 
-                # Get rate options
-                rate_options = self.get_rate_options()
+                # Changes found by a dry run and files it failed on, keyed by upload order
+                previews: dict[int, dict] = {}
+                failures: dict[int, dict] = {}
+
+                def on_preview(task: Task, index: int):
+                    preview, error = task.result if task.error is None else (None, task.error)
+                    if preview is not None:
+                        previews[index] = preview
+                    else:
+                        failures[index] = {"filename": " ".join(os.path.basename(task.args[0]).split("_")), "error": error}
+                        self.app.logger.error(error)
+                    self.send_message('progress', {
+                        'process': process,
+                        'value': task.job.progress()
+                    })
 
+                filename = None
                 try:
-                    total_files = len(current_year_files)
-                    for index, file in enumerate(current_year_files, 1):
-                        filename: str = custom_secure_filename(os.path.basename(file.filename))
-                        # Move to next file if it is not a word document file ending in '.docx'.
-                        if filename.startswith('~') or not filename.endswith('.docx'):
-                            continue
-
-                        # Move to next file if filename has 'DO NOT ROLL'
-                        if 'DO NOT ROLL' in filename.upper():
-                            continue
-                        
-                        # Save temp file to 'temp/processing'
-                        temp_file_path = os.path.join(temp_dir, filename)
-                        file.save(temp_file_path)
-
-                        processed_result, error = process_engagement_letter(temp_file_path, processed_files_directory, **rate_options)
-                        # Log errors
-                        if (error is not None):
-                            # Send process-error event
-                            self.send_message('process-error', {
-                                "error": "Letter Processing Error",
-                                "message": error,
-                                "process": process,
-                                "method": method
-                            })
-                            self.app.logger.error(error)
-                        # Send results event to frontend
-                        self.send_message('process-results',{
-                            "process": process,
-                            "status": "success" if processed_result is not None else "failed",
-                            "filename": processed_result if processed_result is not None else " ".join(filename.split("_"))
-                        })                        
-                        # Send progress event to frontend
-                        self.send_message('progress', {
-                            'process': process,
-                            'value': index/total_files
+                    # Skip files that are not word documents ending in '.docx' or that have 'DO NOT ROLL' in the filename
+                    accept = lambda name: upload_filename(name, '.docx', skip_do_not_roll=True)
+                    # Each file is saved to 'temp/jobs/<job_id>/inputs' and queued as soon as it is received
+                    for index, (filename, source) in enumerate(self._stream_upload(job, journal, 'currentYearDirectory', accept)):
+                        self._submit(job, journal, source, callback=(lambda task, index=index: on_preview(task, index)) if dry_run else on_result)
+
+                    job.seal()
+                    journal.seal()
+                    job.wait()
+                    self.app.logger.info(f'Job statistics: {job.stats()}')
+                    if self.worker_pool is None and not self.app.config.get('BROKER_URL'):
+                        self.app.logger.info(f'Document cache statistics: {document_cache_stats()}')
+                    elif self.worker_pool is not None:
+                        self.app.logger.info(f'Worker statistics: {self.worker_pool.stats()}')
+                    if not dry_run and not self.app.config.get('BROKER_URL'):
+                        self.app.logger.info(f'Template statistics: {self.worker_pool.template_stats() if self.worker_pool is not None else template_stats()}')
+                    if job.cancelled:
+                        return self._cancelled_response(job)
+
+                    if dry_run:
+                        files = [{**previews[index], 'filename': " ".join(previews[index]['filename'].split("_"))} for index in sorted(previews)]
+                        message = f'Preview complete, {sum(1 for preview in files if preview["updated"])} of {len(files) + len(failures)} letters would be updated.'
+                        self.send_message('complete', message)
+                        return jsonify({
+                            'status': 'success',
+                            'message': message,
+                            'job_id': job.id,
+                            'dry_run': True,
+                            'files': [preview for preview in files if preview['updated']],
+                            'skipped': [preview['filename'] for preview in files if not preview['updated']],
+                            'failed': [failures[index] for index in sorted(failures)]
                         })
 
                     self.send_message('complete', 'Successfully processed engagement letters!')
-                    return jsonify({'status': 'success', 'message': 'Successfully processed engagement letters!'})
+                    return jsonify({'status': 'success', 'message': 'Successfully processed engagement letters!', 'job_id': job.id, 'download': f'/jobs/{job.id}/download'})
+                except (UploadError, ChunkError) as e:
+                    # The upload itself is invalid, stop the files already queued
+                    job.cancel()
+                    self.send_message('process-error', {
+                        "error": "Upload Error",
+                        "message": str(e),
+                        "process": process,
+                        "method": method
+                    })
+                    self.app.logger.error(f'Upload for job {job.id} rejected: {e}')
+                    return jsonify({'status': 'error', 'message': str(e), 'job_id': job.id}), 400
                 except Exception as e:
+                    if job.cancelled:
+                        # Reading the rest of the upload can fail once the browser stops sending it
+                        return self._cancelled_response(job)
                     # Send process-error event
                     self.send_message('process-error', {
                         "error": "Letter Processing Error",
@@ -400,8 +552,10 @@ class Server:
                     self.app.logger.exception(f'An unexpected error has occurred while processing {filename}', stack_info=True)
                     return jsonify({'status': 'error', 'message': f'An unexpected error has occurred while processing {filename}'}), 500
                 finally:
-                    # Clear 'temp/processing' directory
-                    shutil.rmtree(temp_dir)
+                    # Let queued work finish before marking the job finished and clearing its inputs
+                    job.seal()
+                    job.wait()
+                    journal.finish()
 
         @self.app.route('/entityChecker', methods=['GET'])
         def entity_checker():
@@ -421,15 +575,14 @@ class Server:
                 return render_template('entity_checker.html')
 
         @self.app.route('/entityChecker/check-entities', methods=['POST'])
+        @self.csrf.exempt
         def check_entities():
             # check entities and return partial update
             process = 'entityChecker'
             self.send_message("process-start", "Checking entities...")
             if request.method == 'POST':
                 method = 'POST'
-
-                # Get files uploaded from form.
-                entity_check_files = request.files.getlist('entityCheckDirectory')
+                self._validate_csrf_header()
 
                 # Send processing event for GET method
                 self.send_message('processing', {
@@ -438,34 +591,66 @@ class Server:
                     "message": "Processing..."
                 })
 
-                # Create temp dir to use for processing
-                temp_dir = get_full_path('temp/processing')
-                directory_check(temp_dir, True)
+                # The frontend asks for JSON and renders the table itself, other clients get the html table
+                as_json = request.args.get('format') == 'json'
+                # Only the letter header is searched for the address, see ADDRESS_SCAN_LINES
+                task, _, options = self._job_settings(process)
+                job, journal = self._create_job(process, task, None, **options)
+
+                # Extracted entity info keyed by upload order
+                results: dict[int, dict] = {}
+
+                def on_result(task: Task, index: int):
+                    if task.error is None and task.result[1] is None:
+                        results[index] = task.result[0]
+                    # Send progress event to frontend
+                    self.send_message('progress', {
+                        'process': process,
+                        'value': task.job.progress()
+                    })
 
                 try:
-                    entities = []
-                    total_files = len(entity_check_files)
-                    for index, file in enumerate(entity_check_files, 1):
-                        # Clean and secure filename
-                        filename: str = custom_secure_filename(os.path.basename(file.filename))
-                        # Move to next file if it is not a word document file ending in '.docx'.
-                        if filename.startswith('~') or not filename.endswith('.docx'):
-                            continue
-                        # Save temp file to 'temp/processing'
-                        temp_file_path = os.path.join(temp_dir, filename)
-                        file.save(temp_file_path)
-                        # Extract entity info and add to entities list
-                        entity = process_document(temp_file_path)
-                        entities.append(entity)
-                        # Send progress event to frontend
-                        self.send_message('progress', {
-                            'process': process,
-                            'value': index/total_files
-                        })
+                    # Skip files that are not word documents ending in '.docx'
+                    accept = lambda name: upload_filename(name, '.docx')
+                    # Each file is saved to 'temp/jobs/<job_id>/inputs' and queued as soon as it is received
+                    for index, (filename, source) in enumerate(self._stream_upload(job, journal, 'entityCheckDirectory', accept)):
+                        # Extract entity info
+                        self._submit(job, journal, source, callback=lambda task, index=index: on_result(task, index))
+
+                    job.seal()
+                    journal.seal()
+                    job.wait()
+                    self.app.logger.info(f'Job statistics: {job.stats()}')
+                    if self.worker_pool is None and not self.app.config.get('BROKER_URL'):
+                        self.app.logger.info(f'Document cache statistics: {document_cache_stats()}')
+                    elif self.worker_pool is not None:
+                        self.app.logger.info(f'Worker statistics: {self.worker_pool.stats()}')
+                    if job.cancelled:
+                        return self._cancelled_response(job)
+                    if job.failed:
+                        raise RuntimeError(f'{job.failed} file(s) failed entity extraction')
+
+                    entities = [results[index] for index in sorted(results)]
                     self.send_message('complete', "Successfully extracted entities!")
+                    if as_json:
+                        return jsonify({'status': 'success', 'message': 'Successfully extracted entities!', 'job_id': job.id, 'entities': entities})
                     return render_template('entity_table.html', data=entities)
 
+                except (UploadError, ChunkError) as e:
+                    # The upload itself is invalid, stop the files already queued
+                    job.cancel()
+                    self.send_message('process-error', {
+                        "error": "Upload Error",
+                        "message": str(e),
+                        "process": process,
+                        "method": method
+                    })
+                    self.app.logger.error(f'Upload for job {job.id} rejected: {e}')
+                    return jsonify({'status': 'error', 'message': str(e), 'job_id': job.id}), 400
                 except Exception as e:
+                    if job.cancelled:
+                        # Reading the rest of the upload can fail once the browser stops sending it
+                        return self._cancelled_response(job)
                     # Send process-error event
                     self.send_message('process-error', {
                         "error": "Entity Check Error",
@@ -474,10 +659,44 @@ class Server:
                         "method": method
                     })
                     self.app.logger.exception(f'An unexpected error has occurred while extracting entities.', stack_info=True)
+                    if as_json:
+                        return jsonify({'status': 'error', 'message': 'An unexpected error has occurred while extracting entities.'}), 500
                     return render_template('entity_table_error.html', error_massage=f'An unexpected error has occurred while extracting entities.')
                 finally:
-                    # Clear 'temp/processing' directory
-                    shutil.rmtree(temp_dir)
+                    # Let queued work finish before marking the job finished and clearing its inputs
+                    job.seal()
+                    job.wait()
+                    journal.finish()
+
+        @self.app.route('/entityChecker/reconcile', methods=['POST'])
+        def reconcile_entities():
+            # Compare the entities of two entity checks, ie. last year's letters and this year's
+            data = request.get_json(silent=True) or {}
+            prior_id, current_id = data.get('prior'), data.get('current')
+            if not prior_id or not current_id:
+                return jsonify({'status': 'error', 'message': 'Both a prior and a current entity check job are required'}), 400
+            try:
+                prior_entries = self._entity_check_entries(str(prior_id))
+                current_entries = self._entity_check_entries(str(current_id))
+            except LookupError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            # Checks still running are waited for, both keep extracting side by side on the scheduler's workers
+            letters = {'prior': [], 'current': []}
+            failed = {'prior': [], 'current': []}
+            for side, entries in (('prior', prior_entries), ('current', current_entries)):
+                for entry in entries:
+                    result = entry.get('result')
+                    if entry.get('error') is None and result is not None:
+                        letters[side].append(result)
+                    else:
+                        failed[side].append({'filename': (result or {}).get('filename') or entry.get('input', ''), 'error': entry.get('error')})
+
+            report = reconcile(letters['prior'], letters['current'], include_unchanged=bool(data.get('includeUnchanged')))
+            self.app.logger.info(f'Reconciled entity checks {prior_id} and {current_id}: {report["summary"]}')
+            return jsonify({'status': 'success', 'message': 'Successfully reconciled entities!', 'prior': prior_id, 'current': current_id, 'failed': failed, **report})
 
         @self.app.route('/pdfPrinter', methods=['GET'])
         def pdf_printer():
@@ -496,15 +715,15 @@ class Server:
                 return render_template('pdf_printer.html')
 
         @self.app.route('/pdfPrinter/print-to-pdf', methods=['POST'])
+        @self.csrf.exempt
         def print_to_pdf():
             process = 'pdfPrinter'
             self.send_message("process-start", "Printing documents to PDF")
             if request.method == 'POST':
                 method = 'POST'
-                # Get uploaded files from form
-                pdf_print_files = request.files.getlist('pdfPrintDirectory')
-                # get directory for printed pdf files
-                pdf_files_directory = self.app.config.get('PDF_FILES_DIRECTORY', get_full_path('temp/pdf'))
+                self._validate_csrf_header()
+                # Print and sign in one pass when requested, signed pdfs go to the signatures directory
+                task, pdf_files_directory, options = self._job_settings(process, sign=request.args.get('sign') == '1')
                 # Send processing event for POST method
                 self.send_message('processing', {
                     "process": process,
@@ -521,49 +740,67 @@ class Server:
                     })
                     return jsonify({"status": "error", "message": f'The specified directory ( {pdf_files_directory} ) does not exist. Configure in settings or in config file.'}), 400
 
-                temp_dir = get_full_path('temp/processing')
-                directory_check(temp_dir, True)
+                job, journal = self._create_job(process, task, pdf_files_directory, **options)
+
+                def on_result(task: Task):
+                    filename = task.args[0]
+                    output_path, error = task.result if task.error is None else (None, task.error)
+                    if output_path is not None:
+                        task.job.add_output(output_path)
+                    # Log errors
+                    if (error is not None):
+                        # Send process-error event
+                        self.send_message('process-error', {
+                            "error": "PDF Printer Error",
+                            "message": error,
+                            "process": process,
+                            "method": method
+                        })
+                        self.app.logger.error(error)
+                    # Send results event to frontend
+                    self.send_message('process-results',{
+                        "process": process,
+                        "status": "success" if output_path is not None else "failed",
+                        "filename": os.path.basename(output_path) if output_path is not None else " ".join(os.path.basename(filename).split("_"))
+                    })
+                    # Send progress event to frontend
+                    self.send_message('progress', {
+                        'process': process,
+                        'value': task.job.progress()
+                    })
 
                 try:
-                    total_files = len(pdf_print_files)
-                    for index, file in enumerate(pdf_print_files, 1):
-                        filename: str = custom_secure_filename(os.path.basename(file.filename))
+                    # Skip files that are not word documents ending in '.docx'
+                    accept = lambda name: upload_filename(name, '.docx')
+                    # Each file is saved to 'temp/jobs/<job_id>/inputs' and queued as soon as it is received
+                    for filename, source in self._stream_upload(job, journal, 'pdfPrintDirectory', accept):
+                        # Implement word to pdf file conversion
+                        self._submit(job, journal, source, callback=on_result)
 
-                        # Move to next file if it is not a word document file ending in '.docx'.
-                        if filename.startswith('~') or not filename.endswith('.docx'):
-                            continue
+                    job.seal()
+                    journal.seal()
+                    job.wait()
+                    self.app.logger.info(f'Job statistics: {job.stats()}')
+                    if job.cancelled:
+                        return self._cancelled_response(job)
 
-                        # Save temp file to 'temp/processing'
-                        temp_file_path = os.path.join(temp_dir, filename)
-                        file.save(temp_file_path)
-                        # Implement word to pdf file conversion
-                        output_path, error = convert_word_to_pdf(temp_file_path, pdf_files_directory)
-                        # Log errors
-                        if (error is not None):
-                            # Send process-error event
-                            self.send_message('process-error', {
-                                "error": "PDF Printer Error",
-                                "message": error,
-                                "process": process,
-                                "method": method
-                            })
-                            self.app.logger.error(error)
-                        # Send results event to frontend
-                        self.send_message('process-results',{
-                            "process": process,
-                            "status": "success" if output_path is not None else "failed",
-                            "filename": output_path if output_path is not None else " ".join(filename.split("_"))
-                        })  
-                        # Send progress event to frontend
-                        self.send_message('progress', {
-                            'process': process,
-                            'value': index/total_files
-                        })
-                        time.sleep(0.5)
-                    
                     self.send_message('complete', 'Successfully printed documents to PDF!')
-                    return jsonify({'status': 'success', 'message': 'Successfully printed documents to PDF!'})
+                    return jsonify({'status': 'success', 'message': 'Successfully printed documents to PDF!', 'job_id': job.id, 'download': f'/jobs/{job.id}/download'})
+                except (UploadError, ChunkError) as e:
+                    # The upload itself is invalid, stop the files already queued
+                    job.cancel()
+                    self.send_message('process-error', {
+                        "error": "Upload Error",
+                        "message": str(e),
+                        "process": process,
+                        "method": method
+                    })
+                    self.app.logger.error(f'Upload for job {job.id} rejected: {e}')
+                    return jsonify({'status': 'error', 'message': str(e), 'job_id': job.id}), 400
                 except Exception as e:
+                    if job.cancelled:
+                        # Reading the rest of the upload can fail once the browser stops sending it
+                        return self._cancelled_response(job)
                     # Send process-error event
                     self.send_message('process-error', {
                         "error": "PDF Printer Error",
@@ -574,8 +811,10 @@ class Server:
                     self.app.logger.exception('An unexpected error has occurred while printing documents to PDF', stack_info=True)
                     return jsonify({'status': 'error', 'message': 'An unexpected error has occurred while printing documents to PDF'}), 500
                 finally:
-                    # Clear 'temp/processing' directory
-                    shutil.rmtree(temp_dir)
+                    # Let queued work finish before marking the job finished and clearing its inputs
+                    job.seal()
+                    job.wait()
+                    journal.finish()
 
         @self.app.route('/pdfSignatures', methods=['GET'])
         def pdf_signatures():
@@ -594,15 +833,15 @@ class Server:
                 return render_template('pdf_signatures.html')
 
         @self.app.route('/pdfSignatures/add-signatures', methods=['POST'])
+        @self.csrf.exempt
         def add_signatures():
             process = 'pdfSignatures'
             self.send_message("process-start", "Adding signatures to PDF documents")
             if request.method == 'POST':
                 method = 'POST'
-                # Get uploaded files from form
-                pdf_signatures_files = request.files.getlist('pdfSignaturesDirectory')
+                self._validate_csrf_header()
                 # get directory for pdf files with signatures
-                pdf_files_directory = self.app.config.get('PDF_SIGNATURES_DIRECTORY', get_full_path('temp/signatures'))
+                task, pdf_files_directory, options = self._job_settings(process)
                 # Send processing event for POST method
                 self.send_message('processing', {
                     "process": process,
@@ -619,71 +858,68 @@ class Server:
                     })
                     return jsonify({"status": "error", "message": f'The specified directory ( {pdf_files_directory} ) does not exist. Configure in settings or in config file.'}), 400
 
-                temp_dir = get_full_path('temp/processing')
-                directory_check(temp_dir, True)
+                job, journal = self._create_job(process, task, pdf_files_directory, **options)
+
+                def on_result(task: Task):
+                    filename = task.args[0]
+                    output_path, error = task.result if task.error is None else (None, task.error)
+                    if output_path is not None:
+                        task.job.add_output(output_path)
+                    # Log errors
+                    if (error is not None):
+                        # Send process-error event
+                        self.send_message('process-error', {
+                            "error": "PDF Signatures Error",
+                            "message": error,
+                            "process": process,
+                            "method": method
+                        })
+                        self.app.logger.error(error)
+                    # Send results event to frontend
+                    self.send_message('process-results',{
+                        "process": process,
+                        "status": "success" if output_path is not None else "failed",
+                        "filename": os.path.basename(output_path) if output_path is not None else " ".join(os.path.basename(filename).split("_"))
+                    })
+                    # Send progress event to frontend
+                    self.send_message('progress', {
+                        'process': process,
+                        'value': task.job.progress()
+                    })
 
                 try:
-                    total_files = len(pdf_signatures_files)
-                    for index, file in enumerate(pdf_signatures_files, 1):
-                        filename: str = custom_secure_filename(os.path.basename(file.filename))
-
-                        # Move to next file if it is not a pdf document file ending in '.pdf'.
-                        if not filename.endswith('.pdf'):
-                            continue
-
-                        # Save temp file to 'temp/processing'
-                        temp_file_path = os.path.join(temp_dir, filename)
-                        file.save(temp_file_path)
+                    # Skip files that are not pdf documents ending in '.pdf'
+                    accept = lambda name: upload_filename(name, '.pdf')
+                    # Each file is saved to 'temp/jobs/<job_id>/inputs' and queued as soon as it is received
+                    for filename, source in self._stream_upload(job, journal, 'pdfSignaturesDirectory', accept):
+                        # add pdf signatures
+                        self._submit(job, journal, source, callback=on_result)
 
-                        # Get paths to output pdf files
-                        output_filename = ' '.join(filename.split('_'))
-                        output_pdf_path = os.path.join(pdf_files_directory, output_filename)
+                    job.seal()
+                    journal.seal()
+                    job.wait()
+                    self.app.logger.info(f'Job statistics: {job.stats()}')
+                    if job.cancelled:
+                        return self._cancelled_response(job)
 
-                        # add pdf signatures
-                        signature_name = extract_name(temp_file_path)
-                        page_number, y_position = find_signature_position(temp_file_path)
-
-                        self.app.logger.info(f'Signature name: {signature_name}, Page number: {page_number}, Y position: {y_position}')
-
-                        if signature_name is None or page_number is None:
-                            output_path = None
-                            error = "An error occurred getting signature name or finding signature position in the document. See logs for more information."
-                            self.app.logger.error(f'signature_name: {signature_name}, page_number: {page_number}', stack_info=True)
-                        else:
-                            # Get path for signature file
-                            signature_file = f"{'_'.join(signature_name.split(' '))}.pdf"
-                            signature_path = os.path.join(get_full_path('images/signatures'), signature_file)
-
-                            self.app.logger.info(f'Signature path: {signature_path}')
-
-                            output_path, error = add_signature(temp_file_path, output_pdf_path, signature_path, (page_number, y_position))
-
-                        # Log errors
-                        if (error is not None):
-                            # Send process-error event
-                            self.send_message('process-error', {
-                                "error": "PDF Signatures Error",
-                                "message": error,
-                                "process": process,
-                                "method": method
-                            })
-                            self.app.logger.error(error)
-                        # Send results event to frontend
-                        self.send_message('process-results',{
-                            "process": process,
-                            "status": "success" if output_path is not None else "failed",
-                            "filename": output_path if output_path is not None else " ".join(filename.split("_"))
-                        })  
-                        # Send progress event to frontend
-                        self.send_message('progress', {
-                            'process': process,
-                            'value': index/total_files
-                        })
-                    
                     self.send_message('complete', 'Successfully printed documents to PDF!')
-                    return jsonify({'status': 'success', 'message': 'Successfully printed documents to PDF!'})
+                    return jsonify({'status': 'success', 'message': 'Successfully printed documents to PDF!', 'job_id': job.id, 'download': f'/jobs/{job.id}/download'})
 
+                except (UploadError, ChunkError) as e:
+                    # The upload itself is invalid, stop the files already queued
+                    job.cancel()
+                    self.send_message('process-error', {
+                        "error": "Upload Error",
+                        "message": str(e),
+                        "process": process,
+                        "method": method
+                    })
+                    self.app.logger.error(f'Upload for job {job.id} rejected: {e}')
+                    return jsonify({'status': 'error', 'message': str(e), 'job_id': job.id}), 400
                 except Exception as e:
+                    if job.cancelled:
+                        # Reading the rest of the upload can fail once the browser stops sending it
+                        return self._cancelled_response(job)
                     # Send process-error event
                     self.send_message('process-error', {
                         "error": "PDF Signatures Error",
@@ -694,8 +930,480 @@ class Server:
                     self.app.logger.exception('An unexpected error has occurred while adding signatures to PDF documents', stack_info=True)
                     return jsonify({'status': 'error', 'message': 'An unexpected error has occurred while adding signatures to PDF documents'}), 500
                 finally:
-                    # Clear 'temp/processing' directory
-                    shutil.rmtree(temp_dir)
+                    # Let queued work finish before marking the job finished and clearing its inputs
+                    job.seal()
+                    job.wait()
+                    journal.finish()
+
+        @self.app.route('/jobs', methods=['GET'])
+        def jobs():
+            return jsonify([job.stats() for job in self.scheduler.jobs()])
+
+        @self.app.route('/workers', methods=['GET'])
+        def workers():
+            if self.worker_pool is None:
+                return jsonify({'status': 'success', 'enabled': False, 'workers': []})
+            return jsonify({'status': 'success', 'enabled': True, **self.worker_pool.stats()})
+
+        @self.app.route('/jobs/known-hashes', methods=['POST'])
+        def known_hashes():
+            # Hashes of files the browser is about to upload, the server returns those it already has results for
+            data = request.get_json(silent=True) or {}
+            try:
+                task, output_dir, options = self._job_settings(data.get('process'), sign=bool(data.get('sign')), dry_run=bool(data.get('dryRun')))
+            except KeyError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            hashes = [str(sha256) for sha256 in data.get('hashes') or []]
+            known = self.results.known(settings_fingerprint(task, output_dir, options), hashes)
+            return jsonify({'status': 'success', 'known': known})
+
+        @self.app.route('/uploads', methods=['POST'])
+        def create_upload():
+            # Files of a large batch are sent in chunks, the process route is called with ?upload=<upload_id>
+            data = request.get_json(silent=True) or {}
+            try:
+                session = self.uploads.create(data.get('files'), self.app.config.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+            except ChunkError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            return jsonify({'status': 'success', **session.status()})
+
+        @self.app.route('/uploads/<upload_id>', methods=['GET', 'DELETE'])
+        def upload_status(upload_id):
+            session = self.uploads.get(upload_id)
+            if session is None:
+                return jsonify({'status': 'error', 'message': f'Upload {upload_id} not found'}), 404
+            if request.method == 'DELETE':
+                self.uploads.remove(upload_id)
+                return jsonify({'status': 'success'})
+            return jsonify({'status': 'success', **session.status()})
+
+        @self.app.route('/uploads/<upload_id>/<int:index>/<int:chunk>', methods=['PUT'])
+        @self.csrf.exempt
+        def upload_chunk(upload_id, index, chunk):
+            # The chunk is streamed to disk, so the CSRF token is only read from the header
+            self._validate_csrf_header()
+            session = self.uploads.get(upload_id)
+            if session is None:
+                return jsonify({'status': 'error', 'message': f'Upload {upload_id} not found'}), 404
+            try:
+                complete = session.write_chunk(index, chunk, request.stream, request.headers.get('X-Chunk-SHA256', ''), request.content_length)
+            except ChunkError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            except OSError as e:
+                # Session was cancelled or finished while the chunk was being written
+                self.app.logger.warning(f'Could not write chunk {chunk} of file {index} in upload {upload_id}: {e}')
+                return jsonify({'status': 'error', 'message': f'Upload {upload_id} is closed'}), 409
+            return jsonify({'status': 'success', 'complete': complete, 'bytes_received': session.bytes_received})
+
+        @self.app.route('/jobs/<job_id>', methods=['GET'])
+        def job_stats(job_id):
+            job = self.scheduler.get_job(job_id)
+            if job is None:
+                return jsonify({'status': 'error', 'message': f'Job {job_id} not found'}), 404
+            return jsonify(job.stats())
+
+        @self.app.route('/jobs/<job_id>/cancel', methods=['POST'])
+        def cancel_job(job_id):
+            body, status = self._cancel_job(job_id)
+            return jsonify(body), status
+
+        @self.app.route('/jobs/<job_id>/trace', methods=['GET'])
+        def job_trace(job_id):
+            job = self.scheduler.get_job(job_id)
+            if job is None:
+                return jsonify({'status': 'error', 'message': f'Job {job_id} not found'}), 404
+            if job.trace is None:
+                return jsonify({'status': 'error', 'message': f'Job {job_id} was not traced'}), 404
+            response = jsonify(job.trace.to_json())
+            response.headers['Content-Disposition'] = f'attachment; filename="{job.process}-{job.id[:8]}-trace.json"'
+            return response
+
+        @self.app.route('/jobs/<job_id>/export', methods=['GET'])
+        def job_export(job_id):
+            export_format = request.args.get('format', 'csv')
+            if export_format not in ('csv', 'xlsx'):
+                return jsonify({'status': 'error', 'message': f'Unknown export format {export_format}, expected csv or xlsx'}), 400
+
+            try:
+                entries = self._entity_check_entries(job_id)
+            except LookupError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+
+            rows = (row for entry in entries for row in self._entity_rows(entry))
+            if export_format == 'xlsx':
+                body = stream_xlsx(self.EXPORT_HEADER, rows, 'Entity Check', widths=[45, 45, 40, 20, 40])
+                mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            else:
+                body = stream_csv(self.EXPORT_HEADER, rows)
+                mimetype = 'text/csv'
+            response = Response(body, mimetype=mimetype)
+            response.headers['Content-Disposition'] = f'attachment; filename="entities-{job_id[:8]}.{export_format}"'
+            return response
+
+        @self.app.route('/jobs/<job_id>/download', methods=['GET'])
+        def job_download(job_id):
+            job = self.scheduler.get_job(job_id)
+            if job is None:
+                return jsonify({'status': 'error', 'message': f'Job {job_id} not found'}), 404
+
+            def entries():
+                seen = set()
+                for path in job.iter_outputs():
+                    if not os.path.isfile(path):
+                        continue
+                    # Keep archive names unique
+                    base, ext = os.path.splitext(os.path.basename(path))
+                    arcname, count = base + ext, 1
+                    while arcname in seen:
+                        arcname, count = f'{base} ({count}){ext}', count + 1
+                    seen.add(arcname)
+                    yield arcname, path
+
+            response = Response(stream_zip(entries()), mimetype='application/zip')
+            response.headers['Content-Disposition'] = f'attachment; filename="{job.process}-{job.id[:8]}.zip"'
+            return response
+
+    def _validate_csrf_header(self):
+        """
+        Validate the CSRF token sent in the 'X-CSRF-Token' header. Used by routes that stream their request body and are
+        exempt from CSRFProtect, which would otherwise parse and buffer the whole form looking for the token.
+        """
+        if not self.app.config.get('WTF_CSRF_ENABLED', True):
+            return
+        try:
+            validate_csrf(request.headers.get('X-CSRF-Token'))
+        except ValidationError as e:
+            raise CSRFError(e.args[0])
+
+    def _job_settings(self, process: str, sign: bool=False, dry_run: bool=False) -> tuple[str, str|None, dict[str, Any]]:
+        """
+        Return the task, output directory and task options the uploads of a process run with under the current settings.
+        Raises KeyError for unknown processes.
+
+        :param sign: [Optional] print and sign in one pass, for the PDF printer.
+        :param dry_run: [Optional] preview the changes of a rollover without writing anything.
+        """
+        config = self.app.config
+        if process == 'processEngagementLetters':
+            options = {"rules": config.get('ROLLOVER_RULES'), **self.get_rate_options()}
+            if dry_run:
+                return 'preview', None, options
+            return 'rollover', config.get('PROCESSED_FILES_DIRECTORY', get_full_path('temp/complete')), options
+        if process == 'entityChecker':
+            return 'extract', None, {"address_lines": int(config['ADDRESS_SCAN_LINES'])}
+        if process == 'pdfPrinter' and sign:
+            return 'print-sign', config.get('PDF_SIGNATURES_DIRECTORY', get_full_path('temp/signatures')), {"signatures_dir": 'images/signatures', "sign_in_docx": bool(config.get('PDF_SIGN_IN_DOCX', False)), "optimize": config.get('PDF_OPTIMIZATION')}
+        if process == 'pdfPrinter':
+            return 'print-pdf', config.get('PDF_FILES_DIRECTORY', get_full_path('temp/pdf')), {}
+        if process == 'pdfSignatures':
+            return 'sign', config.get('PDF_SIGNATURES_DIRECTORY', get_full_path('temp/signatures')), {"signatures_dir": 'images/signatures', "optimize": config.get('PDF_OPTIMIZATION')}
+        raise KeyError(f'Unknown process: {process}')
+
+    def _create_job(self, process: str, task: str, output_dir: str|None, **options) -> tuple[Job, Journal]:
+        """
+        Create a scheduler job and its journal for the current request and let the frontend know where its results
+        can be downloaded.
+
+        :param task: name of the task in backend.tasks run on each file.
+        :param output_dir: directory the task writes output files to.
+        :param options: task options. Must be JSON serializable.
+        """
+        journal = Journal.create(get_full_path(JOBS_DIR), request.remote_addr, process, task, output_dir, options)
+        job = self.scheduler.create_job(request.remote_addr, process, job_id=journal.job_id)
+        # A sample of jobs, or any job uploaded with '?trace=1', records a timeline
+        if request.args.get('trace') == '1' or tracing.sampled(self.app.config.get('TRACE_SAMPLE_RATE', 0.0)):
+            job.trace = tracing.Trace(job.id)
+        message = {
+            "process": process,
+            "job_id": job.id,
+            "download": f'/jobs/{job.id}/download'
+        }
+        if process == 'entityChecker':
+            message["export"] = f'/jobs/{job.id}/export'
+        if task == 'preview':
+            # Rollover previews write no files
+            message["dry_run"] = True
+        if job.trace is not None:
+            message["trace"] = f'/jobs/{job.id}/trace'
+        self.send_message('job', message)
+        return job, journal
+
+    def _cancel_job(self, job_id: str) -> tuple[dict[str, Any], int]:
+        """
+        Cancel a job of the current user. Its queued files are dropped, running files stop at their next check and
+        conversions in progress are killed, so its workers are free again within about a second.
+
+        :return: response body and HTTP status code.
+        """
+        job = self.scheduler.get_job(job_id)
+        if job is None:
+            return {'status': 'error', 'message': f'Job {job_id} not found'}, 404
+        if job.owner != (request.remote_addr or 'anonymous'):
+            return {'status': 'error', 'message': f'Job {job_id} belongs to another user'}, 403
+        if not job.cancel():
+            return {'status': 'error', 'message': f'Job {job_id} has already finished'}, 409
+        self.app.logger.info(f'Cancelled job {job.id} ({job.process}), {job.skipped} queued file(s) dropped')
+        self.send_message('cancelled', {
+            "process": job.process,
+            "job_id": job.id,
+            "message": 'Cancelled, files that were already finished can still be downloaded.'
+        })
+        return {'status': 'success', 'job_id': job.id}, 200
+
+    def _cancelled_response(self, job: Job) -> Response:
+        """Response of a process route whose job was cancelled, see `_cancel_job`."""
+        return jsonify({'status': 'cancelled', 'message': f'Cancelled after {job.completed - job.failed} file(s) were finished.', 'job_id': job.id, 'download': f'/jobs/{job.id}/download'})
+
+    def _submit(self, job: Job, journal: Journal, source: str|dict[str, Any], callback: Callable[[Task], None]|None=None, n: int|None=None) -> Task:
+        """
+        Queue the job's task on an input file. The file is recorded in the journal when it is queued and when it
+        finishes. If BROKER_URL is set the task is sent to a worker through the broker, otherwise it runs on one of the
+        worker processes if they are enabled (WORKER_PROCESSES) or on the scheduler's thread.
+
+        :param source: path of the saved input file, or for an input that was not uploaded again, its name, hash and
+        earlier result, see `_stream_upload`. Earlier results are passed to the callback as if the task had run.
+        :param callback: [Optional] called with the finished task after it is recorded.
+        :param n: [Optional] file number of an input already in the journal, ie. when resuming a job.
+        """
+        reused = isinstance(source, dict)
+        input_path = os.path.join(journal.inputs_dir, source['name']) if reused else source
+        if n is None:
+            n = journal.queued(input_path, sha256=source['sha256'] if reused else None)
+        fingerprint = journal.fingerprint
+        # Reports of PDFs the task optimizes, logged once it finishes
+        reports: list[dict[str, Any]] = []
+
+        def on_done(task: Task):
+            for report in reports:
+                self._log_optimization(job, report)
+            journal.done(n, task.result, task.error)
+            self.results.add(fingerprint, journal.entries[n])
+            job.add_result(journal.entries[n])
+            # Files stopped by a cancel are not reported one by one, the 'cancelled' message covers them
+            if callback is not None and task.error != CANCELLED:
+                callback(task)
+
+        if reused:
+            return self.scheduler.submit(job, self._reuse_result, input_path, source['result'], callback=on_done)
+        broker_url = self.app.config.get('BROKER_URL')
+        if broker_url:
+            # Workers report the PDFs they optimize in their own output
+            fn = RemoteTask(open_broker(broker_url), journal.task, timeout=self.app.config.get('BROKER_TASK_TIMEOUT') or None)
+        else:
+            # The hash recorded when the file was queued sends it back to the worker whose cache holds it
+            task_fn = PoolTask(self.worker_pool, journal.task, journal.entries[n]['sha256']) if self.worker_pool is not None else journal.fn
+
+            def fn(*args, **kwargs):
+                with optimization_reports(reports):
+                    return task_fn(*args, **kwargs)
+        return self.scheduler.submit(job, fn, input_path, journal.output_dir, callback=on_done, **journal.options)
+
+    def _log_optimization(self, job: Job, report: dict[str, Any]):
+        """Log the bytes saved and time taken optimizing one PDF of a job, see backend.pdf_optimizer."""
+        if 'error' in report:
+            self.app.logger.warning(f'Job {job.id}: {report["error"]}')
+            return
+        self.app.logger.info(
+            f'Job {job.id}: optimized {report["file"]} from {report["bytes_before"]} to {report["bytes_after"]} bytes, '
+            f'{report["bytes_saved"]} bytes saved in {report["seconds"]:.3f}s'
+        )
+
+    def _entity_check_entries(self, job_id: str) -> Iterator[dict[str, Any]]|list[dict[str, Any]]:
+        """
+        Journal entries of an entity check job. Active and recent jobs stream their entries as files finish, older
+        jobs are read from their journal.
+
+        :raises LookupError: if the job is unknown.
+        :raises ValueError: if the job is not an entity check.
+        """
+        job = self.scheduler.get_job(job_id)
+        if job is not None:
+            process, entries = job.process, job.iter_results()
+        else:
+            directory = os.path.join(get_full_path(JOBS_DIR), secure_filename(job_id))
+            try:
+                journal = Journal.load(directory)
+            except (OSError, ValueError):
+                raise LookupError(f'Job {job_id} not found')
+            process, entries = journal.meta['process'], journal.completed()
+        if process != 'entityChecker':
+            raise ValueError(f'Job {job_id} is not an entity check')
+        return entries
+
+    @staticmethod
+    def _entity_rows(entry: dict[str, Any]) -> Iterator[list[str]]:
+        """Export rows of an entity check journal entry, one per entity, or one for a letter without entities."""
+        result = entry.get('result') or {}
+        filename = result.get('filename') or entry.get('input', '')
+        address = result.get('address', '')
+        error = entry.get('error') or ''
+        entities = result.get('entities') or [{}]
+        for entity in entities:
+            yield [filename, address, entity.get('name_of_entity', ''), entity.get('type_of_return', ''), error]
+
+    @staticmethod
+    def _reuse_result(input_path: str, earlier: dict[str, Any]|None) -> tuple[Any, str|None]:
+        """Task for an input that was not uploaded again, returns its earlier result as (result, error)."""
+        if earlier is None:
+            return None, f'The earlier result of {os.path.basename(input_path)} is no longer available, upload it again.'
+        result = earlier['result']
+        if isinstance(result, dict) and 'filename' in result:
+            # Same content may have been uploaded under another name before
+            result = {**result, 'filename': os.path.basename(input_path)}
+        return (result if result is not None else earlier['output']), None
+
+    def resume_jobs(self):
+        """
+        Resume jobs interrupted by a crash or restart. Files that finished are skipped and files that were queued or
+        running are queued again, so only the remaining work is redone. Jobs whose upload was cut off are finished with
+        the files that were received.
+        """
+        jobs_dir = get_full_path(JOBS_DIR)
+        Journal.prune(jobs_dir, self.app.config.get('JOB_JOURNAL_RETENTION_DAYS', 7) * 24 * 60 * 60)
+        self.results.load(jobs_dir)
+        for journal in Journal.unfinished(jobs_dir):
+            job = self.scheduler.create_job(journal.meta['owner'], journal.meta['process'], job_id=journal.job_id)
+            completed = journal.completed()
+            outputs = [entry['output'] for entry in completed if entry.get('output') and os.path.isfile(entry['output'])]
+            job.restore(len(completed), sum(1 for entry in completed if entry['status'] == 'failed'), outputs, completed)
+
+            def on_result(task: Task, journal: Journal=journal):
+                output = journal.output_for(task.result)
+                if output is not None:
+                    task.job.add_output(output)
+                self.send_message('progress', {
+                    'process': task.job.process,
+                    'value': task.job.progress()
+                })
+
+            remaining = journal.remaining()
+            for n, input_path in remaining:
+                self._submit(job, journal, input_path, callback=on_result, n=n)
+            job.seal()
+            journal.seal()
+            self.app.logger.info(f'Resuming job {job.id} ({job.process}): {len(completed)} file(s) already finished, {len(remaining)} queued again.')
+
+            def finish(job: Job=job, journal: Journal=journal):
+                job.wait()
+                journal.finish()
+                self.app.logger.info(f'Resumed job statistics: {job.stats()}')
+            threading.Thread(target=finish, name=f'resume-{job.id[:8]}', daemon=True).start()
+
+    def _stream_upload(self, job: Job, journal: Journal, field_name: str, accept: Callable[[str], str|None]) -> Iterator[tuple[str, str|dict[str, Any]]]:
+        """
+        Yield each uploaded file of field_name as soon as it has been received, while the rest of the upload is still
+        arriving. Rejected files are skipped without being written to disk. Uploaded '.zip' archives are extracted
+        and each accepted member is yielded as if it had been uploaded on its own.
+
+        If the request has `?upload=<upload_id>` the files come from that chunked upload session instead of the request
+        body (see /uploads), and are yielded as each file's last chunk arrives. Other form fields are then sent as a
+        normal form.
+
+        Stops without reading the rest of the upload once the job is cancelled.
+
+        Files the browser left out because the server already has their results (see /jobs/known-hashes) are listed
+        in the 'knownFiles' form field as [{"name": filename, "sha256": hash}]. They are yielded after the upload with
+        their earlier result as {"name": filename, "sha256": hash, "result": earlier result or None}. Raises
+        UploadError if that list is larger than StreamingUpload.MAX_FIELD_SIZE or invalid, so files are never dropped
+        from a job without an error.
+
+        :param job: job being fed by the upload, its intake is updated as the upload progresses.
+        :param journal: the job's journal, accepted files are saved to its inputs directory, each in a subdirectory of
+        its own so files of the same name from different folders are all kept.
+        :param field_name: form field name of the file input.
+        :param accept: called with the uploaded filename, returns the filename to save as or None to skip the file.
+        :return: iterator of (saved filename, saved file path or earlier result).
+        """
+        directory = journal.inputs_dir
+        def accept_with_zip(name: str):
+            if name.lower().endswith('.zip') and not name.startswith('~'):
+                return secure_filename(name)
+            return accept(name)
+
+        upload_id = request.args.get('upload')
+        if upload_id:
+            session = self.uploads.claim(upload_id)
+            if session is None:
+                raise ChunkError(f'Upload {upload_id} not found or already in use.')
+            files = self._session_files(session, directory, accept_with_zip)
+            progress = lambda: (session.fraction, session.bytes_received)
+            form, oversized = request.form, set()
+            # Closing the session ends the wait for its next file if the job is cancelled
+            stop = session.close
+        else:
+            upload = StreamingUpload(request.stream, request.content_type, request.content_length)
+            files = upload.files(field_name, directory, accept_with_zip)
+            progress = lambda: (upload.fraction, upload.bytes_read)
+            # Filled in as the body is parsed
+            form, oversized = upload.form, upload.oversized
+            stop = lambda: None
+
+        job.intake = 0.0
+        received = time.perf_counter()
+        with job.cancel_token.on_cancel(stop):
+            for filename, path in files:
+                job.intake, bytes_read = progress()
+                if job.trace is not None:
+                    job.trace.add('receive', 'upload', received, time.perf_counter(), {"file": filename, "bytes_read": bytes_read})
+                if filename.lower().endswith('.zip'):
+                    for member in extract_members(path, directory, accept):
+                        if job.cancelled:
+                            break
+                        yield member
+                    os.remove(path)
+                    os.rmdir(os.path.dirname(path))
+                else:
+                    yield filename, path
+                if job.cancelled:
+                    break
+                received = time.perf_counter()
+        if job.cancelled:
+            # Stop reading the upload, the rest of the request body is never parsed
+            files.close()
+            return
+        job.intake = 1.0
+
+        # Files left out of the upload would be silently missing from the job if their list could not be read
+        if 'knownFiles' in oversized:
+            raise UploadError(f'The list of files already processed is larger than {StreamingUpload.MAX_FIELD_SIZE // 1024} KiB. Upload fewer files at a time.')
+        try:
+            known_files = json.loads(form.get('knownFiles') or '[]')
+        except ValueError:
+            raise UploadError('The list of files already processed is not valid JSON.') from None
+        if not isinstance(known_files, list):
+            raise UploadError('The list of files already processed must be a list.')
+        if known_files:
+            fingerprint = journal.fingerprint
+            for known in known_files:
+                if not isinstance(known, dict):
+                    continue
+                filename = accept(str(known.get('name', '')))
+                if filename:
+                    sha256 = str(known.get('sha256', ''))
+                    yield filename, {"name": filename, "sha256": sha256, "result": self.results.lookup(fingerprint, sha256)}
+
+    def _session_files(self, session: UploadSession, directory: str, accept: Callable[[str], str|None]) -> Iterator[tuple[str, str]]:
+        """
+        Move each file of a chunked upload session to directory as soon as its last chunk arrives. The session is
+        removed once every file is complete, or when the upload stalls for UPLOAD_IDLE_TIMEOUT seconds or is cancelled.
+
+        :param accept: called with the uploaded filename, returns the filename to save as or None to skip the file.
+        :return: iterator of (saved filename, saved file path).
+        """
+        try:
+            for name, part in session.completed(self.uploads.idle_timeout):
+                filename = accept(os.path.basename(name.replace('\\', '/')))
+                if filename:
+                    path = unique_path(directory, filename)
+                    os.replace(part, path)
+                    yield filename, path
+            missing = [file['name'] for file in session.status()['files'] if file['missing']]
+            if missing:
+                self.app.logger.warning(f'Upload {session.id} stopped before {len(missing)} file(s) were complete: {", ".join(missing[:10])}')
+        finally:
+            self.uploads.remove(session.id)
 
     def socketio_events(self):
         """
@@ -711,6 +1419,12 @@ class Server:
         def disconnect_socketio():
             self.app.logger.info("Server disconnected!")
 
+        # Cancel a job, the return value is sent to the client's acknowledgement callback
+        @self.socketio.on('cancel')
+        def cancel_job(data: dict[str, str]):
+            body, _ = self._cancel_job(str((data or {}).get('job_id', '')))
+            return body
+
         # Frontend log events
         @self.socketio.on('log')
         def frontend_log(data: dict[str, str]):
@@ -722,12 +1436,16 @@ class Server:
         """Update flask settings with new values from user settings."""
         for setting in user_settings:
             self.app.config[setting['config_name']] = setting['value']
+        # Compile rollover rules once per settings change
+        try:
+            compile_rules(self.app.config.get('ROLLOVER_RULES'), self.get_rate_options())
+        except RuleError as e:
+            self.app.logger.error(f'Invalid rollover rules in user settings: {e}')
 
     def get_rate_options(self):
         """Get rate options from app.config"""
-        rates = ['COMPLIANCE_PARTNER_RATES', 'COMPLIANCE_ASSOCIATE_RATES', 'COMPLIANCE_BOOKKEEPING_RATES', 'CONSULTING_PARTNER_RATES', 'CONSULTING_ASSOCIATE_RATES']
         rate_options = {}
-        for rate in rates:
+        for rate in self.RATE_OPTIONS:
             if rate in self.app.config:
                 rate_options[rate] = self.app.config.get(rate)
 
@@ -744,13 +1462,14 @@ class Server:
         else:
             webbrowser.open(url)
 
-    def run(self, host, port, debug):
+    def run(self, host, port, debug, started_at: float|None=None):
         """
         Start the server.
 
         :param host: Pass a hostname or IP address
         :param port: Pass a port number for server to listen on
         :param debug: [Optional] debug flag. Default is True.
+        :param started_at: [Optional] `time.perf_counter()` at process start, used for the startup report. Default is when the server was created.
         """
         self.setup_logging(debug)
         self.app.logger.info("Starting the server.")
@@ -774,18 +1493,150 @@ class Server:
             self.app.logger.info("Setting up threading timer to open browser.")
             threading.Timer(1.25, lambda: self.open_browser(host, port)).start()
             self.__class__.STARTED = True
-            
-        self.app.run(host=host, port=port, debug=debug)
+
+        # Only the process serving requests restores caches, starts workers, resumes jobs, reports startup and warms
+        # backends, not the debug reloader
+        serving = not debug or os.environ.get('WERKZEUG_RUN_MAIN')
+        if serving:
+            self.warm_start()
+            self.resume_jobs()
+            started_at = started_at if started_at is not None else self.created_at
+            threading.Thread(target=self.warm_backends, args=(host, port, started_at), name='warm-backends', daemon=True).start()
+            # Stopping the server with a terminate signal drains it like Ctrl+C does
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            self.app.run(host=host, port=port, debug=debug)
+        finally:
+            if serving:
+                self.drain()
+
+    def warm_start(self):
+        """
+        Prepare everything the first requests would otherwise wait on, before the server accepts connections. The
+        document cache is configured and the cache snapshot saved by the last shutdown is restored. If WORKER_PROCESSES
+        is set the worker processes are started, each importing the backends and restoring the snapshot itself.
+        """
+        started = time.perf_counter()
+        cache_dir = self.app.config.get('DOCUMENT_CACHE_DIR')
+        documents_config = (int(self.app.config.get('DOCUMENT_CACHE_MB', 64)) * 1024 * 1024, get_full_path(cache_dir) if cache_dir else None)
+        try:
+            configure_documents(*documents_config, self.app.config.get('JOB_JOURNAL_RETENTION_DAYS', 7) * 24 * 60 * 60)
+        except Exception as e:
+            self.app.logger.error(f'Unable to configure the document cache: {e}')
+
+        snapshot_path = self._snapshot_path()
+        use_workers = self.app.config.get('WORKER_PROCESSES') and not self.app.config.get('BROKER_URL')
+        if snapshot_path and not use_workers:
+            snapshot, error = load_snapshot(snapshot_path)
+            if error:
+                self.app.logger.warning(error)
+            elif snapshot is not None:
+                restored = restore_snapshot(snapshot)
+                self.app.logger.info(f'Restored {restored["documents"]} letter(s) and {restored["rules"]} rule set(s) from the cache snapshot')
+
+        if use_workers:
+            size = self.app.config.get('SCHEDULER_WORKERS', 4)
+            snapshot = snapshot_path if snapshot_path and os.path.isfile(snapshot_path) else None
+            self.worker_pool = WorkerPool(size, BACKEND_MODULES, documents_config, snapshot, logger=self.app.logger,
+                                          max_tasks=self.app.config.get('WORKER_MAX_TASKS'), max_rss_mb=self.app.config.get('WORKER_MAX_RSS_MB'))
+            self.worker_pool.start()
+            ready = self.worker_pool.wait_ready(self.app.config.get('WORKER_START_TIMEOUT', 60))
+            if ready < size:
+                self.app.logger.warning(f'Only {ready} of {size} worker processes started, the rest start in the background.')
+        self.app.logger.info(f'Warm start finished in {time.perf_counter() - started:.2f}s')
+
+    def drain(self) -> dict[str, Any]|None:
+        """
+        Shut down gracefully. New work is refused, running files are given SHUTDOWN_DRAIN_SECONDS to finish, the
+        in-memory caches are saved to the snapshot restored by the next start and the worker processes are stopped.
+        Files still queued or running are left in their job's journal and resumed after the restart.
+
+        :return: {"running", "queued", "jobs"} left for the restart, or None if the server was already draining.
+        """
+        with self._drain_lock:
+            if self.draining:
+                return None
+            self.draining = True
+        started = time.perf_counter()
+        report = self.scheduler.drain(self.app.config.get('SHUTDOWN_DRAIN_SECONDS', 30))
+        self.app.logger.info(
+            f'Drained in {time.perf_counter() - started:.2f}s, {report["running"]} running and {report["queued"]} queued '
+            f'file(s) of {report["jobs"]} job(s) are resumed at the next start.'
+        )
+
+        snapshot_path = self._snapshot_path()
+        if snapshot_path:
+            try:
+                snapshots = self.worker_pool.snapshots() if self.worker_pool is not None else [collect_snapshot()]
+                max_bytes = int(self.app.config.get('DOCUMENT_CACHE_MB', 64)) * 1024 * 1024
+                info, error = save_snapshot(snapshot_path, merge_snapshots(snapshots, max_bytes))
+            except Exception as e:
+                info, error = None, f'Unable to save cache snapshot: {e}'
+            if error:
+                self.app.logger.error(error)
+            else:
+                self.app.logger.info(f'Saved {info["documents"]} letter(s) and {info["rules"]} rule set(s) to the cache snapshot ({info["bytes"]} bytes in {info["seconds"]:.2f}s)')
+
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+        return report
+
+    def _snapshot_path(self) -> str|None:
+        """Path of the cache snapshot, or None if snapshots are disabled (CACHE_SNAPSHOT_PATH)."""
+        path = self.app.config.get('CACHE_SNAPSHOT_PATH')
+        return get_full_path(path) if path else None
+
+    def warm_backends(self, host, port, started_at: float, timeout: float=30.0):
+        """
+        Wait until the server accepts connections, log a startup time report and then import the document backends
+        in the background so the first job does not wait on them.
+
+        :param started_at: `time.perf_counter()` at process start.
+        :param timeout: [Optional] seconds to wait for the server to start listening.
+        """
+        # Wildcard addresses can't be connected to on every platform
+        connect_host = {'0.0.0.0': '127.0.0.1', '::': '::1', '': '127.0.0.1'}.get(host, host)
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                with socket.create_connection((connect_host, port), timeout=0.5):
+                    break
+            except OSError:
+                if time.perf_counter() > deadline:
+                    self.app.logger.warning(f'Server not listening on {host}:{port} after {timeout}s, warming backends anyway.')
+                    break
+                time.sleep(0.05)
+        listening = time.perf_counter()
+        self.app.logger.info(
+            f'Startup: imports {self.created_at - started_at:.2f}s, server setup {listening - self.created_at:.2f}s, '
+            f'listening after {listening - started_at:.2f}s'
+        )
+
+        # Worker processes import the backends before the server starts listening
+        if self.worker_pool is not None:
+            return
+        for module_name in BACKEND_MODULES:
+            try:
+                import_module(module_name)
+            except Exception as e:
+                self.app.logger.error(f'Unable to import {module_name}: {e}')
+        warmed = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in import_times.items())
+        self.app.logger.info(f'Backends warmed {time.perf_counter() - listening:.2f}s after listening ({warmed})')
 
     def shutdown_server(self):
         """
-        Shut down the server gracefully.
+        Shut down the server gracefully, see `drain`. Werkzeug 2.1 and later can't be stopped from a request, the
+        process is then sent a terminate signal once the response is sent, which exits like Ctrl+C does.
         """
-        self.socketio.stop()  # Stop SocketIO if necessary
+        self.drain()
         func = request.environ.get('werkzeug.server.shutdown')
-        if func is None:
-            raise RuntimeError('Not running with the Werkzeug Server')
-        func()
+        if func is not None:
+            # Calls func with the threading server
+            self.socketio.stop()
+        else:
+            # The SIGTERM handler exits the server, the drain above is not repeated
+            threading.Timer(self.SHUTDOWN_EXIT_DELAY, os.kill, (os.getpid(), signal.SIGTERM)).start()
         print("Server shutting down...")
 
     def setup_logging(self, debug: bool):
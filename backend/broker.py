@@ -0,0 +1,482 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable
+from urllib.parse import urlparse
+import uuid
+
+from backend import cancellation
+from backend.tasks import get_task, optimization_reports
+from backend.tracing import span
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class BrokerError(RuntimeError):
+    """Raised when a broker can not be opened."""
+
+
+class Broker:
+    """
+    Queue of tasks shared by the web server and worker processes on any number of hosts. Tasks carry their input file
+    and options, and results carry the output files, so workers do not need access to the server's file system.
+
+    Tasks are leased to a worker while it runs them and the worker renews the lease until the task finishes. A task
+    whose worker dies is leased to another worker once the lease expires, so every task runs at least once.
+    """
+
+    def put(self, task: str, input_name: str, payload: bytes, output_dir: str|None, options: dict[str, Any]) -> str:
+        """
+        Queue a task.
+
+        :param task: task name in backend.tasks.
+        :param input_name: filename of the input file.
+        :param payload: contents of the input file.
+        :param output_dir: output directory on the server, only used to tell if the task writes output files.
+        :param options: JSON serializable task options.
+        :return: id of the queued task.
+        """
+        raise NotImplementedError
+
+    def claim(self, worker: str, lease: float) -> dict[str, Any]|None:
+        """
+        Lease the oldest queued task to a worker.
+
+        :param worker: id of the worker.
+        :param lease: seconds the worker has to complete the task before it is given to another worker.
+        :return: dict with id, task, input_name, payload, output_dir and options, or None if no task is queued.
+        """
+        raise NotImplementedError
+
+    def renew(self, task_id: str, worker: str, lease: float) -> bool:
+        """
+        Extend a worker's lease on a task it is still running.
+
+        :param lease: seconds from now the worker has to complete the task or renew the lease again.
+        :return: False if the worker no longer holds the lease, ie. it expired and the task was given to another worker.
+        """
+        raise NotImplementedError
+
+    def complete(self, task_id: str, worker: str, result: Any, error: str|None, outputs: dict[str, bytes]):
+        """
+        Store the result of a task. Ignored if the task's lease expired and it was given to another worker.
+
+        :param result: JSON serializable task result.
+        :param outputs: output files by filename.
+        """
+        raise NotImplementedError
+
+    def result(self, task_id: str, timeout: float|None=None) -> dict[str, Any]|None:
+        """
+        Wait for the result of a task and remove the task from the broker.
+
+        :return: dict with result, error and outputs, or None on timeout.
+        """
+        raise NotImplementedError
+
+    def discard(self, task_id: str):
+        """
+        Remove a task whose result is no longer wanted, ie. because its job was cancelled. A queued task is never run
+        and the result of a running task is ignored when its worker completes it.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict[str, int]:
+        """Number of queued and running tasks."""
+        raise NotImplementedError
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker backed by a SQLite database file on a local disk. Needs no other services, for extra worker processes on
+    the server's machine. SQLite's file locking is not reliable on network shares (SMB, NFS), where two workers could
+    lease the same task, so workers on other hosts need a RedisBroker.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    task TEXT NOT NULL,
+                    input_name TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    output_dir TEXT,
+                    options TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    worker TEXT,
+                    lease_until REAL,
+                    result TEXT,
+                    error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, seq);
+                CREATE TABLE IF NOT EXISTS outputs (
+                    task_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS outputs_task ON outputs (task_id);
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Connection of the calling thread. Connections are not shared between threads."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def put(self, task, input_name, payload, output_dir, options):
+        task_id = uuid.uuid4().hex
+        db = self._connect()
+        db.execute(
+            "INSERT INTO tasks (id, seq, task, input_name, payload, output_dir, options) VALUES (?, (SELECT IFNULL(MAX(seq), 0) + 1 FROM tasks), ?, ?, ?, ?, ?)",
+            (task_id, task, input_name, payload, output_dir, json.dumps(options))
+        )
+        return task_id
+
+    def claim(self, worker, lease):
+        db = self._connect()
+        now = time.time()
+        # Take a write lock first so two workers can't lease the same task
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT id, task, input_name, payload, output_dir, options FROM tasks "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) ORDER BY seq LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                db.execute("UPDATE tasks SET status = 'running', worker = ?, lease_until = ? WHERE id = ?", (worker, now + lease, row[0]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {"id": row[0], "task": row[1], "input_name": row[2], "payload": row[3], "output_dir": row[4], "options": json.loads(row[5])}
+
+    def renew(self, task_id, worker, lease):
+        db = self._connect()
+        return db.execute(
+            "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'", (time.time() + lease, task_id, worker)
+        ).rowcount > 0
+
+    def complete(self, task_id, worker, result, error, outputs):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            updated = db.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = ?, payload = x'' WHERE id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(result), error, task_id, worker)
+            ).rowcount
+            if updated:
+                db.executemany("INSERT INTO outputs (task_id, name, data) VALUES (?, ?, ?)", [(task_id, name, data) for name, data in outputs.items()])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def result(self, task_id, timeout=None):
+        db = self._connect()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            row = db.execute("SELECT result, error FROM tasks WHERE id = ? AND status = 'done'", (task_id,)).fetchone()
+            if row is not None:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+        outputs = dict(db.execute("SELECT name, data FROM outputs WHERE task_id = ?", (task_id,)).fetchall())
+        db.execute("DELETE FROM outputs WHERE task_id = ?", (task_id,))
+        db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+        return {"result": json.loads(row[0]), "error": row[1], "outputs": outputs}
+
+    def discard(self, task_id):
+        db = self._connect()
+        # complete() only stores results of tasks that are still in the table
+        db.execute("DELETE FROM outputs WHERE task_id = ?", (task_id,))
+        db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def stats(self):
+        counts = dict(self._connect().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return {"queued": counts.get('queued', 0), "running": counts.get('running', 0)}
+
+
+class RedisBroker(Broker):
+    """
+    Broker backed by a Redis server, for workers on other hosts. Needs the optional `redis` package.
+
+    Claimed tasks are moved from the queue to a processing list in one step, and their lease expiry is kept in a
+    sorted set. A task in the processing list without a lease, ie. because its worker died right after claiming it,
+    is given CLAIM_GRACE seconds to get one before it is queued again.
+    """
+    QUEUE = 'pel:queue'
+    PROCESSING = 'pel:processing'
+    RUNNING = 'pel:running'
+    CLAIM_GRACE = 30.0
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise BrokerError('The redis package is required for redis:// brokers. Install it with `pip install redis`.')
+        self.client = redis.Redis.from_url(url)
+
+    def put(self, task, input_name, payload, output_dir, options):
+        task_id = uuid.uuid4().hex
+        self.client.hset(f'pel:task:{task_id}', mapping={
+            "task": task,
+            "input_name": input_name,
+            "payload": payload,
+            "output_dir": json.dumps(output_dir),
+            "options": json.dumps(options)
+        })
+        self.client.lpush(self.QUEUE, task_id)
+        return task_id
+
+    def _requeue_expired(self):
+        """Queue tasks again whose worker did not complete them before the lease expired."""
+        now = time.time()
+        # Tasks claimed without a lease, only added if the claiming worker hasn't added its own lease yet
+        claimed = self.client.lrange(self.PROCESSING, 0, -1)
+        if claimed:
+            pipe = self.client.pipeline(transaction=False)
+            for task_id in claimed:
+                pipe.zadd(self.RUNNING, {task_id: now + self.CLAIM_GRACE}, nx=True)
+            pipe.execute()
+        for task_id in self.client.zrangebyscore(self.RUNNING, 0, now):
+            # Only the client that removes the lease queues the task again
+            if self.client.zrem(self.RUNNING, task_id):
+                pipe = self.client.pipeline(transaction=True)
+                pipe.lrem(self.PROCESSING, 0, task_id)
+                pipe.rpush(self.QUEUE, task_id)
+                pipe.execute()
+
+    def claim(self, worker, lease):
+        self._requeue_expired()
+        # Moved to the processing list in the same step, so a task is never in neither list
+        item = self.client.brpoplpush(self.QUEUE, self.PROCESSING, timeout=1)
+        if item is None:
+            return None
+        task_id = item.decode()
+        self.client.zadd(self.RUNNING, {task_id: time.time() + lease})
+        self.client.hset(f'pel:task:{task_id}', 'worker', worker)
+        data = self.client.hgetall(f'pel:task:{task_id}')
+        if b'task' not in data:
+            # Discarded while it was being claimed
+            self.client.zrem(self.RUNNING, task_id)
+            self.client.lrem(self.PROCESSING, 0, task_id)
+            self.client.delete(f'pel:task:{task_id}')
+            return None
+        return {
+            "id": task_id,
+            "task": data[b'task'].decode(),
+            "input_name": data[b'input_name'].decode(),
+            "payload": data[b'payload'],
+            "output_dir": json.loads(data[b'output_dir']),
+            "options": json.loads(data[b'options'])
+        }
+
+    def renew(self, task_id, worker, lease):
+        if self.client.hget(f'pel:task:{task_id}', 'worker') != worker.encode():
+            return False
+        # Only a lease that still exists is extended, an expired one was already queued again
+        return bool(self.client.zadd(self.RUNNING, {task_id: time.time() + lease}, xx=True, ch=True))
+
+    def complete(self, task_id, worker, result, error, outputs):
+        key = f'pel:task:{task_id}'
+        if self.client.hget(key, 'worker') != worker.encode():
+            return
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrem(self.RUNNING, task_id)
+        pipe.lrem(self.PROCESSING, 0, task_id)
+        if not pipe.execute()[0]:
+            return
+        if outputs:
+            self.client.hset(f'pel:outputs:{task_id}', mapping=outputs)
+        self.client.delete(key)
+        self.client.rpush(f'pel:result:{task_id}', json.dumps({"result": result, "error": error}))
+
+    def result(self, task_id, timeout=None):
+        item = self.client.blpop(f'pel:result:{task_id}', timeout=0 if timeout is None else max(1, int(timeout)))
+        if item is None:
+            return None
+        reply = json.loads(item[1])
+        outputs = {name.decode(): data for name, data in self.client.hgetall(f'pel:outputs:{task_id}').items()}
+        self.client.delete(f'pel:outputs:{task_id}')
+        reply['outputs'] = outputs
+        return reply
+
+    def discard(self, task_id):
+        self.client.lrem(self.QUEUE, 0, task_id)
+        # complete() ignores tasks without a lease
+        self.client.zrem(self.RUNNING, task_id)
+        self.client.lrem(self.PROCESSING, 0, task_id)
+        self.client.delete(f'pel:task:{task_id}', f'pel:outputs:{task_id}', f'pel:result:{task_id}')
+
+    def stats(self):
+        return {"queued": self.client.llen(self.QUEUE), "running": self.client.zcard(self.RUNNING)}
+
+
+_brokers: dict[str, Broker] = {}
+_brokers_lock = threading.Lock()
+
+
+def open_broker(url: str) -> Broker:
+    """
+    Open a broker by URL. Brokers are cached, so every caller in the process shares one per URL.
+
+    :param url: 'sqlite:///path/to/broker.db' or a plain path for a SQLiteBroker, 'redis://host:port/db' for a RedisBroker.
+    """
+    with _brokers_lock:
+        broker = _brokers.get(url)
+        if broker is None:
+            scheme = urlparse(url).scheme
+            if scheme in ('redis', 'rediss'):
+                broker = RedisBroker(url)
+            elif scheme == 'sqlite':
+                broker = SQLiteBroker(url[len('sqlite:///'):] if url.startswith('sqlite:///') else url[len('sqlite:'):])
+            elif scheme in ('', 'file') or len(scheme) == 1:
+                # Plain paths, including Windows drive letters
+                broker = SQLiteBroker(url[len('file://'):] if scheme == 'file' else url)
+            else:
+                raise BrokerError(f'Unsupported broker URL: {url}')
+            _brokers[url] = broker
+        return broker
+
+
+class RemoteTask:
+    """
+    Stand-in for a task in backend.tasks that runs it on a worker through a broker. Called like the task itself, the
+    input file is sent with the task and output files are written to output_dir when the result arrives.
+    """
+
+    def __init__(self, broker: Broker, task: str, timeout: float|None=None):
+        """
+        :param timeout: [Optional] seconds to wait for a worker to queue, run and complete the task before it is
+        discarded and the file fails. Default waits forever.
+        """
+        self.broker = broker
+        self.task = task
+        self.timeout = timeout
+
+    def __call__(self, input_path: str, output_dir: str|None, **options) -> tuple[Any, str|None]:
+        with span('send to broker'):
+            with open(input_path, 'rb') as file:
+                payload = file.read()
+            task_id = self.broker.put(self.task, os.path.basename(input_path), payload, output_dir, options)
+        # Time queued in the broker and running on a worker. If the job is cancelled the task is discarded, a worker
+        # already running it finishes but its result is dropped.
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with span('remote', 'queue', task_id=task_id):
+            reply = None
+            try:
+                while reply is None:
+                    cancellation.check()
+                    if deadline is not None and time.monotonic() > deadline:
+                        self.broker.discard(task_id)
+                        return None, f'No worker completed {os.path.basename(input_path)} within {self.timeout:g} seconds'
+                    reply = self.broker.result(task_id, timeout=0.5)
+            except cancellation.Cancelled:
+                self.broker.discard(task_id)
+                raise
+        result = reply['result']
+        with span('receive outputs'):
+            for name, data in reply['outputs'].items():
+                with open(os.path.join(output_dir, os.path.basename(name)), 'wb') as file:
+                    file.write(data)
+        # Workers return output filenames, point them at the server's output directory
+        if isinstance(result, str) and result in reply['outputs']:
+            result = os.path.join(output_dir, result)
+        return result, reply['error']
+
+    def __repr__(self):
+        return f'<remote {self.task}>'
+
+
+def _renew_lease(broker: Broker, task_id: str, worker: str, lease: float, done: threading.Event):
+    """Renew the lease on a running task every third of the lease until it finishes or the lease is lost."""
+    while not done.wait(lease / 3):
+        try:
+            if not broker.renew(task_id, worker, lease):
+                return
+        except Exception:
+            # Broker briefly unavailable, the next renewal is still within the lease
+            pass
+
+def run_worker(url: str, worker: str|None=None, lease: float=60.0, stop: threading.Event|None=None, on_result: Callable[[dict[str, Any]], None]|None=None):
+    """
+    Run tasks from a broker until stopped. Each task's input is written to a temporary directory, the task is run
+    with a temporary output directory and every file it writes is sent back with the result.
+
+    :param url: broker URL, see `open_broker`.
+    :param worker: [Optional] id of the worker. Default is the host name, process id and a random suffix.
+    :param lease: [Optional] seconds without a lease renewal before a task is given to another worker. Leases are
+    renewed while the task runs, so this is how long a worker that died goes unnoticed. Default is 60.
+    :param stop: [Optional] event that stops the worker after its current task.
+    :param on_result: [Optional] called with a summary of each finished task.
+    """
+    broker = open_broker(url)
+    worker = worker or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        item = broker.claim(worker, lease)
+        if item is None:
+            # SQLite brokers return immediately when the queue is empty
+            stop.wait(0.2)
+            continue
+        started = time.perf_counter()
+        reports = []
+        with tempfile.TemporaryDirectory(prefix='pel-worker-') as temp_dir:
+            input_dir = os.path.join(temp_dir, 'input')
+            output_dir = os.path.join(temp_dir, 'output')
+            os.makedirs(input_dir)
+            os.makedirs(output_dir)
+            input_path = os.path.join(input_dir, os.path.basename(item['input_name']))
+            with open(input_path, 'wb') as file:
+                file.write(item['payload'])
+            done = threading.Event()
+            threading.Thread(target=_renew_lease, args=(broker, item['id'], worker, lease, done), name='renew-lease', daemon=True).start()
+            try:
+                with optimization_reports(reports):
+                    result, error = get_task(item['task'])(input_path, output_dir if item['output_dir'] is not None else None, **item['options'])
+            except Exception as e:
+                result, error = None, str(e)
+            finally:
+                done.set()
+            outputs = {}
+            for name in os.listdir(output_dir):
+                with open(os.path.join(output_dir, name), 'rb') as file:
+                    outputs[name] = file.read()
+            if isinstance(result, str):
+                result = os.path.basename(result)
+            broker.complete(item['id'], worker, result, error, outputs)
+        if on_result is not None:
+            summary = {"type": "result", "worker": worker, "task": item['task'], "file": item['input_name'], "error": error, "seconds": round(time.perf_counter() - started, 4)}
+            if reports:
+                summary["optimized"] = reports
+            on_result(summary)
@@ -0,0 +1,164 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import threading
+from typing import Callable
+
+
+_local = threading.local()
+
+
+class Cancelled(BaseException):
+    """
+    Raised inside a task when its job is cancelled. Derives from BaseException, like asyncio.CancelledError, so the
+    `except Exception` blocks that turn task errors into (result, error) tuples let it through.
+    """
+
+
+class ShuttingDown(Cancelled):
+    """
+    Raised inside a task that was stopped because the server is shutting down rather than because its job was
+    cancelled. The scheduler leaves its file unfinished in the job's journal so it is resumed after the restart.
+    """
+
+
+class CancelToken:
+    """
+    Cancellation flag shared by the tasks of one job. Tasks check it between files and pipeline stages, and register
+    callbacks that stop work which can't check it, ie. killing a converter process.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: dict[int, Callable[[], None]] = {}
+        self._next = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> bool:
+        """
+        Cancel and run every registered callback.
+
+        :return: False if the token was already cancelled.
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+        return True
+
+    def check(self):
+        """Raise Cancelled if the token was cancelled."""
+        if self._event.is_set():
+            raise Cancelled()
+
+    def on_cancel(self, callback: Callable[[], None]) -> '_Registration':
+        """
+        Run callback when the token is cancelled while inside a with block. Runs it straight away if the token is
+        already cancelled. Callbacks run on the cancelling thread and must be quick.
+        """
+        return _Registration(self, callback)
+
+
+class _Registration:
+    __slots__ = ('token', 'callback', 'key')
+
+    def __init__(self, token: CancelToken, callback: Callable[[], None]):
+        self.token = token
+        self.callback = callback
+
+    def __enter__(self):
+        token = self.token
+        with token._lock:
+            self.key = token._next
+            token._next += 1
+            token._callbacks[self.key] = self.callback
+            cancelled = token._event.is_set()
+        if cancelled:
+            self.callback()
+        return self
+
+    def __exit__(self, *exc):
+        with self.token._lock:
+            self.token._callbacks.pop(self.key, None)
+        return False
+
+
+class _NoRegistration:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_REGISTRATION = _NoRegistration()
+
+
+def current() -> CancelToken|None:
+    """Return the token active on this thread, if any."""
+    return getattr(_local, 'token', None)
+
+class activate:
+    """Make token the active token of this thread inside a with block. A token of None disables cancellation."""
+    __slots__ = ('token', 'previous')
+
+    def __init__(self, token: CancelToken|None):
+        self.token = token
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'token', None)
+        _local.token = self.token
+        return self.token
+
+    def __exit__(self, *exc):
+        _local.token = self.previous
+        return False
+
+def check():
+    """Raise Cancelled if the thread's active token was cancelled. Does nothing outside a cancellable task."""
+    token = getattr(_local, 'token', None)
+    if token is not None and token._event.is_set():
+        raise Cancelled()
+
+def on_cancel(callback: Callable[[], None]):
+    """Run callback if the thread's active token is cancelled inside the with block, see `CancelToken.on_cancel`."""
+    token = getattr(_local, 'token', None)
+    if token is None:
+        return _NO_REGISTRATION
+    return token.on_cancel(callback)
+
+def acquire(lock: threading.Lock, poll: float=0.1):
+    """
+    Acquire lock, giving up with Cancelled if the thread's active token is cancelled while waiting for it.
+
+    :param poll: [Optional] seconds between checks of the token.
+    """
+    while not lock.acquire(timeout=poll):
+        check()
+    try:
+        check()
+    except Cancelled:
+        lock.release()
+        raise
@@ -0,0 +1,366 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Any, Iterator
+
+from backend.broker import open_broker, run_worker
+from backend.reconcile import reconcile
+from backend.tasks import get_task, optimization_reports
+from backend.utils.load_json import load_json_data
+from backend.utils.path_utils import get_full_path, upload_filename
+
+
+USER_CONFIG_PATH = 'user-config.json'
+RATE_OPTIONS = ['COMPLIANCE_PARTNER_RATES', 'COMPLIANCE_ASSOCIATE_RATES', 'COMPLIANCE_BOOKKEEPING_RATES', 'CONSULTING_PARTNER_RATES', 'CONSULTING_ASSOCIATE_RATES']
+
+# Input extension, output directory setting and default worker count of each command, see backend.tasks.
+# Word only converts one document at a time, so printing defaults to a single worker.
+COMMANDS = {
+    'rollover': ('.docx', 'PROCESSED_FILES_DIRECTORY', 'temp/complete', os.cpu_count() or 1),
+    'extract': ('.docx', None, None, os.cpu_count() or 1),
+    'print-pdf': ('.docx', 'PDF_FILES_DIRECTORY', 'temp/pdf', 1),
+    'sign': ('.pdf', 'PDF_SIGNATURES_DIRECTORY', 'temp/signatures', os.cpu_count() or 1),
+    'print-sign': ('.docx', 'PDF_SIGNATURES_DIRECTORY', 'temp/signatures', 1),
+}
+
+
+def load_user_config(path: str|None=None) -> dict[str, Any]:
+    """
+    Load user settings as a {config_name: value} dict without starting the server.
+
+    :param path: [Optional] path to a user-config.json. Default is the project's user-config.json.
+    """
+    settings = load_json_data(path or get_full_path(USER_CONFIG_PATH)) or []
+    return {setting['config_name']: setting['value'] for setting in settings}
+
+def find_files(source: str, extension: str, skip_do_not_roll: bool=False) -> Iterator[str]:
+    """
+    Walk a directory tree and yield the files the upload forms would accept, in a stable order.
+
+    :param source: directory to search.
+    :param extension: required file extension, ie. '.docx'.
+    :param skip_do_not_roll: [Optional] skip files marked 'DO NOT ROLL'.
+    """
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if upload_filename(name, extension, skip_do_not_roll):
+                yield os.path.join(root, name)
+
+def run_file(command: str, path: str, output_dir: str|None, options: dict[str, Any]) -> dict[str, Any]:
+    """
+    Run one command on one file. Runs in a worker process, so errors are returned rather than raised.
+
+    :return: JSON serializable result with the input file, output file or extracted info, error and seconds taken,
+    and a report for each PDF optimized.
+    """
+    started = time.perf_counter()
+    result = {"type": "result", "command": command, "file": path}
+    try:
+        with optimization_reports() as reports:
+            value, error = get_task(command)(path, output_dir, **options)
+        if reports:
+            result["optimized"] = reports
+        if command == 'extract':
+            result.update({"address": value['address'], "address_fields": value['address_fields'], "entities": value['entities']})
+        elif command == 'preview':
+            if value is not None:
+                result.update({"updated": value['updated'], "changes": value['changes']})
+        else:
+            result["output"] = value
+        result["error"] = error
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+def failed_file(command: str, path: str, error: Exception) -> dict[str, Any]:
+    """Result of a file whose worker process exited before returning one, ie. killed for using too much memory."""
+    return {"type": "result", "command": command, "file": path, "error": f'Worker process exited: {error or type(error).__name__}', "seconds": None}
+
+def mirrored_directory(output_dir: str|None, source: str, path: str) -> str|None:
+    """
+    Create and return the directory under output_dir the output of an input file is saved to. Subdirectories of the
+    source are mirrored, so letters of the same name in different folders don't overwrite each other's output.
+    """
+    if output_dir is None:
+        return None
+    directory = os.path.normpath(os.path.join(output_dir, os.path.relpath(os.path.dirname(path), source)))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def output_directory(command: str, config: dict[str, Any], output: str|None=None) -> str|None:
+    """
+    Create and return the output directory of a command. None for commands without output files.
+
+    :param output: [Optional] directory given on the command line. Default is the directory in user settings.
+    """
+    _, directory_setting, default_directory, _ = COMMANDS[command]
+    if directory_setting is None:
+        return None
+    directory = os.path.abspath(output or get_full_path(config.get(directory_setting, default_directory)))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def rollover_options(config: dict[str, Any]) -> dict[str, Any]:
+    """Rollover rules and rate options from user settings."""
+    options = {rate: config[rate] for rate in RATE_OPTIONS if rate in config}
+    options['rules'] = config.get('ROLLOVER_RULES')
+    return options
+
+def sign_in_docx(args: argparse.Namespace, config: dict[str, Any]) -> bool:
+    """Whether print-sign places signature images in letters before printing, from --sign-in-docx, --stamp-pdf or the PDF_SIGN_IN_DOCX setting."""
+    if args.sign_in_docx or args.stamp_pdf:
+        return args.sign_in_docx
+    return bool(config.get('PDF_SIGN_IN_DOCX', False))
+
+def command_options(args: argparse.Namespace, config: dict[str, Any]) -> dict[str, Any]:
+    """Backend keyword arguments for a command, taken from the command line and user settings."""
+    if args.command == 'rollover':
+        return rollover_options(config)
+    if args.command == 'extract':
+        return {"address_lines": args.address_lines or int(config.get('ADDRESS_SCAN_LINES', 40))}
+    if args.command == 'print-pdf':
+        return {}
+    if args.command == 'sign':
+        return {"signatures_dir": os.path.abspath(args.signatures), "incremental": not args.rewrite, "optimize": config.get('PDF_OPTIMIZATION')}
+    if args.command == 'print-sign':
+        return {"signatures_dir": os.path.abspath(args.signatures), "sign_in_docx": sign_in_docx(args, config), "incremental": not args.rewrite, "optimize": config.get('PDF_OPTIMIZATION')}
+    return {}
+
+def emit(record: dict[str, Any]):
+    """Write one JSON line to stdout."""
+    sys.stdout.write(json.dumps(record) + '\n')
+    sys.stdout.flush()
+
+def run(args: argparse.Namespace) -> int:
+    """
+    Run a batch command over a directory tree. Writes one JSON line per file and a summary line to stdout. Outputs
+    are saved under the output directory in the same subdirectories as their input under the source.
+
+    :return: exit code, 0 if every file succeeded, 1 if any failed, 2 if the source directory does not exist.
+    """
+    if args.command == 'watch':
+        # The watcher builds on this module, so it is imported here
+        from backend import watcher
+        return watcher.run(args)
+    if args.command == 'worker':
+        return run_workers(args)
+    if args.command == 'reconcile':
+        return run_reconcile(args)
+
+    extension, _, _, default_workers = COMMANDS[args.command]
+    # A dry run rollover only reports the changes it would make
+    command = 'preview' if getattr(args, 'dry_run', False) else args.command
+    if not os.path.isdir(args.source):
+        emit({"type": "error", "command": command, "error": f"Source directory not found: {args.source}"})
+        return 2
+
+    config = load_user_config(args.config)
+    output_dir = output_directory(args.command, config, getattr(args, 'output', None)) if command != 'preview' else None
+    options = command_options(args, config)
+    workers = max(1, args.workers or default_workers)
+
+    started = time.perf_counter()
+    files = list(find_files(args.source, extension, skip_do_not_roll=args.command == 'rollover'))
+    succeeded = failed = bytes_saved = 0
+    with ProcessPoolExecutor(max_workers=min(workers, max(1, len(files)))) as pool:
+        futures = {pool.submit(run_file, command, path, mirrored_directory(output_dir, args.source, path), options): path for path in files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                result = failed_file(command, futures[future], e)
+            if result["error"] is None:
+                succeeded += 1
+            else:
+                failed += 1
+            bytes_saved += sum(report.get('bytes_saved', 0) for report in result.get('optimized', []))
+            emit(result)
+
+    seconds = time.perf_counter() - started
+    emit({
+        "type": "summary",
+        "command": command,
+        "files": len(files),
+        "succeeded": succeeded,
+        "failed": failed,
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(len(files) / seconds, 2) if seconds > 0 else 0.0,
+        "bytes_saved": bytes_saved,
+        "output_dir": output_dir
+    })
+    return 1 if failed else 0
+
+def run_reconcile(args: argparse.Namespace) -> int:
+    """
+    Extract the letters of a prior and a current year directory tree side by side on one process pool, then compare
+    their entities. Writes one JSON line per letter whose entities changed, per letter found in only one year and per
+    letter that could not be read, and a summary line to stdout.
+
+    :return: exit code, 0 if every entity of the prior year is still present, 1 if any is missing or a letter could
+    not be read, 2 if a source directory does not exist.
+    """
+    for source in (args.prior, args.current):
+        if not os.path.isdir(source):
+            emit({"type": "error", "command": "reconcile", "error": f"Source directory not found: {source}"})
+            return 2
+
+    config = load_user_config(args.config)
+    options = {"address_lines": args.address_lines or int(config.get('ADDRESS_SCAN_LINES', 40))}
+    workers = max(1, args.workers or COMMANDS['extract'][3])
+
+    started = time.perf_counter()
+    files = [(side, path) for side, source in (('prior', args.prior), ('current', args.current)) for path in find_files(source, '.docx')]
+    letters = {"prior": [], "current": []}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=min(workers, max(1, len(files)))) as pool:
+        futures = {pool.submit(run_file, 'extract', path, None, options): (side, path) for side, path in files}
+        for future in as_completed(futures):
+            side, path = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                result = failed_file('extract', path, e)
+            if result["error"] is not None:
+                failed += 1
+                emit({**result, "year": side})
+                continue
+            letters[side].append({
+                "filename": os.path.basename(result["file"]),
+                "address": result["address"],
+                "address_fields": result["address_fields"],
+                "entities": result["entities"]
+            })
+    extracted = time.perf_counter()
+
+    report = reconcile(letters["prior"], letters["current"], include_unchanged=args.all)
+    for letter in report["letters"]:
+        emit({"type": "letter", **letter})
+    for side in ("prior_only", "current_only"):
+        for letter in report[side]:
+            emit({"type": side, **letter})
+    summary = report["summary"]
+    emit({
+        "type": "summary",
+        "command": "reconcile",
+        "files": len(files),
+        "failed": failed,
+        "workers": workers,
+        "extract_seconds": round(extracted - started, 3),
+        **summary,
+        "seconds": round(time.perf_counter() - started, 3)
+    })
+    return 1 if failed or summary["missing_entities"] else 0
+
+def run_workers(args: argparse.Namespace) -> int:
+    """
+    Run worker processes that take tasks from the broker until interrupted. Writes one JSON line per finished task.
+
+    :return: exit code, 2 if no broker is configured.
+    """
+    config = load_user_config(args.config)
+    url = args.broker or config.get('BROKER_URL')
+    if not url:
+        emit({"type": "error", "command": "worker", "error": "No broker configured. Pass --broker or set BROKER_URL."})
+        return 2
+    # Fail early on bad broker URLs rather than in every worker process
+    open_broker(url)
+
+    workers = max(1, args.workers or os.cpu_count() or 1)
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(url,), kwargs={"lease": args.lease, "on_result": emit}, name=f'worker-{i}', daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    emit({"type": "workers", "broker": url, "workers": workers})
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    return 0
+
+def add_commands(parser: argparse.ArgumentParser):
+    """Add the batch subcommands to the main.py argument parser."""
+    subparsers = parser.add_subparsers(dest='command', metavar='command', help='Process a directory without starting the server. Run the server if omitted.')
+    descriptions = {
+        'rollover': 'Roll over every engagement letter in a directory tree.',
+        'extract': 'Extract address and entity info from every engagement letter in a directory tree.',
+        'print-pdf': 'Print every engagement letter in a directory tree to PDF.',
+        'sign': 'Add partner signatures to every engagement letter PDF in a directory tree.',
+        'print-sign': 'Print every engagement letter in a directory tree to PDF with partner signatures.',
+    }
+    for command, description in descriptions.items():
+        subparser = subparsers.add_parser(command, help=description, description=description)
+        subparser.add_argument('source', help='Directory to search for files, including subdirectories.')
+        if command != 'extract':
+            subparser.add_argument('-o', '--output', help='Directory to save output files to. Default is the directory in user settings.')
+        subparser.add_argument('-w', '--workers', type=int, default=None, help=f'Number of worker processes. Default is {COMMANDS[command][3]}.')
+        subparser.add_argument('--config', default=None, help='Path to a user-config.json. Default is the project user-config.json.')
+        if command == 'rollover':
+            subparser.add_argument('--dry-run', action='store_true', help='Report the paragraphs each letter would change and the letters that would not be updated, without writing anything.')
+        if command == 'extract':
+            subparser.add_argument('--address-lines', type=int, default=None, help='Lines at the top of each letter searched for the address. Default is the ADDRESS_SCAN_LINES setting.')
+        if command == 'sign':
+            subparser.add_argument('--signatures', default=get_full_path('images/signatures'), help='Directory of partner signature PDFs. Default is images/signatures.')
+            subparser.add_argument('--rewrite', action='store_true', help='Rewrite each signed PDF instead of appending the signature to the original bytes.')
+        if command == 'print-sign':
+            subparser.add_argument('--signatures', default=get_full_path('images/signatures'), help='Directory of partner signature images and PDFs. Default is images/signatures.')
+            stamping = subparser.add_mutually_exclusive_group()
+            stamping.add_argument('--sign-in-docx', action='store_true', help='Place signature images in the letters before printing. Default is the PDF_SIGN_IN_DOCX setting.')
+            stamping.add_argument('--stamp-pdf', action='store_true', help='Stamp signatures onto the printed PDFs instead of placing them in the letters before printing.')
+            subparser.add_argument('--rewrite', action='store_true', help='With --stamp-pdf, rewrite each signed PDF instead of appending the signature to the printed bytes.')
+
+    description = 'Watch a directory and roll over new or changed engagement letters as they arrive.'
+    subparser = subparsers.add_parser('watch', help=description, description=description)
+    subparser.add_argument('source', nargs='?', default=None, help='Directory to watch, including subdirectories. Default is the WATCH_DIRECTORY setting.')
+    subparser.add_argument('--print-pdf', action='store_true', help='Print each rolled over letter to PDF.')
+    subparser.add_argument('--sign', action='store_true', help='Print each rolled over letter to PDF with partner signatures.')
+    subparser.add_argument('--signatures', default=get_full_path('images/signatures'), help='Directory of partner signature images and PDFs. Default is images/signatures.')
+    stamping = subparser.add_mutually_exclusive_group()
+    stamping.add_argument('--sign-in-docx', action='store_true', help='With --sign, place signature images in the letters before printing. Default is the PDF_SIGN_IN_DOCX setting.')
+    stamping.add_argument('--stamp-pdf', action='store_true', help='With --sign, stamp signatures onto the printed PDFs instead of placing them in the letters before printing.')
+    subparser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes. Default is 1.')
+    subparser.add_argument('--debounce', type=float, default=2.0, help='Seconds a file must stay unchanged before it is processed. Default is 2.')
+    subparser.add_argument('--poll', action='store_true', help='Scan the directory for changes instead of using file system events.')
+    subparser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between scans when polling. Default is 5.')
+    subparser.add_argument('--state', default=None, help='Path of the file recording processed letters. Default is temp/watch/state.json.')
+    subparser.add_argument('--config', default=None, help='Path to a user-config.json. Default is the project user-config.json.')
+
+    description = "Compare the entities of last year's engagement letters with this year's."
+    subparser = subparsers.add_parser('reconcile', help=description, description=description)
+    subparser.add_argument('prior', help="Directory of the prior year's letters, including subdirectories.")
+    subparser.add_argument('current', help="Directory of the current year's letters, including subdirectories.")
+    subparser.add_argument('-w', '--workers', type=int, default=None, help=f'Number of worker processes shared by both years. Default is {COMMANDS["extract"][3]}.')
+    subparser.add_argument('--address-lines', type=int, default=None, help='Lines at the top of each letter searched for the address. Default is the ADDRESS_SCAN_LINES setting.')
+    subparser.add_argument('--all', action='store_true', help='Also list matched letters whose entities did not change.')
+    subparser.add_argument('--config', default=None, help='Path to a user-config.json. Default is the project user-config.json.')
+
+    description = 'Run worker processes that take tasks from the broker, so letters uploaded to the server are processed on this machine.'
+    subparser = subparsers.add_parser('worker', help=description, description=description)
+    subparser.add_argument('--broker', default=None, help="Broker URL, ie. 'sqlite:///path/to/broker.db' or 'redis://host:6379/0'. Default is the BROKER_URL setting.")
+    subparser.add_argument('-w', '--workers', type=int, default=None, help=f'Number of worker processes. Default is {os.cpu_count() or 1}.')
+    subparser.add_argument('--lease', type=float, default=60.0, help='Seconds without a lease renewal from a running task before it is given to another worker. Default is 60.')
+    subparser.add_argument('--config', default=None, help='Path to a user-config.json. Default is the project user-config.json.')
@@ -1,5 +1,112 @@
 import os
-from docx2pdf import convert
+import signal
+import subprocess
+import sys
+import threading
+# Imported here so a missing docx2pdf is reported when the converter is loaded, conversions run it in a child process
+import docx2pdf  # noqa: F401
+
+from backend import cancellation
+from backend.tracing import span
+
+
+# Word can only run one conversion at a time, so conversions from concurrent jobs are serialized.
+_convert_lock = threading.Lock()
+
+# Seconds a conversion may take before Word is assumed to be stuck and is stopped
+CONVERT_TIMEOUT = 300.0
+
+# Run by the converter process with the input and output paths as arguments. On Windows it starts a Word instance of
+# its own rather than attaching to one the user has open, and prints Word's process id so the server can stop Word
+# too if the conversion is cancelled or stuck. Word runs as a separate COM server that outlives the converter process.
+_CONVERT_SCRIPT = r"""
+import os, sys
+doc_path, output_path = os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2])
+if sys.platform == 'win32':
+    import pythoncom, win32com.client, win32gui, win32process
+    pythoncom.CoInitialize()
+    word = win32com.client.DispatchEx('Word.Application')
+    try:
+        word.Visible = False
+        word.DisplayAlerts = 0
+        word.Caption = f'pel-convert-{os.getpid()}'
+        hwnd = win32gui.FindWindow('OpusApp', word.Caption)
+        if hwnd:
+            print('WORD_PID', win32process.GetWindowThreadProcessId(hwnd)[1], flush=True)
+        doc = word.Documents.Open(doc_path, ReadOnly=True)
+        try:
+            doc.SaveAs(output_path, FileFormat=17)
+        finally:
+            doc.Close(0)
+    finally:
+        word.Quit()
+else:
+    from docx2pdf import convert
+    convert(doc_path, output_path)
+"""
+_WORD_PID = 'WORD_PID '
+
+
+def _terminate(pid: int):
+    """Stop a process by id, ie. a stuck Word. TerminateProcess on Windows."""
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+def _convert(doc_path: str, output_path: str, timeout: float|None=CONVERT_TIMEOUT):
+    """
+    Convert a Word document in a child process, so a conversion that is stuck or belongs to a cancelled job can be
+    killed along with the Word instance it started. Raises Cancelled if the job is cancelled, RuntimeError with the
+    converter's last output line if it fails or if it takes longer than timeout seconds.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-c', _CONVERT_SCRIPT, doc_path, output_path],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+    )
+    word_pids: list[int] = []
+    lines: list[str] = []
+
+    def read_output():
+        for line in process.stdout:
+            text = line.decode('utf-8', errors='replace').strip()
+            if text.startswith(_WORD_PID):
+                word_pids.append(int(text[len(_WORD_PID):]))
+            elif text:
+                lines.append(text)
+    reader = threading.Thread(target=read_output, name='convert-output', daemon=True)
+    reader.start()
+
+    def stop():
+        # Word quits on its own once the converter process has finished
+        running = process.poll() is None
+        process.kill()
+        if running:
+            for pid in word_pids:
+                _terminate(pid)
+
+    with cancellation.on_cancel(stop):
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            stop()
+            process.wait()
+            raise RuntimeError(f'Word did not finish converting within {timeout:g} seconds and was stopped')
+        finally:
+            reader.join(5)
+    cancellation.check()
+    if process.returncode != 0:
+        raise RuntimeError(lines[-1] if lines else f'converter exited with code {process.returncode}')
+
+
+def share_convert_lock(lock):
+    """
+    Use a lock shared with other processes, ie. a multiprocessing lock given to every worker of a pool, so Word
+    still converts one document at a time.
+    """
+    global _convert_lock
+    _convert_lock = lock
 
 
 def convert_word_to_pdf(doc_path: str, output_dir: str):
@@ -12,8 +119,21 @@ def convert_word_to_pdf(doc_path: str, output_dir: str):
     output_path = os.path.join(output_dir, pdf_filename)
 
     try:
-        # Convert the Word document to PDF
-        convert(doc_path, output_path)
+        # Convert the Word document to PDF. Waiting for the lock ends early if the job is cancelled.
+        with span('convert lock', 'queue'):
+            cancellation.acquire(_convert_lock)
+        try:
+            with span('convert'):
+                _convert(doc_path, output_path)
+        finally:
+            _convert_lock.release()
         return pdf_filename, None
+    except cancellation.Cancelled:
+        # Remove what a killed conversion left behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
     except Exception as e:
+        if os.path.exists(output_path):
+            os.remove(output_path)
         return None, f'Unable to print word document: {converted_filename}: {e}'
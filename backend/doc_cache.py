@@ -0,0 +1,264 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from collections import OrderedDict
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Iterable
+import zipfile
+
+from lxml import etree
+
+from backend.fingerprint import fingerprint
+from backend.utils.path_utils import file_hash
+
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_BODY = _W + 'body'
+_P = _W + 'p'
+_R = _W + 'r'
+_HYPERLINK = _W + 'hyperlink'
+_T = _W + 't'
+_BR = _W + 'br'
+_TYPE = _W + 'type'
+# Text equivalent of run content other than w:t and w:br, as in python-docx
+_RUN_TEXT = {_W + 'tab': '\t', _W + 'ptab': '\t', _W + 'cr': '\n', _W + 'noBreakHyphen': '-'}
+# Rough bytes used by each cached paragraph besides its text, for the memory bound
+_PARAGRAPH_OVERHEAD = 64
+
+_parser = etree.XMLParser(resolve_entities=False, remove_blank_text=False, huge_tree=True)
+
+
+def _run_text(run, parts: list[str]):
+    for el in run:
+        if el.tag == _T:
+            parts.append(el.text or '')
+        elif el.tag == _BR:
+            # Page and column breaks have no text
+            if el.get(_TYPE, 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        else:
+            text = _RUN_TEXT.get(el.tag)
+            if text is not None:
+                parts.append(text)
+
+def paragraph_text(p) -> str:
+    """
+    Return the text of a w:p element, the same as python-docx's `Paragraph.text` but read straight from the XML.
+
+    :param p: paragraph element, from lxml or python-docx, ie. `paragraph._p`.
+    """
+    parts = []
+    for child in p:
+        if child.tag == _R:
+            _run_text(child, parts)
+        elif child.tag == _HYPERLINK:
+            for run in child:
+                if run.tag == _R:
+                    _run_text(run, parts)
+    return ''.join(parts)
+
+def body_paragraphs(body) -> list[str]:
+    """Return the text of each paragraph directly in a w:body element, in the order of `Document.paragraphs`."""
+    return [paragraph_text(p) for p in body if p.tag == _P]
+
+def read_document(path: str) -> tuple[list[str], str|None]:
+    """
+    Read the body paragraph texts and template fingerprint (see backend.fingerprint) of a docx without loading it with
+    python-docx.
+    """
+    with zipfile.ZipFile(path) as archive:
+        with archive.open('word/document.xml') as xml:
+            root = etree.parse(xml, _parser).getroot()
+    body = root.find(_BODY)
+    return (body_paragraphs(body), fingerprint(body)) if body is not None else ([], None)
+
+
+class ParsedDocument:
+    """
+    Compact form of a letter: the text of each body paragraph and the fingerprint of its template, None if it is not
+    known. A paragraph's index is its position in `Document.paragraphs`, so rewrites found from the text can be
+    applied to the loaded document by index.
+    """
+    __slots__ = ('sha256', 'paragraphs', 'template', 'size')
+
+    def __init__(self, sha256: str, paragraphs: Iterable[str], template: str|None=None):
+        self.sha256 = sha256
+        self.paragraphs = tuple(paragraphs)
+        self.template = template
+        self.size = sum(sys.getsizeof(p) + _PARAGRAPH_OVERHEAD for p in self.paragraphs)
+
+
+class DocumentCache:
+    """
+    Parsed letters by content hash, shared by every backend function that reads a letter's text. Kept in memory up to
+    max_bytes with the least recently used letters dropped first, and optionally saved to a directory so letters parsed
+    before a restart don't have to be parsed again.
+    """
+
+    def __init__(self, max_bytes: int=64 * 1024 * 1024, directory: str|None=None):
+        """
+        :param max_bytes: [Optional] memory used by cached letters before the least recently used are dropped.
+        :param directory: [Optional] directory parsed letters are also saved to. Default keeps them in memory only.
+        """
+        self._documents: OrderedDict[str, ParsedDocument] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self.configure(max_bytes, directory)
+
+    def configure(self, max_bytes: int, directory: str|None=None):
+        """Change the memory bound and disk directory, ie. from the server settings."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.directory = directory or None
+            self._evict()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _evict(self):
+        """Drop least recently used letters until under max_bytes. Caller holds the lock."""
+        while self._documents and self._bytes > self.max_bytes:
+            _, dropped = self._documents.popitem(last=False)
+            self._bytes -= dropped.size
+            self._stats['evictions'] += 1
+
+    def _disk_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, f'{sha256}.json')
+
+    def get(self, sha256: str) -> ParsedDocument|None:
+        """Return a cached letter by content hash, from memory or the cache directory."""
+        with self._lock:
+            parsed = self._documents.get(sha256)
+            if parsed is not None:
+                self._documents.move_to_end(sha256)
+                self._stats['hits'] += 1
+                return parsed
+            directory = self.directory
+        if directory:
+            try:
+                with open(self._disk_path(sha256), 'r', encoding='utf-8') as file:
+                    saved = json.load(file)
+                # Letters saved before templates were recorded are a plain list of paragraphs
+                parsed = ParsedDocument(sha256, saved) if isinstance(saved, list) else ParsedDocument(sha256, saved['paragraphs'], saved.get('template'))
+                # Keep recently read letters from being pruned
+                os.utime(self._disk_path(sha256))
+            except (OSError, ValueError):
+                parsed = None
+            if parsed is not None:
+                self._remember(parsed)
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+                return parsed
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def _remember(self, parsed: ParsedDocument):
+        with self._lock:
+            if parsed.sha256 in self._documents:
+                self._documents.move_to_end(parsed.sha256)
+                return
+            self._documents[parsed.sha256] = parsed
+            self._bytes += parsed.size
+            self._evict()
+
+    def add(self, sha256: str, paragraphs: Iterable[str], template: str|None=None) -> ParsedDocument:
+        """Cache the paragraph texts and template fingerprint of a letter parsed elsewhere, ie. by python-docx before rewriting it."""
+        parsed = ParsedDocument(sha256, paragraphs, template)
+        self._remember(parsed)
+        if self.directory:
+            path = self._disk_path(sha256)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump({"paragraphs": parsed.paragraphs, "template": template}, file)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+        return parsed
+
+    def lookup(self, path: str) -> tuple[str, ParsedDocument|None]:
+        """Return the content hash of a letter and its cached form, or None if it has not been parsed yet."""
+        sha256 = file_hash(path)
+        return sha256, self.get(sha256)
+
+    def load(self, path: str) -> ParsedDocument:
+        """Return a letter's paragraph texts, parsing the docx only if it is not cached."""
+        sha256, parsed = self.lookup(path)
+        if parsed is None:
+            parsed = self.add(sha256, *read_document(path))
+        return parsed
+
+    def prune(self, max_age: float):
+        """Delete letters in the cache directory that have not been used for max_age seconds."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def snapshot(self) -> list[tuple[str, tuple[str, ...], str|None]]:
+        """Cached letters as (sha256, paragraphs, template), least recently used first, see backend.snapshot."""
+        with self._lock:
+            return [(sha256, parsed.paragraphs, parsed.template) for sha256, parsed in self._documents.items()]
+
+    def restore(self, entries: Iterable[tuple]) -> int:
+        """
+        Add letters from a snapshot, least recently used first. Letters are only kept in memory, as a cache directory
+        already has them.
+
+        :return: number of letters restored.
+        """
+        count = 0
+        for entry in entries:
+            # (sha256, paragraphs, template), or (sha256, paragraphs) from snapshots saved before templates were recorded
+            self._remember(ParsedDocument(*entry))
+            count += 1
+        return count
+
+    def stats(self) -> dict[str, Any]:
+        """Cache statistics, including the number of letters and bytes held in memory."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['documents'] = len(self._documents)
+            stats['bytes'] = self._bytes
+        return stats
+
+
+# Shared by the extractor, the processor and signing
+documents = DocumentCache()
+
+def configure_documents(max_bytes: int, directory: str|None=None, max_age: float|None=None):
+    """
+    Configure the shared document cache.
+
+    :param max_bytes: memory used by cached letters before the least recently used are dropped.
+    :param directory: [Optional] directory parsed letters are also saved to. Default keeps them in memory only.
+    :param max_age: [Optional] delete letters in directory not used for this many seconds.
+    """
+    documents.configure(max_bytes, directory)
+    if max_age is not None:
+        documents.prune(max_age)
+
+def document_cache_stats() -> dict[str, Any]:
+    """Statistics of the shared document cache."""
+    return documents.stats()
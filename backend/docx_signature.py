@@ -0,0 +1,84 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+
+import docx
+from docx.shared import Pt
+
+from backend.doc_cache import documents
+from backend.tracing import span
+
+
+CLOSING = "Very truly yours,"
+# Image formats Word can embed. Signatures only available as PDF are stamped onto the printed PDF instead.
+SIGNATURE_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+# Same line height as the signature stamped onto PDFs, see backend.pdf_signature
+SIGNATURE_HEIGHT = Pt(20)
+
+
+def find_signer(paragraphs: list[str]) -> tuple[int|None, int|None]:
+    """
+    Find the closing paragraph and the first non-empty paragraph after it, which holds the signer's name.
+    Returns the index of each, or None if not found.
+
+    :param paragraphs: paragraph texts of the letter.
+    """
+    for i, text in enumerate(paragraphs):
+        if CLOSING in text:
+            for j in range(i + 1, len(paragraphs)):
+                if paragraphs[j].strip():
+                    return i, j
+            return i, None
+    return None, None
+
+def find_signature_image(signatures_dir: str, name: str) -> str|None:
+    """Return the path of the signer's signature image, ie. 'Mike_Taylor.png', or None if there is none."""
+    base = '_'.join(name.split(' '))
+    for extension in SIGNATURE_IMAGE_EXTENSIONS:
+        path = os.path.join(signatures_dir, base + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def insert_signature(doc_path: str, output_path: str, signatures_dir: str) -> tuple[bool, str|None]:
+    """
+    Insert the signer's signature image above their name in a Word document, so it is signed before it is printed.
+    The image goes in the last empty paragraph between the closing and the name, or a new paragraph if there is none.
+
+    :return: (True, None) if the signed document was saved to output_path, (False, reason) if the letter has no closing
+    or signer, or the signer has no signature image.
+    """
+    # Letters without a signer or signature image are turned away without loading them with python-docx
+    with span('parse'):
+        texts = documents.load(doc_path).paragraphs
+    closing, signer = find_signer(texts)
+    if closing is None or signer is None:
+        return False, f'No signer found after "{CLOSING}"'
+
+    name = texts[signer].strip()
+    image_path = find_signature_image(signatures_dir, name)
+    if image_path is None:
+        return False, f'No signature image for {name}'
+
+    with span('parse'):
+        doc = docx.Document(doc_path)
+    # Cached paragraph indices are positions in doc.paragraphs
+    paragraphs = doc.paragraphs
+    blank = next((paragraphs[i] for i in range(signer - 1, closing, -1) if not texts[i].strip()), None)
+    target = blank if blank is not None else paragraphs[signer].insert_paragraph_before()
+    with span('insert signature'):
+        target.add_run().add_picture(image_path, height=SIGNATURE_HEIGHT)
+    with span('save'):
+        doc.save(output_path)
+    return True, None
@@ -1,21 +1,112 @@
-import docx
-from docx.document import Document
 import os
 import re
 
+from backend.doc_cache import documents
+from backend.tracing import span
 
-def extract_address(paragraphs: list[str]):
-    # Regular expression pattern for address
-    address_pattern = r'\n(.+)\n(.+),\s+([A-Z]{2})\s+(\d{5})\n'
-    address_text = "\n".join(paragraphs)
 
-    match = re.search(address_pattern, address_text)
-    if match:
-        street_address = match.group(1)
-        city_state_zip = match.group(2) + ", " + match.group(3) + " " + match.group(4)
-        return street_address + "\n" + city_state_zip
-    else:
+# Number of lines at the top of a letter searched for the address block
+ADDRESS_SCAN_LINES = 40
+# Lines longer than this are never part of an address block
+MAX_ADDRESS_LINE_LENGTH = 120
+# Most lines above the city, state and zip line that belong to the address block
+MAX_STREET_LINES = 4
+
+# The city is everything up to the last comma, so single-line addresses ("123 Main St, Springfield, IL 62704") match
+CITY_STATE_ZIP_PATTERN = re.compile(r'^(?P<city>.+),\s*(?P<state>[A-Z]{2})\s+(?P<zip>\d{5}(?:-\d{4})?)$')
+CARE_OF_PATTERN = re.compile(r'^(?:c/o|care of)\b', re.IGNORECASE)
+STREET_PATTERN = re.compile(r'^(?:\d|p\.?\s*o\.?\s*box\b|post office box\b|(?:suite|ste|apt|unit|floor|fl|bldg|building|room|rm)\b\.?|#)', re.IGNORECASE)
+
+
+def header_lines(paragraphs: list[str], max_lines: int=ADDRESS_SCAN_LINES):
+    """ Return the first max_lines lines of the letter. Paragraphs can contain line breaks. """
+    lines = []
+    for paragraph in paragraphs:
+        for line in paragraph.split('\n'):
+            lines.append(line.strip())
+            if len(lines) >= max_lines:
+                return lines
+    return lines
+
+def parse_address(paragraphs: list[str], max_lines: int=ADDRESS_SCAN_LINES):
+    """
+    Find the address block in the first max_lines lines of the letter. Each line is matched on its own by
+    anchored patterns, so parsing is linear in the number of header lines.
+
+    Returns a dict with recipient, care_of, street (list of lines), city, state and zip, or None if no
+    address was found.
+    """
+    lines = header_lines(paragraphs, max_lines)
+    for index, line in enumerate(lines):
+        if len(line) > MAX_ADDRESS_LINE_LENGTH:
+            continue
+        match = CITY_STATE_ZIP_PATTERN.match(line)
+        if not match:
+            continue
+
+        city, inline_street, recipient = split_city(match.group('city'))
+
+        # Walk up from the city line collecting street, suite and c/o lines until the recipient line
+        street, care_of = [], None
+        above_lines = [] if recipient else lines[max(0, index - MAX_STREET_LINES - 1):index]
+        for above in reversed(above_lines):
+            if not above or len(above) > MAX_ADDRESS_LINE_LENGTH:
+                break
+            if CARE_OF_PATTERN.match(above):
+                care_of = above
+            elif STREET_PATTERN.match(above) and care_of is None:
+                street.insert(0, above)
+            else:
+                recipient = above
+                break
+        street += inline_street
+
+        # Street lines without a number, ie. building names, fall back to the line above the city line
+        if not street:
+            if index == 0 or not lines[index - 1]:
+                continue
+            street = [lines[index - 1]]
+            recipient = None
+            if care_of == street[0]:
+                care_of = None
+
+        return {
+            "recipient": recipient,
+            "care_of": care_of,
+            "street": street,
+            "city": city,
+            "state": match.group('state'),
+            "zip": match.group('zip')
+        }
+    return None
+
+def split_city(text: str):
+    """
+    Split what comes before the state of a city, state and zip line into the city and any street and recipient
+    written on the same line, ie. "Acme LLC, 123 Main St, Suite 4, Springfield".
+
+    Returns (city, street lines, recipient or None).
+    """
+    parts = [part.strip() for part in text.split(',')]
+    city, before = parts[-1], [part for part in parts[:-1] if part]
+    if not before:
+        return city, [], None
+    # Parts from the first that looks like a street line are the street, anything before them is the recipient
+    first_street = next((i for i, part in enumerate(before) if STREET_PATTERN.match(part)), 0)
+    recipient = ', '.join(before[:first_street]) or None
+    return city, before[first_street:], recipient
+
+def format_address(address: dict):
+    """ Format a parsed address as c/o and street lines followed by 'City, ST ZIP'. """
+    lines = ([address['care_of']] if address.get('care_of') else []) + address['street']
+    lines.append(f"{address['city']}, {address['state']} {address['zip']}")
+    return '\n'.join(lines)
+
+def extract_address(paragraphs: list[str], max_lines: int=ADDRESS_SCAN_LINES):
+    address = parse_address(paragraphs, max_lines)
+    if address is None:
         return "Address not found"
+    return format_address(address)
 
 def extract_entities(paragraphs: list[str]):
     # Find the start of the table-like section
@@ -38,16 +129,22 @@ def extract_entities(paragraphs: list[str]):
 
     return entities
 
-def process_document(file_path: str):
-    doc: Document = docx.Document(file_path)
-    paragraphs = [p.text for p in doc.paragraphs]
+def process_document(file_path: str, address_lines: int=ADDRESS_SCAN_LINES):
+    """
+    Extract address and entity information from a letter.
+
+    :param address_lines: [Optional] number of lines at the top of the letter searched for the address.
+    """
+    with span('parse'):
+        paragraphs = documents.load(file_path).paragraphs
 
-    # TODO: parallel process the extracting functions o improve performance
-    address = extract_address(paragraphs)
-    entities = extract_entities(paragraphs)
+    with span('extract'):
+        address = parse_address(paragraphs, address_lines)
+        entities = extract_entities(paragraphs)
 
     return {
         "filename": os.path.basename(file_path),
-        "address": address,
+        "address": format_address(address) if address is not None else "Address not found",
+        "address_fields": address,
         "entities": entities
     }
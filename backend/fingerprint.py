@@ -0,0 +1,163 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from collections import OrderedDict
+import hashlib
+import threading
+from typing import Any, Hashable, Sequence
+
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_P = _W + 'p'
+_PPR = _W + 'pPr'
+_PSTYLE = _W + 'pStyle'
+_VAL = _W + 'val'
+
+
+def style_sequence(elements) -> list[str]:
+    """Return the paragraph style id of each w:p element, '' for the default style."""
+    styles = []
+    for p in elements:
+        ppr = p.find(_PPR)
+        pstyle = ppr.find(_PSTYLE) if ppr is not None else None
+        styles.append(pstyle.get(_VAL, '') if pstyle is not None else '')
+    return styles
+
+def fingerprint(body) -> str:
+    """
+    Fingerprint a letter's structure from the style sequence of the paragraphs of its w:body element. Letters made
+    from the same template have the same fingerprint no matter whose letter it is.
+    """
+    styles = style_sequence(p for p in body if p.tag == _P)
+    digest = hashlib.blake2b('\x1f'.join(styles).encode('utf-8'), digest_size=16)
+    return f'{len(styles)}-{digest.hexdigest()}'
+
+
+class Template:
+    """
+    What is known about the letters of one template: the paragraphs the rules matched in every letter (hot), the
+    paragraphs that differ between letters or only sometimes match (variable), and the text of every paragraph of the
+    first letter seen, used to check the remaining boilerplate paragraphs are unchanged.
+
+    Templates are not changed once made, other threads may be reading them. A letter that teaches the cache something
+    new replaces its template with a new one, see `TemplateCache.learn`.
+    """
+    __slots__ = ('texts', 'hot', 'variable', 'boilerplate', 'samples', 'confirmed', 'hits')
+
+    def __init__(self, texts: Sequence[str], hot: set[int], variable: set[int]=frozenset(), samples: int=1, confirmed: bool=False, hits: int=0):
+        self.texts = tuple(texts)
+        self.hot = frozenset(hot)
+        self.variable = frozenset(variable)
+        self.boilerplate = tuple(i for i in range(len(self.texts)) if i not in self.hot and i not in self.variable) if confirmed else ()
+        self.samples = samples
+        self.confirmed = confirmed
+        # Counted under the cache's lock, see `TemplateCache.lookup`
+        self.hits = hits
+
+    def boilerplate_changed(self, paragraphs: Sequence[str]) -> bool:
+        """True if any boilerplate paragraph's text differs from the template."""
+        texts = self.texts
+        return any(paragraphs[i] != texts[i] for i in self.boilerplate)
+
+
+class TemplateCache:
+    """
+    Learns the paragraphs rollover rules match in each letter template, so letters of known templates only have those
+    paragraphs run through the rules instead of every paragraph being scanned.
+
+    A template is trusted after `learn_after` letters with its fingerprint were fully scanned. Letters of trusted
+    templates are checked before use: boilerplate paragraphs must be unchanged and every hot paragraph must still
+    match. Otherwise, and every `audit_every` letters, the letter is fully scanned and the template updated.
+    """
+
+    def __init__(self, max_templates: int=256, learn_after: int=2, audit_every: int=25):
+        """
+        :param max_templates: [Optional] number of templates kept, least recently used are dropped.
+        :param learn_after: [Optional] full scans needed before a template is used.
+        :param audit_every: [Optional] fully scan every nth letter of a trusted template to check it is still right.
+        """
+        self.max_templates = max_templates
+        self.learn_after = max(1, learn_after)
+        self.audit_every = audit_every
+        self._templates: OrderedDict[Hashable, Template] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"letters": 0, "hits": 0, "misses": 0, "fallbacks": 0, "audits": 0}
+
+    def lookup(self, key: Hashable) -> Template|None:
+        """Return the trusted template for a fingerprint, or None if the letter must be fully scanned."""
+        with self._lock:
+            self._stats['letters'] += 1
+            template = self._templates.get(key)
+            if template is None or not template.confirmed:
+                self._stats['misses'] += 1
+                return None
+            self._templates.move_to_end(key)
+            template.hits += 1
+            if self.audit_every and template.hits % self.audit_every == 0:
+                self._stats['audits'] += 1
+                return None
+            return template
+
+    def hit(self):
+        """Count a letter rewritten from its template."""
+        with self._lock:
+            self._stats['hits'] += 1
+
+    def fallback(self):
+        """Count a letter whose template check failed and that was fully scanned instead."""
+        with self._lock:
+            self._stats['fallbacks'] += 1
+
+    def learn(self, key: Hashable, texts: Sequence[str], hot: set[int]):
+        """
+        Record a fully scanned letter.
+
+        :param texts: text of every paragraph before it was rewritten.
+        :param hot: indices of the paragraphs the rules matched.
+        """
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None or len(template.texts) != len(texts):
+                self._templates[key] = Template(texts, hot, confirmed=self.learn_after == 1)
+                self._templates.move_to_end(key)
+                while len(self._templates) > self.max_templates:
+                    self._templates.popitem(last=False)
+                return
+
+            changed = {i for i, (a, b) in enumerate(zip(template.texts, texts)) if a != b}
+            # Paragraphs matched in every letter must match again, paragraphs that differ between letters or only
+            # sometimes match are scanned every time
+            new_hot = template.hot & hot
+            variable = (template.variable | changed | (template.hot ^ hot)) - new_hot
+            samples = template.samples + 1
+            self._templates[key] = Template(template.texts, new_hot, variable, samples, template.confirmed or samples >= self.learn_after, template.hits)
+
+    def stats(self) -> dict[str, Any]:
+        """Template cache statistics including the hit rate, the fraction of letters rewritten from a template."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['templates'] = len(self._templates)
+        stats['hit_rate'] = hit_rate(stats)
+        return stats
+
+
+def hit_rate(stats: dict[str, Any]) -> float:
+    return round(stats['hits'] / stats['letters'], 4) if stats['letters'] else 0.0
+
+
+# Shared by every rollover in the process
+templates = TemplateCache()
+
+def template_stats() -> dict[str, Any]:
+    """Statistics of the shared template cache."""
+    return templates.stats()
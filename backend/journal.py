@@ -0,0 +1,333 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Iterator
+import uuid
+
+from backend.tasks import get_task
+from backend.utils.path_utils import file_hash
+
+
+JOBS_DIR = 'temp/jobs'
+
+
+def settings_fingerprint(task: str, output_dir: str|None, options: dict[str, Any]) -> str:
+    """Return a digest of the settings a task runs with. Results are only reused for inputs run with the same settings."""
+    return hashlib.sha256(json.dumps([task, output_dir, options], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Journal:
+    """
+    Durable record of a batch job. Every input is kept in the job's inputs directory and every queued and finished
+    file is appended to journal.jsonl and synced to disk, so a job interrupted by a crash or restart can be resumed
+    without the files being uploaded or processed again.
+
+    The job's task is stored as a task name from backend.tasks with its output directory and options, so the options
+    must be JSON serializable.
+    """
+    META_FILE = 'meta.json'
+    JOURNAL_FILE = 'journal.jsonl'
+    INPUTS_DIR = 'inputs'
+
+    def __init__(self, directory: str, meta: dict[str, Any]):
+        self.directory = directory
+        self.meta = meta
+        # Entries by file number: input, sha256 and, once finished, status, output, result and error
+        self.entries: dict[int, dict[str, Any]] = {}
+        self.sealed = False
+        self.finished = False
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def job_id(self) -> str:
+        return self.meta['job_id']
+
+    @property
+    def inputs_dir(self) -> str:
+        return os.path.join(self.directory, self.INPUTS_DIR)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, self.JOURNAL_FILE)
+
+    @property
+    def task(self) -> str:
+        """Name of the job's task in backend.tasks."""
+        return self.meta['task']
+
+    @property
+    def fn(self):
+        """The job's task function."""
+        return get_task(self.task)
+
+    @property
+    def output_dir(self) -> str|None:
+        return self.meta['output_dir']
+
+    @property
+    def options(self) -> dict[str, Any]:
+        return self.meta['options']
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the job's task, output directory and options, see `settings_fingerprint`."""
+        return settings_fingerprint(self.task, self.output_dir, self.options)
+
+    @classmethod
+    def create(cls, root: str, owner: str, process: str, task: str, output_dir: str|None, options: dict[str, Any]|None=None, job_id: str|None=None) -> 'Journal':
+        """
+        Create the journal of a new job.
+
+        :param root: directory holding every job's journal.
+        :param task: name of the job's task in backend.tasks, called as `task(input_path, output_dir, **options)`.
+        :param output_dir: directory the task writes output files to.
+        :param options: [Optional] task options.
+        :param job_id: [Optional] id of the job. Default is a new id.
+        """
+        get_task(task)
+        meta = {
+            "job_id": job_id or uuid.uuid4().hex,
+            "owner": owner,
+            "process": process,
+            "created_at": time.time(),
+            "task": task,
+            "output_dir": output_dir,
+            "options": options or {}
+        }
+        journal = cls(os.path.join(root, meta['job_id']), meta)
+        os.makedirs(journal.inputs_dir, exist_ok=True)
+        temp_path = os.path.join(journal.directory, cls.META_FILE + '.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, os.path.join(journal.directory, cls.META_FILE))
+        return journal
+
+    @classmethod
+    def load(cls, directory: str) -> 'Journal':
+        """Load a job's journal and replay its entries."""
+        with open(os.path.join(directory, cls.META_FILE), 'r') as file:
+            journal = cls(directory, json.load(file))
+        journal._replay()
+        return journal
+
+    @classmethod
+    def unfinished(cls, root: str) -> Iterator['Journal']:
+        """Yield the journals of jobs that did not finish, oldest first."""
+        if not os.path.isdir(root):
+            return
+        journals = []
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            if not os.path.isfile(os.path.join(directory, cls.META_FILE)):
+                continue
+            try:
+                journal = cls.load(directory)
+            except (OSError, ValueError):
+                continue
+            if not journal.finished:
+                journals.append(journal)
+        yield from sorted(journals, key=lambda journal: journal.meta['created_at'])
+
+    @classmethod
+    def prune(cls, root: str, max_age: float):
+        """
+        Delete the journals of finished jobs older than max_age seconds.
+
+        :param root: directory holding every job's journal.
+        :param max_age: seconds to keep finished journals for.
+        """
+        if not os.path.isdir(root):
+            return
+        cutoff = time.time() - max_age
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            path = os.path.join(directory, cls.JOURNAL_FILE)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                with open(path, 'rb') as file:
+                    # The finished event is always the last line
+                    file.seek(max(0, os.path.getsize(path) - 64))
+                    finished = b'"finished"' in file.read()
+            except OSError:
+                continue
+            if finished:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line was cut short by a crash
+                    continue
+                event = record.pop('event')
+                if event == 'queued':
+                    self.entries[record['n']] = record
+                elif event == 'done':
+                    self.entries.setdefault(record['n'], {}).update(record)
+                elif event == 'sealed':
+                    self.sealed = True
+                elif event == 'finished':
+                    self.finished = True
+
+    def _append(self, record: dict[str, Any]):
+        """Append one record and sync it to disk. Caller holds the lock."""
+        if self._file is None:
+            self._file = open(self.path, 'a+b')
+            # Start on a new line if the last write was cut short by a crash
+            if self._file.tell() > 0:
+                self._file.seek(-1, os.SEEK_END)
+                if self._file.read(1) != b'\n':
+                    self._file.write(b'\n')
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def queued(self, input_path: str, sha256: str|None=None) -> int:
+        """
+        Record an input saved to the inputs directory that is about to be queued.
+
+        :param sha256: [Optional] hash of an input that was not uploaded because an earlier result is reused. Default
+        hashes the saved input.
+        :return: the input's file number.
+        """
+        # Relative to the inputs directory, inputs are saved in subdirectories so files of the same name are kept apart
+        entry = {"input": os.path.relpath(input_path, self.inputs_dir), "sha256": sha256 or file_hash(input_path)}
+        with self._lock:
+            n = len(self.entries)
+            entry['n'] = n
+            self.entries[n] = entry
+            self._append({"event": "queued", **entry})
+        return n
+
+    def output_for(self, result: Any) -> str|None:
+        """Return the path of the output file of a task result, if any."""
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], str):
+            return result[0]
+        return None
+
+    def done(self, n: int, result: Any, error: str|None=None):
+        """
+        Record a finished file.
+
+        :param n: file number returned by `queued`.
+        :param result: the task's (result, error) return value, see backend.tasks.
+        :param error: [Optional] exception raised by the task.
+        """
+        record = {"n": n, "output": self.output_for(result), "result": None, "error": error}
+        if isinstance(result, tuple) and len(result) == 2:
+            value, record['error'] = result[0], result[1] if result[1] is not None else error
+            if isinstance(value, dict):
+                record['result'] = value
+        record['status'] = 'success' if record['error'] is None else 'failed'
+        with self._lock:
+            self.entries.setdefault(n, {}).update(record)
+            self._append({"event": "done", **record})
+
+    def seal(self):
+        """Record that no more inputs will be added."""
+        with self._lock:
+            if not self.sealed:
+                self.sealed = True
+                self._append({"event": "sealed"})
+
+    def finish(self):
+        """Record that the job finished and delete its inputs. The journal itself is kept for reporting."""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self._append({"event": "finished"})
+            self._file.close()
+            self._file = None
+        shutil.rmtree(self.inputs_dir, ignore_errors=True)
+
+    def completed(self) -> list[dict[str, Any]]:
+        """Entries of finished files, in file number order."""
+        return [entry for n, entry in sorted(self.entries.items()) if 'status' in entry]
+
+    def remaining(self) -> list[tuple[int, str]]:
+        """(file number, input path) of queued files that did not finish and whose input is still on disk."""
+        remaining = []
+        for n, entry in sorted(self.entries.items()):
+            if 'status' in entry or 'input' not in entry:
+                continue
+            path = os.path.join(self.inputs_dir, entry['input'])
+            if os.path.isfile(path):
+                remaining.append((n, path))
+        return remaining
+
+
+class ResultIndex:
+    """
+    Successful results of earlier jobs by settings fingerprint and input hash, so inputs the server already has a result
+    for don't have to be uploaded and processed again. Built from the journals kept in temp/jobs and updated as files
+    finish. Results whose output file was since deleted are forgotten.
+    """
+
+    def __init__(self):
+        self._results: dict[tuple[str, str], dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, root: str):
+        """Add the results recorded in every job journal under root."""
+        if not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            if not os.path.isfile(os.path.join(directory, Journal.META_FILE)):
+                continue
+            try:
+                journal = Journal.load(directory)
+            except (OSError, ValueError):
+                continue
+            for entry in journal.completed():
+                self.add(journal.fingerprint, entry)
+
+    def add(self, fingerprint: str, entry: dict[str, Any]):
+        """
+        Record a finished file.
+
+        :param fingerprint: settings fingerprint of the file's job.
+        :param entry: the file's journal entry. Failed files are ignored.
+        """
+        if entry.get('status') != 'success' or not entry.get('sha256'):
+            return
+        with self._lock:
+            self._results[(fingerprint, entry['sha256'])] = {"output": entry.get('output'), "result": entry.get('result')}
+
+    def lookup(self, fingerprint: str, sha256: str) -> dict[str, Any]|None:
+        """Return the earlier result of an input as {'output': path, 'result': info}, or None if there is none."""
+        with self._lock:
+            result = self._results.get((fingerprint, sha256))
+            if result is not None and result['output'] is not None and not os.path.isfile(result['output']):
+                del self._results[(fingerprint, sha256)]
+                result = None
+        return result
+
+    def known(self, fingerprint: str, hashes: list[str]) -> list[str]:
+        """Return the hashes in hashes that have an earlier result."""
+        return [sha256 for sha256 in hashes if self.lookup(fingerprint, sha256) is not None]
@@ -0,0 +1,256 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from collections import deque
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Iterator
+import zlib
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, EncodedStreamObject, IndirectObject, NameObject, NullObject, PdfObject, StreamObject
+
+from backend.tracing import span
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+
+# Objects that are never merged with an identical copy, as each one is a node of a tree that has to stay distinct
+# (pages, annotations, outline items and form fields)
+UNIQUE_TYPES = {'/Catalog', '/Pages', '/Page', '/Annot', '/Outlines', '/Sig'}
+UNIQUE_KEYS = {'/Parent', '/Kids'}
+# Streams shorter than this are written as is, compressing them saves less than the filter entry costs
+MIN_COMPRESS_SIZE = 64
+# Large streams are only compressed if a sample of their start compresses to less than this fraction of its size,
+# so incompressible data isn't compressed in full for nothing
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+
+
+def optimize_pdf(path: str, compress_streams: bool=True, deduplicate: bool=True, linearize: bool=False) -> tuple[dict[str, Any]|None, str|None]:
+    """
+    Rewrite a PDF in place with its uncompressed streams compressed and identical objects, ie. fonts and images
+    embedded more than once, stored once. The original is kept if the rewritten PDF isn't smaller.
+
+    :param path: path of the PDF.
+    :param compress_streams: [Optional] flate compress streams written without a filter. Default is True.
+    :param deduplicate: [Optional] store identical objects once. Default is True.
+    :param linearize: [Optional] linearize the PDF for fast web view. Needs the optional `pikepdf` package and is
+    skipped without it. Default is False.
+    :return: report with the size before and after, bytes saved, seconds taken, streams compressed, objects merged
+    and whether the PDF was linearized.
+    """
+    with span('optimize pdf'):
+        return _optimize(path, compress_streams, deduplicate, linearize)
+
+def _optimize(path: str, compress_streams: bool, deduplicate: bool, linearize: bool) -> tuple[dict[str, Any]|None, str|None]:
+    started = time.perf_counter()
+    filename = os.path.basename(path)
+    bytes_before = os.path.getsize(path)
+    fd, temp_path = tempfile.mkstemp(suffix='.pdf', dir=os.path.dirname(path) or None)
+    os.close(fd)
+    try:
+        with open(path, 'rb') as file:
+            reader = PdfReader(file)
+            if reader.is_encrypted:
+                return None, f'{filename} is encrypted and was not optimized'
+            objects = _collect(reader)
+            compressed = _compress(objects) if compress_streams else 0
+            merged = _deduplicate(objects) if deduplicate else {}
+            _write(reader, objects, merged, temp_path)
+        linearized = False
+        if linearize and pikepdf is not None:
+            with pikepdf.open(temp_path, allow_overwriting_input=True) as pdf:
+                pdf.save(temp_path, linearize=True)
+            linearized = True
+        bytes_after = os.path.getsize(temp_path)
+        if linearized or bytes_after < bytes_before:
+            # Temporary files are only readable by their owner
+            shutil.copymode(path, temp_path)
+            os.replace(temp_path, path)
+        else:
+            bytes_after = bytes_before
+        return {
+            "file": filename,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "bytes_saved": bytes_before - bytes_after,
+            "seconds": round(time.perf_counter() - started, 4),
+            "streams_compressed": compressed,
+            "objects_merged": len(merged),
+            "linearized": linearized
+        }, None
+    except Exception as e:
+        return None, f'An error occurred optimizing {filename}: {e}'
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _children(obj: PdfObject) -> Iterator[IndirectObject]:
+    """References held by an object and the direct objects inside it. A stream's /Length is rewritten, so skipped."""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, IndirectObject):
+            yield item
+        elif isinstance(item, DictionaryObject):
+            stream = isinstance(item, StreamObject)
+            stack.extend(value for key, value in item.items() if not (stream and key == '/Length'))
+        elif isinstance(item, ArrayObject):
+            stack.extend(item)
+
+def _collect(reader: PdfReader) -> dict[tuple[int, int], PdfObject]:
+    """Every object reachable from the trailer, by (object number, generation), in breadth first order."""
+    objects = {}
+    pending = deque(reader.trailer.get(key) for key in ('/Root', '/Info') if isinstance(reader.trailer.get(key), IndirectObject))
+    while pending:
+        ref = pending.popleft()
+        key = (ref.idnum, ref.generation)
+        if key in objects:
+            continue
+        obj = ref.get_object()
+        objects[key] = NullObject() if obj is None else obj
+        pending.extend(_children(objects[key]))
+    return objects
+
+def _compress(objects: dict[tuple[int, int], PdfObject]) -> int:
+    """Flate compress streams without a filter. Returns the number of streams compressed."""
+    count = 0
+    for key, obj in objects.items():
+        if not isinstance(obj, StreamObject) or '/Filter' in obj or '/DecodeParms' in obj or len(obj._data) < MIN_COMPRESS_SIZE:
+            continue
+        if len(obj._data) > SAMPLE_SIZE and len(zlib.compress(obj._data[:SAMPLE_SIZE], 1)) > SAMPLE_SIZE * SAMPLE_RATIO:
+            continue
+        data = zlib.compress(obj._data)
+        if len(data) >= len(obj._data):
+            continue
+        stream = EncodedStreamObject()
+        stream.update(obj)
+        stream[NameObject('/Filter')] = NameObject('/FlateDecode')
+        stream._data = data
+        objects[key] = stream
+        count += 1
+    return count
+
+def _mergeable(obj: PdfObject) -> bool:
+    if isinstance(obj, DictionaryObject):
+        return obj.get('/Type') not in UNIQUE_TYPES and not UNIQUE_KEYS.intersection(obj.keys())
+    return True
+
+def _deduplicate(objects: dict[tuple[int, int], PdfObject]) -> dict[tuple[int, int], tuple[int, int]]:
+    """
+    Find objects identical to an earlier object. Objects are compared with their references resolved to merged
+    objects, so passes are repeated until nothing new merges, ie. fonts merge once their font files have.
+
+    :return: {duplicate: object kept in its place}.
+    """
+    merged: dict[tuple[int, int], tuple[int, int]] = {}
+    # Stream data is hashed once rather than on every pass
+    digests = {key: hashlib.sha256(obj._data).digest() for key, obj in objects.items() if isinstance(obj, StreamObject)}
+    candidates = [key for key, obj in objects.items() if _mergeable(obj)]
+
+    def reference(ref: IndirectObject) -> bytes:
+        kept = _resolve(merged, (ref.idnum, ref.generation))
+        return b'%d %d R' % kept
+
+    while True:
+        seen: dict[bytes, tuple[int, int]] = {}
+        found = False
+        for key in candidates:
+            if key in merged:
+                continue
+            buffer = io.BytesIO()
+            _serialize(objects[key], buffer, reference)
+            signature = buffer.getvalue() + digests.get(key, b'')
+            kept = seen.setdefault(signature, key)
+            if kept != key:
+                merged[key] = kept
+                found = True
+        if not found:
+            return merged
+
+def _resolve(merged: dict[tuple[int, int], tuple[int, int]], key: tuple[int, int]) -> tuple[int, int]:
+    while key in merged:
+        key = merged[key]
+    return key
+
+def _serialize(obj: PdfObject, out: io.BytesIO, reference: Callable[[IndirectObject], bytes]):
+    """Write an object in PDF syntax with references written by `reference`. Streams are written without their data."""
+    if isinstance(obj, IndirectObject):
+        out.write(reference(obj))
+    elif isinstance(obj, DictionaryObject):
+        out.write(b'<<')
+        for key in sorted(obj.keys()):
+            if key == '/Length' and isinstance(obj, StreamObject):
+                continue
+            NameObject(key).write_to_stream(out, None)
+            out.write(b' ')
+            _serialize(obj.raw_get(key), out, reference)
+            out.write(b'\n')
+        if isinstance(obj, StreamObject):
+            out.write(b'/Length %d\n' % len(obj._data))
+        out.write(b'>>')
+    elif isinstance(obj, ArrayObject):
+        out.write(b'[')
+        for n, item in enumerate(obj):
+            if n:
+                out.write(b' ')
+            _serialize(item, out, reference)
+        out.write(b']')
+    else:
+        obj.write_to_stream(out, None)
+
+def _write(reader: PdfReader, objects: dict[tuple[int, int], PdfObject], merged: dict[tuple[int, int], tuple[int, int]], output_path: str):
+    """Write the objects that were not merged, numbered from 1, with a cross-reference table and trailer."""
+    numbers = {key: n for n, key in enumerate((key for key in objects if key not in merged), 1)}
+
+    def reference(ref: IndirectObject) -> bytes:
+        number = numbers.get(_resolve(merged, (ref.idnum, ref.generation)))
+        # References to objects that could not be read are written as null, as readers treat them
+        return b'%d 0 R' % number if number is not None else b'null'
+
+    offsets = []
+    with open(output_path, 'wb') as out:
+        out.write(reader.pdf_header.encode() + b'\n%\xe2\xe3\xcf\xd3\n')
+        for key, number in numbers.items():
+            obj = objects[key]
+            offsets.append(out.tell())
+            buffer = io.BytesIO()
+            buffer.write(b'%d 0 obj\n' % number)
+            _serialize(obj, buffer, reference)
+            if isinstance(obj, StreamObject):
+                buffer.write(b'\nstream\n')
+                buffer.write(obj._data)
+                buffer.write(b'\nendstream')
+            buffer.write(b'\nendobj\n')
+            out.write(buffer.getvalue())
+
+        xref = out.tell()
+        out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+        out.write(b''.join(b'%010d 00000 n \n' % offset for offset in offsets))
+        buffer = io.BytesIO()
+        buffer.write(b'trailer\n<</Size %d' % (len(offsets) + 1))
+        for key in ('/Root', '/Info', '/ID'):
+            if key in reader.trailer:
+                buffer.write(b' %s ' % key.encode())
+                # /ID is written directly, in case it is stored as a reference
+                _serialize(reader.trailer[key] if key == '/ID' else reader.trailer.raw_get(key), buffer, reference)
+        buffer.write(b'>>\nstartxref\n%d\n%%%%EOF\n' % xref)
+        out.write(buffer.getvalue())
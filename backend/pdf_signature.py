@@ -1,8 +1,18 @@
 import os
+import shutil
 
 from PyPDF2 import PdfReader, PdfWriter, Transformation
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, IndirectObject, NameObject, RectangleObject
 import pdfplumber
 
+from backend.tracing import span
+from backend.utils.pdf_update import IncrementalUpdate, UpdateError
+
+
+# Height of the signature in points, and its distance from the left edge of the page
+SIGNATURE_HEIGHT = 20
+SIGNATURE_LEFT = 1.25 * 72
+
 
 def find_signature_position(pdf_path):
     """
@@ -56,19 +66,22 @@ def add_signature(pdf_path, output_path, signature_path, position):
                 signature_page = signature_reader.pages[0]
 
                 # Calculate the scale based on the signature size and desired line height (20pt)
-                desired_height_in_inches = 20 / 72
+                desired_height_in_inches = SIGNATURE_HEIGHT / 72
                 # convert points to inches
                 signature_height = signature_page.mediabox.height / 72
                 scale = desired_height_in_inches / signature_height
 
                 # Calculate translation values
                 # 1.25 inches from the left, converted to points
-                tx = 1.25 * 72
+                tx = SIGNATURE_LEFT
                 # y position adjusted for the scaled signature height
                 ty = position[1] - (desired_height_in_inches * 72)
 
-                # Scale and position the signature
+                # Scale and position the signature. merge_page clips the signature to its trim box, which is moved
+                # with it so the clip lands on the signature.
+                trim = signature_page.trimbox
                 signature_page.add_transformation(Transformation().scale(scale).translate(tx, ty))
+                signature_page.trimbox = RectangleObject([float(value) * scale + offset for value, offset in zip((trim.left, trim.bottom, trim.right, trim.top), (tx, ty, tx, ty))])
                 page.merge_page(signature_page)
 
             pdf_writer.add_page(page)
@@ -82,3 +95,105 @@ def add_signature(pdf_path, output_path, signature_path, position):
     finally:
         # Close writer
         pdf_writer.close()
+
+def _stream_list(contents) -> list:
+    """References of a page's content streams, from its raw /Contents entry."""
+    if contents is None:
+        return []
+    resolved = contents.get_object()
+    if isinstance(resolved, ArrayObject):
+        return list(resolved)
+    return [contents]
+
+def add_signature_incremental(pdf_path, output_path, signature_path, position):
+    """
+    Add the signature to the PDF at the specified position as an incremental update. The original bytes are copied
+    as is and only the signed page, its new content streams and the signature are appended, so time and memory depend
+    on the size of the signature, not of the document. Raises UpdateError for PDFs that have to be rewritten instead.
+    """
+    with open(pdf_path, 'rb') as pdf_file, open(signature_path, 'rb') as signature_file:
+        # Readers on open files only read the objects they need
+        pdf_reader = PdfReader(pdf_file)
+        signature_reader = PdfReader(signature_file)
+        update = IncrementalUpdate(pdf_reader, pdf_path)
+        if len(signature_reader.pages) == 0:
+            shutil.copyfile(pdf_path, output_path)
+            return os.path.basename(output_path), None
+
+        page = pdf_reader.pages[position[0]]
+        page_ref = page.indirect_ref
+        if not isinstance(page_ref, IndirectObject):
+            raise UpdateError('Page has no object number')
+
+        # Signature page as a form XObject, with the objects it uses copied from the signature PDF
+        signature_page = signature_reader.pages[0]
+        box = signature_page.mediabox
+        content = b'\n'.join(stream.get_object().get_data() for stream in _stream_list(signature_page.raw_get('/Contents') if '/Contents' in signature_page else None))
+        form = DecodedStreamObject()
+        form._data = content
+        form = form.flate_encode()
+        form[NameObject('/Type')] = NameObject('/XObject')
+        form[NameObject('/Subtype')] = NameObject('/Form')
+        # Clipped to the trim box like a merged page, and scaled by the media box height like add_signature
+        trim = signature_page.trimbox
+        form[NameObject('/BBox')] = ArrayObject(FloatObject(value) for value in (trim.left, trim.bottom, trim.right, trim.top))
+        form[NameObject('/Resources')] = update.import_object(signature_page.raw_get('/Resources')) if '/Resources' in signature_page else DictionaryObject()
+        form_ref = update.add(form)
+
+        # Page resources are copied so resources shared with other pages are left alone
+        resources = DictionaryObject(page['/Resources']) if '/Resources' in page else DictionaryObject()
+        xobjects = DictionaryObject(resources['/XObject']) if '/XObject' in resources else DictionaryObject()
+        name, n = '/PELSignature', 0
+        while name in xobjects:
+            n += 1
+            name = f'/PELSignature{n}'
+        xobjects[NameObject(name)] = form_ref
+        resources[NameObject('/XObject')] = xobjects
+
+        # Same placement as add_signature: scaled to SIGNATURE_HEIGHT with its bottom SIGNATURE_HEIGHT below position
+        scale = SIGNATURE_HEIGHT / float(box.height)
+        tx, ty = SIGNATURE_LEFT, position[1] - SIGNATURE_HEIGHT
+        before = DecodedStreamObject()
+        before._data = b'q\n'
+        after = DecodedStreamObject()
+        after._data = b'Q\nq %.6f 0 0 %.6f %.4f %.4f cm %s Do Q\n' % (scale, scale, tx, ty, name.encode())
+        contents = [update.add(before)] + _stream_list(page.raw_get('/Contents') if '/Contents' in page else None) + [update.add(after)]
+
+        signed_page = DictionaryObject(page)
+        signed_page[NameObject('/Resources')] = resources
+        signed_page[NameObject('/Contents')] = ArrayObject(contents)
+        update.replace(page_ref, signed_page)
+        update.write(output_path)
+    return os.path.basename(output_path), None
+
+def sign_pdf(pdf_path, output_dir, signatures_dir, incremental=True):
+    """
+    Locate the signer and signature position in the PDF and stamp the signer's signature onto it.
+    The output keeps the original filename with underscores converted back to spaces.
+    Returns the output filename and an error message, if any.
+
+    :param incremental: [Optional] append the signature as an incremental update instead of rewriting the whole
+    PDF. PDFs that can't be updated, ie. encrypted ones, are rewritten. Default is True.
+    """
+    output_filename = ' '.join(os.path.basename(pdf_path).split('_'))
+    output_path = os.path.join(output_dir, output_filename)
+
+    with span('locate signature'):
+        signature_name = extract_name(pdf_path)
+        page_number, y_position = find_signature_position(pdf_path)
+    if signature_name is None or page_number is None:
+        return None, f"An error occurred getting signature name or finding signature position in {output_filename}. signature_name: {signature_name}, page_number: {page_number}"
+
+    # Get path for signature file
+    signature_file = f"{'_'.join(signature_name.split(' '))}.pdf"
+    signature_path = os.path.join(signatures_dir, signature_file)
+
+    with span('stamp signature'):
+        if incremental:
+            try:
+                return add_signature_incremental(pdf_path, output_path, signature_path, (page_number, y_position))
+            except UpdateError:
+                pass
+            except Exception as e:
+                return None, f'An error has occurred adding signature stamp to {os.path.basename(output_path)}: {e}'
+        return add_signature(pdf_path, output_path, signature_path, (page_number, y_position))
@@ -13,9 +13,20 @@
 # You should have received a copy of the GNU General Public License
 import os
 import re
+from typing import Iterable
+
 import docx
 from docx.document import Document
 
+from backend import cancellation
+from backend.doc_cache import ParsedDocument, body_paragraphs, documents
+from backend.fingerprint import Template, TemplateCache, fingerprint, templates
+from backend.rules import RuleSet, compile_rules
+from backend.tracing import span
+
+
+# Year in filenames
+DATE_PATTERN = re.compile(r"\s(20[0-9][0-9])")
 
 def increment_date(match):
     """ Increment the year in a date match by 1. """
@@ -38,70 +49,122 @@ def clean_filename(filename):
         return f'{match.group(1)}{match.group(2)}'
     return filename
 
-def get_partner_rates(partner_rates: list[dict[str, str]]):
-    partner1 = f"{partner_rates[0].get('name')}–{partner_rates[0].get('rate')}"
-    partner2 = f"{partner_rates[1].get('name')}–{partner_rates[1].get('rate')}"
-    return partner1, partner2
-    
-
-def update_paragraphs(doc: Document, date_pattern, compliance_rates_pattern, consulting_rates_pattern, **rate_options):
-    updated = False
-    default_partner_rates = [
-        {
-            "name": "No name set",
-            "rate": "No rate set"
-        }, {
-            "name": "No name set",
-            "rate": "No rate set"
-        }
-    ]
-    for para in doc.paragraphs:
-        # Update dates
-        if date_pattern.search(para.text):
-            para.text = re.sub(date_pattern, lambda m: increment_date(m), para.text)
-            updated = True
-
-        # Update compliance rates
-        if compliance_rates_pattern.search(para.text):
-            # This is a list of dictionaries with each partner and their rate.
-            compliance_partner1, compliance_partner2 = get_partner_rates(rate_options.get('COMPLIANCE_PARTNER_RATES', default_partner_rates))
-            compliance_associate_rates = rate_options.get('COMPLIANCE_ASSOCIATE_RATES', 'No rate set')
-            compliance_bookkeeping_rates = rate_options.get('COMPLIANCE_BOOKKEEPING_RATES', "No rate set")
-
-            para.text = re.sub(compliance_rates_pattern, f"Partner hourly rates are: {compliance_partner1}, {compliance_partner2}. Our Associate hourly rates range from {compliance_associate_rates}. Our bookkeeping rate is {compliance_bookkeeping_rates} per hour.", para.text)
-            updated = True
-        # Update consulting rates
-        elif consulting_rates_pattern.search(para.text):
-            # This is a list of dictionaries with each partner and their rate.
-            consulting_partner1, consulting_partner2 = get_partner_rates(rate_options.get('CONSULTING_PARTNER_RATES', default_partner_rates))
-            consulting_associate_rates = rate_options.get('CONSULTING_ASSOCIATE_RATES', 'No rate set')
-
-            para.text = re.sub(consulting_rates_pattern, f"Partner hourly rates are: {consulting_partner1}, {consulting_partner2}. Our Associate hourly rates range from {consulting_associate_rates}.", para.text)
-            updated = True
-
-    return updated
-
-def process_engagement_letter(filename: str, processed_file_directory, **rate_options):
-    """ Process a single engagement letter. """
+def rollover_updates(paragraphs: Iterable[str], rule_set: RuleSet) -> list[tuple[int, str]]:
+    """ Return (index, new text) of each paragraph the rollover rules rewrite. """
+    updates = []
+    for i, text in enumerate(paragraphs):
+        new_text = rule_set.apply(text)
+        if new_text is not None:
+            updates.append((i, new_text))
+    return updates
+
+def template_updates(paragraphs: tuple[str, ...], rule_set: RuleSet, template: Template) -> list[tuple[int, str]]|None:
+    """
+    Run the rules over only the paragraphs a known template says can match. Returns a list of (index, new text), or
+    None if the letter doesn't fit the template and must be fully scanned.
+    """
+    if template.boilerplate_changed(paragraphs):
+        return None
+    updates = []
+    for i in sorted(template.hot | template.variable):
+        new_text = rule_set.apply(paragraphs[i])
+        if new_text is not None:
+            updates.append((i, new_text))
+        elif i in template.hot:
+            return None
+    return updates
+
+def letter_updates(parsed: ParsedDocument, rule_set: RuleSet, template_cache: TemplateCache|None=templates) -> list[tuple[int, str]]:
+    """
+    Return (index, new text) of each paragraph of a letter the rollover rules rewrite. Letters of a known template
+    only have the paragraphs that can match run through the rules, other letters are fully scanned and teach the
+    cache their template.
+
+    :param template_cache: [Optional] cache of known letter templates. Default is the cache shared by the process,
+    None always scans every paragraph.
+    """
+    if template_cache is None or parsed.template is None:
+        return rollover_updates(parsed.paragraphs, rule_set)
+    # Paragraph indices of a template are only valid for the rules they were learned with
+    key = (parsed.template, rule_set.regex.pattern if rule_set.regex is not None else '')
+    template = template_cache.lookup(key)
+    if template is not None:
+        updates = template_updates(parsed.paragraphs, rule_set, template)
+        if updates is not None:
+            template_cache.hit()
+            return updates
+        template_cache.fallback()
+    updates = rollover_updates(parsed.paragraphs, rule_set)
+    template_cache.learn(key, parsed.paragraphs, {i for i, _ in updates})
+    return updates
+
+def preview_engagement_letter(filename: str, rules=None, **rate_options):
+    """
+    Dry run of `process_engagement_letter`. The paragraphs the rollover would rewrite are found from the letter's text,
+    read from the document cache or straight from the docx XML. The letter is never loaded with python-docx and
+    nothing is written.
+
+    :param rules: [Optional] rollover rule configs, see backend.rules. Default rules are used if not set.
+    :return: {'filename', 'updated', 'changes'}, with the paragraph index, matching rule names, current text and
+    new text of each change. 'updated' is False for letters the rollover would skip as not updated.
+    """
     try:
-        doc: Document = docx.Document(filename)
-        # regex patterns
-        date_pattern = re.compile(r"\s(20[0-9][0-9])")
-        compliance_rates_pattern = re.compile(r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.\s*Our bookkeeping rate is \$\d+-\d+\s*per hour\.")
-        consulting_rates_pattern = re.compile(r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.")
+        rule_set = compile_rules(rules, rate_options)
+        with span('parse'):
+            parsed = documents.load(filename)
+        with span('rewrite'):
+            updates = rollover_updates(parsed.paragraphs, rule_set)
+        changes = [
+            {"paragraph": i, "rules": rule_set.matched_rules(parsed.paragraphs[i]), "text": parsed.paragraphs[i], "new_text": new_text}
+            for i, new_text in updates
+        ]
+        return {"filename": os.path.basename(filename), "updated": bool(changes), "changes": changes}, None
+    except Exception as error:
+        return None, str(error)
+
+def process_engagement_letter(filename: str, processed_file_directory, rules=None, **rate_options):
+    """
+    Process a single engagement letter.
+
+    :param rules: [Optional] rollover rule configs, see backend.rules. Default rules are used if not set.
+    """
+    try:
+        rule_set = compile_rules(rules, rate_options)
+        # Paragraph texts come from the shared document cache, ie. when the letters were just checked for entities.
+        # Letters that are not cached are parsed once with python-docx and their texts cached from that.
+        with span('parse'):
+            sha256, parsed = documents.lookup(filename)
+            doc: Document|None = None
+            if parsed is None:
+                doc = docx.Document(filename)
+                parsed = documents.add(sha256, body_paragraphs(doc.element.body), fingerprint(doc.element.body))
+
+        with span('rewrite'):
+            updates = letter_updates(parsed, rule_set)
 
-        updated = update_paragraphs(doc, date_pattern, compliance_rates_pattern, consulting_rates_pattern, **rate_options)
+        if updates:
+            # Stop before the slower python-docx stages if the job was cancelled
+            cancellation.check()
+            if doc is None:
+                with span('parse'):
+                    doc = docx.Document(filename)
+            with span('rewrite'):
+                # Cached paragraph indices are positions in doc.paragraphs
+                paragraphs = doc.paragraphs
+                for i, new_text in updates:
+                    paragraphs[i].text = new_text
 
-        if updated:
             # filenames have spaces ' ' replaced with underscores '_'. These need to be converted back to spaces.
             filename = ' '.join(filename.split('_'))
 
             # Increment year in filename
-            new_filename = get_new_filename(os.path.basename(filename), date_pattern)
+            new_filename = get_new_filename(os.path.basename(filename), DATE_PATTERN)
             # Clean the filename of the previous years tracking info
             cleaned_filename = clean_filename(new_filename)
             new_file_path = os.path.join(processed_file_directory, cleaned_filename)
-            doc.save(new_file_path)
+            cancellation.check()
+            with span('save'):
+                doc.save(new_file_path)
             return new_file_path, None
         return None, f'File {filename} was not updated.'
 
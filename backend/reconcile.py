@@ -0,0 +1,191 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import re
+import time
+from typing import Any, Iterable
+
+from backend.tracing import span
+
+
+# Letters are matched by client name and address first, then by either alone for clients who moved or were renamed
+MATCH_PASSES = ('name_and_address', 'name', 'address')
+
+ENGAGEMENT_LETTER_PATTERN = re.compile(r'engagement\s+letter.*$', re.IGNORECASE)
+YEAR_PATTERN = re.compile(r'\b(?:19|20)\d\d\b')
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]+')
+SPACE_PATTERN = re.compile(r'[\s_]+')
+# Common street abbreviations, so 'Main Street' and 'Main St.' match
+STREET_WORDS = {
+    'street': 'st', 'avenue': 'ave', 'road': 'rd', 'drive': 'dr', 'boulevard': 'blvd', 'lane': 'ln', 'court': 'ct',
+    'place': 'pl', 'parkway': 'pkwy', 'highway': 'hwy', 'circle': 'cir', 'terrace': 'ter', 'suite': 'ste',
+    'apartment': 'apt', 'floor': 'fl', 'building': 'bldg', 'room': 'rm', 'north': 'n', 'south': 's', 'east': 'e',
+    'west': 'w', 'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw', 'number': '', 'no': ''
+}
+
+
+def normalize(text: str|None) -> str:
+    """ Casefold text, drop punctuation and collapse whitespace, so 'Smith, L.L.C.' and 'smith llc' are equal. """
+    if not text:
+        return ''
+    text = PUNCTUATION_PATTERN.sub('', text.casefold().replace('&', ' and '))
+    return SPACE_PATTERN.sub(' ', text).strip()
+
+def client_name(letter: dict[str, Any]) -> str:
+    """
+    Normalized client name of an extracted letter. Taken from the filename without its year and everything from
+    'Engagement Letter' on, as rollovers keep the rest of the filename. Falls back to the address recipient.
+    """
+    base = os.path.splitext(letter.get('filename') or '')[0].replace('_', ' ')
+    name = normalize(YEAR_PATTERN.sub(' ', ENGAGEMENT_LETTER_PATTERN.sub('', base)))
+    if not name:
+        name = normalize((letter.get('address_fields') or {}).get('recipient'))
+    return name
+
+def client_address(letter: dict[str, Any]) -> str:
+    """ Normalized street lines and 5 digit zip code of an extracted letter, or '' if no address was found. """
+    fields = letter.get('address_fields')
+    if not fields:
+        return ''
+    words = normalize(' '.join(fields.get('street') or [])).split()
+    street = ' '.join(word for word in (STREET_WORDS.get(word, word) for word in words) if word)
+    return f"{street} {(fields.get('zip') or '')[:5]}".strip()
+
+def entity_key(entity: dict[str, Any]) -> str:
+    return normalize(entity.get('name_of_entity'))
+
+def diff_entities(prior: list[dict[str, Any]], current: list[dict[str, Any]]) -> dict[str, list[dict[str, Any]]]:
+    """
+    Hash join the entity lists of two letters of the same client on normalized entity name.
+
+    :return: {"added": entities only in current, "removed": entities only in prior, "changed": entities whose
+    return type changed as {"name_of_entity", "prior_type", "current_type"}}.
+    """
+    prior_by_name = {}
+    for entity in prior:
+        prior_by_name.setdefault(entity_key(entity), entity)
+    added, changed, seen = [], [], set()
+    for entity in current:
+        key = entity_key(entity)
+        if key in seen:
+            continue
+        seen.add(key)
+        earlier = prior_by_name.get(key)
+        if earlier is None:
+            added.append(entity)
+        elif normalize(earlier.get('type_of_return')) != normalize(entity.get('type_of_return')):
+            changed.append({
+                "name_of_entity": entity.get('name_of_entity'),
+                "prior_type": earlier.get('type_of_return'),
+                "current_type": entity.get('type_of_return')
+            })
+    removed = [entity for key, entity in prior_by_name.items() if key not in seen]
+    return {"added": added, "removed": removed, "changed": changed}
+
+def _match_keys(name: str, address: str) -> dict[str, str]:
+    keys = {}
+    if name and address:
+        keys['name_and_address'] = f'{name}\n{address}'
+    if name:
+        keys['name'] = name
+    if address:
+        keys['address'] = address
+    return keys
+
+def _match_letters(prior: list[dict[str, Any]], current: list[dict[str, Any]]) -> tuple[list[tuple[int, int, str]], set[int], set[int]]:
+    """
+    Pair prior and current letters with one hash join per match pass. Letters sharing a key are paired in order.
+
+    :return: (prior index, current index, match pass) of each pair, and the unmatched prior and current indices.
+    """
+    prior_keys = [_match_keys(client_name(letter), client_address(letter)) for letter in prior]
+    current_keys = [_match_keys(client_name(letter), client_address(letter)) for letter in current]
+    prior_left, current_left = set(range(len(prior))), set(range(len(current)))
+    pairs = []
+    for match_pass in MATCH_PASSES:
+        table: dict[str, list[int]] = {}
+        for i in sorted(prior_left):
+            key = prior_keys[i].get(match_pass)
+            if key:
+                table.setdefault(key, []).append(i)
+        for j in sorted(current_left):
+            candidates = table.get(current_keys[j].get(match_pass))
+            if candidates:
+                i = candidates.pop(0)
+                pairs.append((i, j, match_pass))
+                prior_left.discard(i)
+                current_left.discard(j)
+    return pairs, prior_left, current_left
+
+def _letter(letter: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "client": client_name(letter),
+        "filename": letter.get('filename'),
+        "address": letter.get('address'),
+        "entities": letter.get('entities') or []
+    }
+
+def reconcile(prior: Iterable[dict[str, Any]], current: Iterable[dict[str, Any]], include_unchanged: bool=False) -> dict[str, Any]:
+    """
+    Compare the entities of last year's letters with this year's. Letters are matched by normalized client name
+    and address, then the entity lists of each pair are hash joined on normalized entity name. Runs in time linear
+    in the number of letters and entities.
+
+    :param prior: extracted letters of the prior year, see backend.extractor.process_document.
+    :param current: extracted letters of the current year.
+    :param include_unchanged: [Optional] also list matched letters whose entities did not change. Default is False.
+    :return: {"summary": counts, "letters": matched letters with their added, removed and changed entities,
+    "prior_only": prior letters without a current letter, "current_only": current letters without a prior letter}.
+    """
+    started = time.perf_counter()
+    prior, current = list(prior), list(current)
+    with span('reconcile', prior=len(prior), current=len(current)):
+        pairs, prior_left, current_left = _match_letters(prior, current)
+        letters = []
+        totals = {"added": 0, "removed": 0, "changed": 0}
+        for i, j, match_pass in pairs:
+            diff = diff_entities(prior[i].get('entities') or [], current[j].get('entities') or [])
+            for change, entities in diff.items():
+                totals[change] += len(entities)
+            if include_unchanged or any(diff.values()):
+                letters.append({
+                    "client": client_name(current[j]),
+                    "prior": prior[i].get('filename'),
+                    "current": current[j].get('filename'),
+                    "match": match_pass,
+                    **diff
+                })
+        prior_only = [_letter(prior[i]) for i in prior_left]
+        current_only = [_letter(current[j]) for j in current_left]
+        # Checks list letters in the order they finished, so results are sorted by client
+        for group in (letters, prior_only, current_only):
+            group.sort(key=lambda letter: (letter['client'], letter.get('current') or letter.get('filename') or ''))
+
+    return {
+        "summary": {
+            "prior_letters": len(prior),
+            "current_letters": len(current),
+            "matched": len(pairs),
+            "changed_letters": sum(1 for letter in letters if letter['added'] or letter['removed'] or letter['changed']),
+            "prior_only": len(prior_only),
+            "current_only": len(current_only),
+            # Entities of prior letters without a current letter are missing from this year as well
+            "missing_entities": totals['removed'] + sum(len(letter['entities']) for letter in prior_only),
+            **totals,
+            "seconds": round(time.perf_counter() - started, 4)
+        },
+        "letters": letters,
+        "prior_only": prior_only,
+        "current_only": current_only
+    }
@@ -0,0 +1,226 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import json
+import re
+import threading
+from typing import Any
+
+
+# Built in rollover rules, used when ROLLOVER_RULES is not configured in user-config.json.
+DEFAULT_RULES = [
+    {
+        "name": "Year",
+        "pattern": r"\s(20[0-9][0-9])",
+        "literals": ["20"],
+        "action": "increment_year"
+    },
+    {
+        "name": "Compliance rates",
+        "pattern": r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.\s*Our bookkeeping rate is \$\d+-\d+\s*per hour\.",
+        "literals": ["Partner hourly rates are:"],
+        "action": "replace",
+        "replacement": "Partner hourly rates are: {COMPLIANCE_PARTNER_RATES}. Our Associate hourly rates range from {COMPLIANCE_ASSOCIATE_RATES}. Our bookkeeping rate is {COMPLIANCE_BOOKKEEPING_RATES} per hour."
+    },
+    {
+        "name": "Consulting rates",
+        "pattern": r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.",
+        "literals": ["Partner hourly rates are:"],
+        "action": "replace",
+        "replacement": "Partner hourly rates are: {CONSULTING_PARTNER_RATES}. Our Associate hourly rates range from {CONSULTING_ASSOCIATE_RATES}."
+    }
+]
+
+DEFAULT_PARTNER_RATES = [
+    {
+        "name": "No name set",
+        "rate": "No rate set"
+    }, {
+        "name": "No name set",
+        "rate": "No rate set"
+    }
+]
+
+ACTIONS = ('increment_year', 'replace')
+
+# Group references by number, ie. \1 or (?(1)...), not preceded by an escaping backslash
+_NUMERIC_GROUP_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\(\d+\))')
+
+
+class RuleError(ValueError):
+    """Raised when a rollover rule is invalid."""
+
+
+def increment_year(groups: tuple[str, ...]) -> str:
+    """ Increment the year captured by the first group by 1. """
+    return f" {int(groups[0]) + 1}"
+
+
+def format_rate_fields(rate_options: dict[str, Any]) -> dict[str, str]:
+    """
+    Build the values available to rule replacements from rate options. Partner rate lists are formatted as
+    'Name–Rate' pairs joined with ', ', other settings are used as is.
+    """
+    fields = {
+        'COMPLIANCE_ASSOCIATE_RATES': 'No rate set',
+        'COMPLIANCE_BOOKKEEPING_RATES': 'No rate set',
+        'CONSULTING_ASSOCIATE_RATES': 'No rate set',
+        'COMPLIANCE_PARTNER_RATES': DEFAULT_PARTNER_RATES,
+        'CONSULTING_PARTNER_RATES': DEFAULT_PARTNER_RATES,
+    }
+    fields.update(rate_options)
+    for key, value in fields.items():
+        if isinstance(value, list):
+            if not all(isinstance(item, dict) for item in value):
+                raise RuleError(f'{key} must be a list of {{"name": ..., "rate": ...}} entries: {value}')
+            fields[key] = ', '.join(f"{item.get('name')}–{item.get('rate')}" for item in value)
+        else:
+            fields[key] = str(value)
+    return fields
+
+
+class Rule:
+    """
+    A single declarative rollover rule.
+
+    :param name: display name of the rule.
+    :param pattern: regular expression matched against paragraph text.
+    :param literals: strings of which at least one appears in every match, used to skip paragraphs cheaply.
+    :param action: 'increment_year' or 'replace'.
+    :param replacement: text for 'replace' rules. '{SETTING}' placeholders are filled from rate options.
+    """
+
+    def __init__(self, name: str, pattern: str, literals: list[str]|None=None, action: str='replace', replacement: str=''):
+        if action not in ACTIONS:
+            raise RuleError(f'Rule {name!r} has unknown action {action!r}. Expected one of {", ".join(ACTIONS)}.')
+        try:
+            self.regex = re.compile(pattern)
+        except re.error as e:
+            raise RuleError(f'Rule {name!r} has an invalid pattern: {e}')
+        # Rules are combined into one pattern, where group numbers are shifted by the groups of the rules before it
+        if _NUMERIC_GROUP_REFERENCE.search(pattern):
+            raise RuleError(f'Rule {name!r} refers to a group by number. Name the group, ie. (?P<word>...), and refer to it with (?P=word) instead.')
+        self.name = name
+        self.pattern = pattern
+        self.literals = list(literals or [])
+        self.action = action
+        self.replacement = replacement
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> 'Rule':
+        try:
+            return cls(config['name'], config['pattern'], config.get('literals'), config.get('action', 'replace'), config.get('replacement', ''))
+        except KeyError as e:
+            raise RuleError(f'Rollover rule is missing {e}: {config}')
+
+
+class RuleSet:
+    """
+    Rules compiled into one combined pattern so each paragraph is scanned once. Paragraphs that contain none
+    of the rules' literals are skipped without running the pattern. Earlier rules win when two rules match
+    at the same position.
+    """
+
+    def __init__(self, rules: list[Rule], rate_options: dict[str, Any]):
+        self.rules = rules
+        fields = format_rate_fields(rate_options)
+        # Replacement text is computed once per rule set instead of for every matching paragraph
+        self._replacements = []
+        for rule in rules:
+            try:
+                self._replacements.append(rule.replacement.format_map(fields) if rule.action == 'replace' else None)
+            except (KeyError, ValueError) as e:
+                raise RuleError(f'Rule {rule.name!r} has an invalid replacement: {e}')
+
+        alternatives = [f'(?P<r{i}>{rule.pattern})' for i, rule in enumerate(rules)]
+        try:
+            self.regex = re.compile('|'.join(alternatives)) if alternatives else None
+        except re.error as e:
+            raise RuleError(f'Rollover rules could not be combined: {e}')
+        # Group index and number of groups of each rule inside the combined pattern
+        self._groups = [(self.regex.groupindex[f'r{i}'], rule.regex.groups) for i, rule in enumerate(rules)]
+
+        # Literal pre-filter, disabled if any rule has no literals
+        literals = [literal for rule in rules for literal in rule.literals]
+        if rules and all(rule.literals for rule in rules):
+            self.prefilter = re.compile('|'.join(re.escape(literal) for literal in sorted(set(literals), key=len, reverse=True)))
+        else:
+            self.prefilter = None
+
+    def _replace(self, match: re.Match) -> str:
+        index = int(match.lastgroup[1:])
+        if self.rules[index].action == 'increment_year':
+            start, count = self._groups[index]
+            return increment_year(match.groups()[start:start + count])
+        return self._replacements[index]
+
+    def may_match(self, text: str) -> bool:
+        """Cheap check whether any rule could match text."""
+        if self.regex is None:
+            return False
+        return self.prefilter is None or self.prefilter.search(text) is not None
+
+    def apply(self, text: str) -> str|None:
+        """
+        Apply every rule to text in a single pass.
+
+        :return: the rewritten text, or None if no rule matched.
+        """
+        if not self.may_match(text):
+            return None
+        new_text, count = self.regex.subn(self._replace, text)
+        return new_text if count else None
+
+    def matched_rules(self, text: str) -> list[str]:
+        """Names of the rules that match text, in the order they first match."""
+        if not self.may_match(text):
+            return []
+        names = []
+        for match in self.regex.finditer(text):
+            name = self.rules[int(match.lastgroup[1:])].name
+            if name not in names:
+                names.append(name)
+        return names
+
+
+_cache: dict[str, RuleSet] = {}
+_cache_lock = threading.Lock()
+
+
+def compile_rules(rules: list[dict[str, Any]]|None=None, rate_options: dict[str, Any]|None=None) -> RuleSet:
+    """
+    Compile rollover rules and rate options into a RuleSet. Compiled rule sets are cached, so rules are only
+    compiled again when the settings change.
+
+    :param rules: [Optional] rule configs from ROLLOVER_RULES. Default is DEFAULT_RULES.
+    :param rate_options: [Optional] rate settings used by rule replacements.
+    """
+    rules = rules if rules else DEFAULT_RULES
+    rate_options = rate_options or {}
+    key = json.dumps([rules, rate_options], sort_keys=True)
+    with _cache_lock:
+        rule_set = _cache.get(key)
+        if rule_set is None:
+            rule_set = RuleSet([Rule.from_config(rule) for rule in rules], rate_options)
+            # Settings rarely change, keep only the most recent few
+            if len(_cache) >= 8:
+                _cache.pop(next(iter(_cache)))
+            _cache[key] = rule_set
+    return rule_set
+
+
+def cached_rules() -> list[tuple[list[dict[str, Any]], dict[str, Any]]]:
+    """(rules, rate options) of each cached rule set, least recently compiled first, see backend.snapshot."""
+    with _cache_lock:
+        keys = list(_cache)
+    return [tuple(json.loads(key)) for key in keys]
@@ -0,0 +1,409 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from collections import Counter, deque
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Iterator
+import uuid
+
+from backend import cancellation, tracing
+
+
+# Error of tasks that were dropped or stopped because their job was cancelled
+CANCELLED = 'Cancelled'
+
+
+class Task:
+    """
+    A single unit of work (usually one file) belonging to a job.
+    """
+    __slots__ = ('job', 'fn', 'args', 'kwargs', 'callback', 'submitted_at', 'started_at', 'finished_at', 'result', 'error')
+
+    def __init__(self, job: 'Job', fn: Callable, args: tuple, kwargs: dict[str, Any], callback: Callable|None):
+        self.job = job
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds the task spent queued before a worker picked it up."""
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.submitted_at
+
+
+class Job:
+    """
+    A batch of tasks submitted by one user for one process. Jobs are created by the scheduler, filled with
+    tasks as files arrive, sealed once no more tasks will be added and then waited on.
+    """
+
+    def __init__(self, scheduler: 'Scheduler', owner: str, process: str, job_id: str|None=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.owner = owner
+        self.process = process
+        self.created_at = time.time()
+        self.pending: deque[Task] = deque()
+        self.submitted = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        # Tasks dropped without running because the job was cancelled, counted as completed and failed
+        self.skipped = 0
+        self.sealed = False
+        # Fraction of the job's inputs received so far, for jobs fed while their upload is still arriving
+        self.intake = 1.0
+        self.queue_waits: list[float] = []
+        # Paths of output files produced by the job's tasks
+        self.outputs: list[str] = []
+        # Journal entries of the job's finished files, in the order they finished
+        self.results: list[dict[str, Any]] = []
+        # Timeline of the job's tasks, only set for jobs that are traced
+        self.trace: tracing.Trace|None = None
+        # Checked by the job's tasks between files and pipeline stages
+        self.cancel_token = cancellation.CancelToken()
+        self._scheduler = scheduler
+
+    @property
+    def remaining(self) -> int:
+        """Number of tasks not yet finished."""
+        return len(self.pending) + self.running
+
+    @property
+    def done(self) -> bool:
+        return self.sealed and self.completed == self.submitted
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    def head_wait(self, now: float) -> float:
+        """Seconds the oldest pending task of this job has been waiting."""
+        if not self.pending:
+            return 0.0
+        return now - self.pending[0].submitted_at
+
+    def progress(self) -> float:
+        """Fraction of the job that is finished, scaled by how much of its input has been received."""
+        done = self.completed / self.submitted if self.submitted else 0.0
+        return done if self.sealed else done * self.intake
+
+    def seal(self):
+        """Mark the job as complete, no more tasks will be submitted."""
+        self._scheduler._seal(self)
+
+    def wait(self, timeout: float|None=None) -> bool:
+        """
+        Block until every task in the sealed job has finished.
+
+        :param timeout: [Optional] seconds to wait. Default waits forever.
+        :return: True if the job finished, False on timeout.
+        """
+        return self._scheduler._wait(self, timeout)
+
+    def cancel(self) -> bool:
+        """
+        Cancel the job. Queued tasks are dropped, running tasks stop at their next check and tasks submitted later
+        are skipped.
+
+        :return: False if the job had already finished or been cancelled.
+        """
+        return self._scheduler._cancel(self)
+
+    def restore(self, completed: int, failed: int, outputs: list[str], results: list[dict[str, Any]]|None=None):
+        """Count files that were finished before the job was interrupted, ie. when resuming it after a restart."""
+        self._scheduler._restore(self, completed, failed, outputs, results or [])
+
+    def add_output(self, path: str):
+        """Record an output file produced by one of the job's tasks."""
+        self._scheduler._add_output(self, path)
+
+    def iter_outputs(self) -> Iterator[str]:
+        """Yield the job's output files as they are produced, until the job is done."""
+        return self._scheduler._iter_items(self, self.outputs)
+
+    def add_result(self, entry: dict[str, Any]):
+        """Record the journal entry of a finished file."""
+        self._scheduler._add_result(self, entry)
+
+    def iter_results(self) -> Iterator[dict[str, Any]]:
+        """Yield the journal entries of the job's files as they finish, until the job is done."""
+        return self._scheduler._iter_items(self, self.results)
+
+    def stats(self) -> dict[str, Any]:
+        """Queue wait and progress statistics for the job."""
+        waits = sorted(self.queue_waits)
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(round(p * (len(waits) - 1))))]
+        return {
+            "job_id": self.id,
+            "owner": self.owner,
+            "process": self.process,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "cancelled": self.cancelled,
+            "pending": len(self.pending),
+            "running": self.running,
+            "sealed": self.sealed,
+            "queue_wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "queue_wait_p95": percentile(0.95),
+            "queue_wait_max": waits[-1] if waits else 0.0,
+        }
+
+
+class Scheduler:
+    """
+    Interleaves tasks from every active job on a fixed pool of worker threads.
+
+    The next task is picked from the owner with the fewest tasks currently running (per-user fair share), and
+    within that from the job with the least remaining work (shortest-remaining-first). Waiting lowers a job's
+    effective remaining work by `aging` tasks per second so large batches are never starved.
+    """
+
+    def __init__(self, workers: int=4, aging: float=5.0, history: int=50, logger: logging.Logger|None=None):
+        """
+        :param workers: number of worker threads.
+        :param aging: tasks per second of waiting subtracted from a job's remaining work when picking the next task.
+        :param history: number of finished jobs kept for statistics.
+        :param logger: [Optional] logger for task and callback errors.
+        """
+        self.aging = aging
+        self.logger = logger or logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        self._jobs: dict[str, Job] = {}
+        self._finished: deque[Job] = deque(maxlen=history)
+        self._owner_running: Counter[str] = Counter()
+        # Set while shutting down, no more tasks are started
+        self._draining = False
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._worker, name=f'scheduler-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def create_job(self, owner: str, process: str, job_id: str|None=None) -> Job:
+        """
+        Create a new job.
+
+        :param owner: identifier of the user submitting the job, used for fair share.
+        :param process: name of the process the job belongs to.
+        :param job_id: [Optional] id of the job, ie. when resuming an interrupted job. Default is a new id.
+        """
+        job = Job(self, owner or 'anonymous', process, job_id)
+        with self._cond:
+            self._jobs[job.id] = job
+        return job
+
+    def get_job(self, job_id: str) -> Job|None:
+        """Return an active or recently finished job by id."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = next((j for j in self._finished if j.id == job_id), None)
+            return job
+
+    def jobs(self) -> list[Job]:
+        """Return active jobs followed by recently finished jobs."""
+        with self._cond:
+            return list(self._jobs.values()) + list(self._finished)
+
+    def submit(self, job: Job, fn: Callable, *args, callback: Callable[[Task], None]|None=None, **kwargs) -> Task:
+        """
+        Queue `fn(*args, **kwargs)` as a task of job. Tasks of a cancelled job are counted as skipped and never run.
+
+        :param job: the job the task belongs to.
+        :param fn: function to call.
+        :param callback: [Optional] called with the finished task on the worker thread.
+        """
+        task = Task(job, fn, args, kwargs, callback)
+        with self._cond:
+            if job.sealed:
+                raise RuntimeError(f'Job {job.id} is sealed')
+            job.submitted += 1
+            if job.cancelled:
+                task.error = CANCELLED
+                job.completed += 1
+                job.failed += 1
+                job.skipped += 1
+                return task
+            job.pending.append(task)
+            self._cond.notify_all()
+        return task
+
+    def drain(self, timeout: float|None=None) -> dict[str, int]:
+        """
+        Stop starting tasks and wait for the running ones to finish, ie. before the server shuts down. Queued tasks
+        are left queued, their files are resumed from the journal after a restart.
+
+        :param timeout: [Optional] seconds to wait for running tasks. Default waits forever.
+        :return: {"running": tasks still running after timeout, "queued": tasks left queued, "jobs": active jobs}.
+        """
+        with self._cond:
+            self._draining = True
+            self._cond.wait_for(lambda: not any(job.running for job in self._jobs.values()), timeout)
+            return {
+                "running": sum(job.running for job in self._jobs.values()),
+                "queued": sum(len(job.pending) for job in self._jobs.values()),
+                "jobs": len(self._jobs)
+            }
+
+    def _seal(self, job: Job):
+        with self._cond:
+            job.sealed = True
+            self._retire(job)
+            self._cond.notify_all()
+
+    def _wait(self, job: Job, timeout: float|None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: job.done, timeout)
+
+    def _cancel(self, job: Job) -> bool:
+        with self._cond:
+            if job.done or job.cancelled:
+                return False
+            skipped = len(job.pending)
+            job.pending.clear()
+            job.completed += skipped
+            job.failed += skipped
+            job.skipped += skipped
+            # Callbacks are quick, ie. killing a converter process, and setting the token under the lock means no
+            # task can be queued after the pending ones were dropped
+            job.cancel_token.cancel()
+            self._retire(job)
+            self._cond.notify_all()
+        return True
+
+    def _restore(self, job: Job, completed: int, failed: int, outputs: list[str], results: list[dict[str, Any]]):
+        with self._cond:
+            job.submitted += completed
+            job.completed += completed
+            job.failed += failed
+            job.outputs.extend(outputs)
+            job.results.extend(results)
+            self._cond.notify_all()
+
+    def _add_output(self, job: Job, path: str):
+        with self._cond:
+            job.outputs.append(path)
+            self._cond.notify_all()
+
+    def _add_result(self, job: Job, entry: dict[str, Any]):
+        with self._cond:
+            job.results.append(entry)
+            self._cond.notify_all()
+
+    def _iter_items(self, job: Job, items: list) -> Iterator[Any]:
+        """Yield items appended to one of the job's lists as they arrive, until the job is done."""
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: index < len(items) or job.done)
+                if index >= len(items):
+                    return
+                new_items = items[index:]
+            index += len(new_items)
+            yield from new_items
+
+    def _retire(self, job: Job):
+        """Move a finished job to history. Caller holds the lock."""
+        if job.done and self._jobs.pop(job.id, None) is not None:
+            self._finished.append(job)
+
+    def _next_task(self) -> Task|None:
+        """Pick the next task to run. Caller holds the lock."""
+        if self._draining:
+            return None
+        now = time.monotonic()
+        best, best_key = None, None
+        for job in self._jobs.values():
+            if not job.pending:
+                continue
+            key = (self._owner_running[job.owner], job.remaining - self.aging * job.head_wait(now))
+            if best_key is None or key < best_key:
+                best, best_key = job, key
+        if best is None:
+            return None
+        task = best.pending.popleft()
+        task.started_at = now
+        best.running += 1
+        best.queue_waits.append(task.queue_wait)
+        self._owner_running[best.owner] += 1
+        return task
+
+    @staticmethod
+    def _task_name(task: Task) -> str:
+        """Name of the task's input file, shown in traces."""
+        return os.path.basename(task.args[0]) if task.args and isinstance(task.args[0], str) else getattr(task.fn, '__name__', 'task')
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+
+            trace = task.job.trace
+            if trace is not None:
+                started = time.perf_counter()
+                trace.add('queued', 'queue', started - task.queue_wait, started, {"file": self._task_name(task)})
+
+            shutting_down = False
+            with tracing.activate(trace), cancellation.activate(task.job.cancel_token):
+                try:
+                    task.result = task.fn(*task.args, **task.kwargs)
+                except cancellation.ShuttingDown:
+                    # No callback, so the file is not recorded as done and is resumed from the journal
+                    task.error = CANCELLED
+                    shutting_down = True
+                except cancellation.Cancelled:
+                    task.error = CANCELLED
+                except Exception as e:
+                    task.error = str(e)
+                    self.logger.exception(f'Error running task for job {task.job.id}: {e}')
+                task.finished_at = time.monotonic()
+
+                if task.callback is not None and not shutting_down:
+                    try:
+                        with tracing.span('callback'):
+                            task.callback(task)
+                    except Exception as e:
+                        self.logger.exception(f'Error in task callback for job {task.job.id}: {e}')
+
+            if trace is not None:
+                trace.add('task', 'task', started, time.perf_counter(), {"file": self._task_name(task), "error": task.error})
+
+            with self._cond:
+                job = task.job
+                job.running -= 1
+                job.completed += 1
+                if task.error is not None or (isinstance(task.result, tuple) and len(task.result) == 2 and task.result[1] is not None):
+                    job.failed += 1
+                self._owner_running[job.owner] -= 1
+                if self._owner_running[job.owner] <= 0:
+                    del self._owner_running[job.owner]
+                self._retire(job)
+                self._cond.notify_all()
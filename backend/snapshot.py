@@ -0,0 +1,121 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import gzip
+import json
+import os
+import tempfile
+import time
+from typing import Any, Iterable
+
+from backend.doc_cache import ParsedDocument, documents
+from backend.rules import RuleError, cached_rules, compile_rules
+
+
+# Snapshots of another version are ignored
+SNAPSHOT_VERSION = 1
+# Snapshots are written while the server shuts down, so favour speed over size
+COMPRESS_LEVEL = 1
+
+
+def collect() -> dict[str, Any]:
+    """Snapshot of this process's in-memory caches: parsed letters and compiled rollover rules."""
+    return {
+        "version": SNAPSHOT_VERSION,
+        "documents": documents.snapshot(),
+        "rules": cached_rules()
+    }
+
+def merge(snapshots: Iterable[dict[str, Any]], max_bytes: int|None=None) -> dict[str, Any]:
+    """
+    Merge the snapshots of several processes, ie. every worker of a pool. Letters cached by more than one process
+    are kept once, at their most recent position.
+
+    :param max_bytes: [Optional] keep only the most recently used letters that fit, see DOCUMENT_CACHE_MB.
+    """
+    letters: dict[str, Any] = {}
+    rules: dict[str, Any] = {}
+    for snapshot in snapshots:
+        for entry in snapshot.get('documents', []):
+            letters.pop(entry[0], None)
+            letters[entry[0]] = entry
+        for entry in snapshot.get('rules', []):
+            rules[json.dumps(entry, sort_keys=True)] = entry
+    entries = list(letters.values())
+    if max_bytes is not None:
+        kept, size = 0, 0
+        for entry in reversed(entries):
+            size += ParsedDocument(*entry).size
+            if size > max_bytes:
+                break
+            kept += 1
+        entries = entries[len(entries) - kept:]
+    return {"version": SNAPSHOT_VERSION, "documents": entries, "rules": list(rules.values())}
+
+def save_snapshot(path: str, snapshot: dict[str, Any]) -> tuple[dict[str, Any]|None, str|None]:
+    """
+    Write a snapshot to a gzipped JSON file. The file is replaced in one step, so a shutdown cut short never leaves
+    a partial snapshot.
+
+    :return: ({"documents", "rules", "bytes", "seconds"}, error).
+    """
+    started = time.perf_counter()
+    directory = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=COMPRESS_LEVEL) as file:
+                file.write(json.dumps({**snapshot, "created": time.time()}).encode('utf-8'))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except (OSError, TypeError, ValueError) as e:
+        return None, f'Unable to save cache snapshot to {path}: {e}'
+    return {
+        "documents": len(snapshot.get('documents', [])),
+        "rules": len(snapshot.get('rules', [])),
+        "bytes": os.path.getsize(path),
+        "seconds": round(time.perf_counter() - started, 3)
+    }, None
+
+def load_snapshot(path: str) -> tuple[dict[str, Any]|None, str|None]:
+    """Read a snapshot written by `save_snapshot`. Returns (None, None) if there is no snapshot."""
+    if not os.path.isfile(path):
+        return None, None
+    try:
+        with gzip.open(path, 'rb') as file:
+            snapshot = json.loads(file.read())
+    except (OSError, EOFError, ValueError) as e:
+        return None, f'Unable to read cache snapshot {path}: {e}'
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None, f'Ignoring cache snapshot {path} of another version'
+    return snapshot, None
+
+def restore(snapshot: dict[str, Any]) -> dict[str, int]:
+    """
+    Restore a snapshot into this process's caches. Letters beyond the document cache's memory bound are dropped,
+    least recently used first. Rules that no longer compile are skipped.
+
+    :return: number of letters and rule sets restored.
+    """
+    letters = documents.restore(snapshot.get('documents', []))
+    rule_sets = 0
+    for rules, rate_options in snapshot.get('rules', []):
+        try:
+            compile_rules(rules, rate_options)
+            rule_sets += 1
+        except RuleError:
+            continue
+    return {"documents": letters, "rules": rule_sets}
@@ -0,0 +1,165 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+from typing import Any, Iterator
+
+from backend import cancellation
+from backend.utils.lazy_import import LazyFunction
+from backend.utils.path_utils import get_full_path
+
+
+# Backends are imported on first use, see backend.utils.lazy_import
+_process_engagement_letter = LazyFunction('backend.processor', 'process_engagement_letter')
+_preview_engagement_letter = LazyFunction('backend.processor', 'preview_engagement_letter')
+_process_document = LazyFunction('backend.extractor', 'process_document')
+_convert_word_to_pdf = LazyFunction('backend.converter', 'convert_word_to_pdf')
+_sign_pdf = LazyFunction('backend.pdf_signature', 'sign_pdf')
+_insert_signature = LazyFunction('backend.docx_signature', 'insert_signature')
+_optimize_pdf = LazyFunction('backend.pdf_optimizer', 'optimize_pdf')
+
+_local = threading.local()
+
+# Every task is called as `task(input_path, output_dir, **options)` and returns (result, error). The result is the
+# path of the output file written to output_dir, or the extracted info for `extract`. Options must be JSON
+# serializable so tasks can be journaled and sent to workers on other hosts.
+
+
+def rollover(input_path: str, output_dir: str, rules: list[dict[str, Any]]|None=None, **rate_options) -> tuple[str|None, str|None]:
+    """Roll over an engagement letter, see `backend.processor.process_engagement_letter`."""
+    return _process_engagement_letter(input_path, output_dir, rules=rules, **rate_options)
+
+def preview(input_path: str, output_dir: str|None=None, rules: list[dict[str, Any]]|None=None, **rate_options) -> tuple[dict[str, Any]|None, str|None]:
+    """Dry run of `rollover`: the changes it would make, see `backend.processor.preview_engagement_letter`. Nothing is written to output_dir."""
+    return _preview_engagement_letter(input_path, rules=rules, **rate_options)
+
+def extract(input_path: str, output_dir: str|None=None, address_lines: int=40) -> tuple[dict[str, Any]|None, str|None]:
+    """
+    Extract address and entity info from an engagement letter. Nothing is written to output_dir.
+
+    :param address_lines: [Optional] lines at the top of the letter searched for the address. Default matches ADDRESS_SCAN_LINES.
+    """
+    return _process_document(input_path, address_lines=address_lines), None
+
+def print_pdf(input_path: str, output_dir: str) -> tuple[str|None, str|None]:
+    """
+    Print an engagement letter to PDF.
+    """
+    filename, error = _convert_word_to_pdf(input_path, output_dir)
+    return (os.path.join(output_dir, filename) if filename else None), error
+
+def sign(input_path: str, output_dir: str, signatures_dir: str='images/signatures', incremental: bool=True, optimize: dict[str, Any]|None=None) -> tuple[str|None, str|None]:
+    """
+    Add the partner's signature to an engagement letter PDF.
+
+    :param signatures_dir: [Optional] directory of signature PDFs. Relative paths are relative to the project root
+    of the host running the task.
+    :param incremental: [Optional] append the signature to the original PDF instead of rewriting it. Default is True.
+    :param optimize: [Optional] PDF_OPTIMIZATION settings rewritten PDFs are optimized with. Incremental updates
+    leave the original bytes as they are, so are not optimized.
+    """
+    filename, error = _sign_pdf(input_path, output_dir, get_full_path(signatures_dir), incremental=incremental)
+    if filename and not incremental:
+        _optimize(os.path.join(output_dir, filename), optimize)
+    return (os.path.join(output_dir, filename) if filename else None), error
+
+def print_and_sign(input_path: str, output_dir: str, signatures_dir: str='images/signatures', sign_in_docx: bool=False, incremental: bool=True, optimize: dict[str, Any]|None=None) -> tuple[str|None, str|None]:
+    """
+    Print an engagement letter to PDF with the partner's signature.
+
+    :param signatures_dir: [Optional] directory of signature images and PDFs, see `sign`.
+    :param sign_in_docx: [Optional] place the signature image in the letter before printing, so the PDF is never
+    re-read. Letters without a signer or whose signer only has a signature PDF are printed and then stamped like
+    `sign`. Default is False, signatures are stamped onto the printed PDF. See the PDF_SIGN_IN_DOCX setting.
+    :param incremental: [Optional] stamp printed PDFs with an incremental update, see `sign`. Default is True.
+    :param optimize: [Optional] PDF_OPTIMIZATION settings signed PDFs are optimized with when they are rewritten,
+    see `sign`.
+    """
+    signatures_dir = get_full_path(signatures_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        if sign_in_docx:
+            signed_path = os.path.join(work_dir, os.path.basename(input_path))
+            signed, _ = _insert_signature(input_path, signed_path, signatures_dir)
+            # Each stage checks whether the job was cancelled before starting
+            cancellation.check()
+            if signed:
+                return print_pdf(signed_path, output_dir)
+        filename, error = _convert_word_to_pdf(input_path, work_dir)
+        if filename is None:
+            return None, error
+        cancellation.check()
+        filename, error = _sign_pdf(os.path.join(work_dir, filename), output_dir, signatures_dir, incremental=incremental)
+        if filename and not incremental:
+            _optimize(os.path.join(output_dir, filename), optimize)
+        return (os.path.join(output_dir, filename) if filename else None), error
+
+def _optimize(path: str, optimize: dict[str, Any]|None):
+    """
+    Optimize a PDF written by a task in place, see `backend.pdf_optimizer.optimize_pdf`, and add its report to the
+    reports collected on this thread. A PDF that can't be optimized is kept as written, so never fails the task.
+
+    :param optimize: PDF_OPTIMIZATION settings: 'enabled', 'compress_streams', 'deduplicate' and 'linearize'. Nothing
+    is done if None or not enabled.
+    """
+    if not optimize or not optimize.get('enabled', True):
+        return
+    cancellation.check()
+    report, error = _optimize_pdf(
+        path,
+        compress_streams=optimize.get('compress_streams', True),
+        deduplicate=optimize.get('deduplicate', True),
+        linearize=optimize.get('linearize', False)
+    )
+    add_optimization_reports([report or {"file": os.path.basename(path), "error": error}])
+
+def add_optimization_reports(reports: list[dict[str, Any]]):
+    """Add reports of optimized PDFs to the reports collected on this thread, ie. reports sent back by a worker process."""
+    collected = getattr(_local, 'reports', None)
+    if collected is not None:
+        collected.extend(reports)
+
+@contextmanager
+def optimization_reports(reports: list[dict[str, Any]]|None=None) -> Iterator[list[dict[str, Any]]]:
+    """
+    Collect the reports of PDFs optimized by tasks run on this thread inside the with block.
+
+    :param reports: [Optional] list to add reports to. Default is a new list.
+    :return: the list reports are added to.
+    """
+    previous = getattr(_local, 'reports', None)
+    _local.reports = reports if reports is not None else []
+    try:
+        yield _local.reports
+    finally:
+        _local.reports = previous
+
+
+# Tasks by command name
+TASKS = {
+    'rollover': rollover,
+    'preview': preview,
+    'extract': extract,
+    'print-pdf': print_pdf,
+    'sign': sign,
+    'print-sign': print_and_sign,
+}
+
+def get_task(name: str):
+    """Return a task by command name or function name. Raises KeyError for unknown tasks."""
+    for command, task in TASKS.items():
+        if name in (command, task.__name__):
+            return task
+    raise KeyError(f'Unknown task: {name}')
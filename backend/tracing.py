@@ -0,0 +1,174 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import random
+import threading
+import time
+from typing import Any
+
+
+# Recording stops at this many events so a huge batch can't use unbounded memory
+MAX_EVENTS = 200_000
+
+_local = threading.local()
+
+
+class Trace:
+    """
+    Timeline of one job in Chrome trace event format, viewable in chrome://tracing or ui.perfetto.dev. Spans are
+    recorded from any thread, with the thread's id and name, and timestamps are microseconds since the trace started.
+    """
+
+    def __init__(self, job_id: str, max_events: int=MAX_EVENTS):
+        self.job_id = job_id
+        self.max_events = max_events
+        self.started = time.perf_counter()
+        self.events: list[dict[str, Any]] = []
+        self.dropped = 0
+        self._threads: dict[int, str] = {}
+        # Process and thread name events of traces merged from other processes, see `merge`
+        self._metadata: dict[tuple, dict[str, Any]] = {}
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict[str, Any]|None=None):
+        """
+        Record a span.
+
+        :param start: span start, from time.perf_counter().
+        :param end: span end, from time.perf_counter().
+        :param args: [Optional] values shown with the span.
+        """
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        thread = threading.current_thread()
+        if thread.ident not in self._threads:
+            self._threads[thread.ident] = thread.name
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.started) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = args
+        # list.append is atomic, so spans from several threads need no lock
+        self.events.append(event)
+
+    def merge(self, trace: dict[str, Any], started: float, process_name: str):
+        """
+        Add the spans of a trace recorded in another process, ie. a worker process running one of the job's files.
+
+        :param trace: the other trace's `to_json`.
+        :param started: when the other trace started, from this process's time.perf_counter().
+        :param process_name: name the other process is shown with.
+        """
+        offset = (started - self.started) * 1e6
+        for event in trace["traceEvents"]:
+            if event["ph"] == "M":
+                if event["name"] == "thread_name":
+                    self._metadata[(event["pid"], event["tid"])] = event
+                else:
+                    self._metadata[(event["pid"],)] = {**event, "args": {"name": process_name}}
+            elif len(self.events) >= self.max_events:
+                self.dropped += 1
+            else:
+                self.events.append({**event, "ts": round(event["ts"] + offset, 1)})
+        self.dropped += trace["otherData"]["dropped_events"]
+
+    def to_json(self) -> dict[str, Any]:
+        """Return the trace as a Chrome trace JSON object."""
+        pid = os.getpid()
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f'job {self.job_id}'}}]
+        metadata += [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in list(self._threads.items())
+        ]
+        metadata += list(self._metadata.values())
+        return {
+            "traceEvents": metadata + list(self.events),
+            "displayTimeUnit": "ms",
+            "otherData": {"job_id": self.job_id, "dropped_events": self.dropped},
+        }
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'category', 'args', 'start')
+
+    def __init__(self, trace: Trace, name: str, category: str, args: dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current() -> Trace|None:
+    """Return the trace active on this thread, if any."""
+    return getattr(_local, 'trace', None)
+
+class activate:
+    """Make trace the active trace of this thread inside a with block. A trace of None disables recording."""
+    __slots__ = ('trace', 'previous')
+
+    def __init__(self, trace: Trace|None):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'trace', None)
+        _local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc):
+        _local.trace = self.previous
+        return False
+
+def span(name: str, category: str='task', **args):
+    """
+    Record the with block as a span of the thread's active trace. Does nothing, and costs one attribute lookup, when
+    the thread has no active trace.
+
+    :param category: span category, ie. 'task', 'queue', 'upload' or 'emit'.
+    :param args: values shown with the span.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, category, args)
+
+def sampled(rate: float) -> bool:
+    """Return True for a fraction of calls given by rate, from 0 (never) to 1 (always)."""
+    return rate >= 1 or (rate > 0 and random.random() < rate)
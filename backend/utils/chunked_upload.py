@@ -0,0 +1,250 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import IO, Any, Iterator
+import uuid
+
+
+UPLOADS_DIR = 'temp/uploads'
+CHUNK_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# Bytes of a chunk read from the request at a time
+READ_SIZE = 64 * 1024
+
+
+class ChunkError(ValueError):
+    """Raised when an upload session or chunk is rejected."""
+
+
+class UploadSession:
+    """
+    A batch of files uploaded in fixed-size chunks. Chunks can arrive in any order, in parallel and more than once.
+    Each chunk is written straight to its place in the file on disk and is only acknowledged once its sha256 matches,
+    so a client that lost its connection resumes by sending the chunks still missing. Files are handed on as soon as
+    their last chunk arrives, while the rest of the batch is still uploading.
+    """
+
+    def __init__(self, directory: str, files: list[dict[str, Any]], chunk_size: int):
+        """
+        :param directory: directory the session's files are written to, its name is the session id.
+        :param files: [{"name": filename, "size": bytes}] of each file in the batch.
+        :param chunk_size: bytes per chunk, the last chunk of a file may be shorter.
+        """
+        self.id = os.path.basename(directory)
+        self.directory = directory
+        self.files = files
+        self.chunk_size = chunk_size
+        self.total_bytes = sum(file['size'] for file in files)
+        self.bytes_received = 0
+        self.updated_at = time.monotonic()
+        # Set once a job takes the session's files, a session only feeds one job
+        self.claimed = False
+        self.closed = False
+        self._missing = [set(range(self.chunk_count(index))) for index in range(len(files))]
+        # File indexes in the order they were completed
+        self._complete = [index for index, missing in enumerate(self._missing) if not missing]
+        self._cond = threading.Condition()
+
+        os.makedirs(directory, exist_ok=True)
+        for index, file in enumerate(files):
+            # Sparse file of the final size, chunks are written in place
+            with open(self._path(index), 'wb') as handle:
+                handle.truncate(file['size'])
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, f'{index}.part')
+
+    def chunk_count(self, index: int) -> int:
+        """Number of chunks file index is split into."""
+        return -(-self.files[index]['size'] // self.chunk_size)
+
+    @property
+    def fraction(self) -> float:
+        """Fraction of the batch's bytes received so far."""
+        return self.bytes_received / self.total_bytes if self.total_bytes else 1.0
+
+    def status(self) -> dict[str, Any]:
+        """The session's files with the chunks still missing from each, for resuming the upload."""
+        with self._cond:
+            files = [{**file, "missing": sorted(missing)} for file, missing in zip(self.files, self._missing)]
+            return {
+                "upload_id": self.id,
+                "chunk_size": self.chunk_size,
+                "files": files,
+                "bytes_received": self.bytes_received,
+                "total_bytes": self.total_bytes,
+            }
+
+    def write_chunk(self, index: int, chunk: int, stream: IO[bytes], sha256: str, length: int|None=None) -> bool:
+        """
+        Write one chunk of a file from stream. Raises ChunkError if the chunk is unknown, incomplete or its checksum
+        does not match, in which case it stays missing and can be sent again.
+
+        :param index: file number in the session.
+        :param chunk: chunk number in the file.
+        :param stream: chunk data, ie. `request.stream`. Read READ_SIZE bytes at a time.
+        :param sha256: hex digest of the chunk data.
+        :param length: [Optional] content length of the request, checked against the chunk's size.
+        :return: True if the file is complete.
+        """
+        if not 0 <= index < len(self.files):
+            raise ChunkError(f'Upload {self.id} has no file {index}.')
+        if not 0 <= chunk < self.chunk_count(index):
+            raise ChunkError(f'{self.files[index]["name"]} has no chunk {chunk}.')
+        offset = chunk * self.chunk_size
+        expected = min(self.chunk_size, self.files[index]['size'] - offset)
+        if length is not None and length != expected:
+            raise ChunkError(f'Chunk {chunk} of {self.files[index]["name"]} is {expected} bytes, got {length}.')
+
+        with self._cond:
+            if self.closed:
+                raise ChunkError(f'Upload {self.id} is closed.')
+            if chunk not in self._missing[index]:
+                # Sent again after its acknowledgement was lost
+                return not self._missing[index]
+
+        digest = hashlib.sha256()
+        written = 0
+        with open(self._path(index), 'r+b') as handle:
+            handle.seek(offset)
+            while written < expected:
+                data = stream.read(min(READ_SIZE, expected - written))
+                if not data:
+                    break
+                digest.update(data)
+                handle.write(data)
+                written += len(data)
+        if written != expected:
+            raise ChunkError(f'Chunk {chunk} of {self.files[index]["name"]} ended after {written} of {expected} bytes.')
+        if digest.hexdigest() != str(sha256).lower():
+            raise ChunkError(f'Chunk {chunk} of {self.files[index]["name"]} does not match its checksum.')
+
+        with self._cond:
+            self.updated_at = time.monotonic()
+            if chunk in self._missing[index]:
+                self._missing[index].discard(chunk)
+                self.bytes_received += expected
+                if not self._missing[index]:
+                    self._complete.append(index)
+                self._cond.notify_all()
+            return not self._missing[index]
+
+    def completed(self, idle_timeout: float) -> Iterator[tuple[str, str]]:
+        """
+        Yield each file as soon as its last chunk has arrived, until every file is complete. Stops early if no chunk
+        arrives for idle_timeout seconds or the session is closed, leaving out the files that are still missing chunks.
+
+        :param idle_timeout: seconds to wait for the next chunk.
+        :return: iterator of (uploaded filename, path of the complete file).
+        """
+        n = 0
+        while True:
+            with self._cond:
+                while n >= len(self._complete) and len(self._complete) < len(self.files) and not self.closed:
+                    remaining = idle_timeout - (time.monotonic() - self.updated_at)
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+                if n >= len(self._complete) or self.closed:
+                    return
+                index = self._complete[n]
+            n += 1
+            yield self.files[index]['name'], self._path(index)
+
+    def close(self):
+        """Stop accepting chunks and delete the session's files that were not moved elsewhere."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class UploadSessions:
+    """
+    Chunked upload sessions in progress. Sessions only live as long as the server, their files are kept under root
+    until the job they feed has taken them.
+    """
+
+    def __init__(self, root: str, idle_timeout: float=300.0):
+        """
+        :param root: directory sessions are stored in.
+        :param idle_timeout: [Optional] seconds without a chunk after which a session is abandoned.
+        """
+        self.root = root
+        self.idle_timeout = idle_timeout
+        self._sessions: dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+        # Sessions of an earlier run can't be resumed, their jobs are gone
+        shutil.rmtree(root, ignore_errors=True)
+
+    def create(self, files: Any, chunk_size: int=CHUNK_SIZE) -> UploadSession:
+        """
+        Start a session for a batch of files. Raises ChunkError if the file list or chunk size is invalid.
+
+        :param files: [{"name": filename, "size": bytes}] of each file, as sent by the client.
+        :param chunk_size: [Optional] bytes per chunk, clamped to MIN_CHUNK_SIZE - MAX_CHUNK_SIZE.
+        """
+        if not isinstance(files, list) or not files:
+            raise ChunkError('Expected a list of files to upload.')
+        checked = []
+        for file in files:
+            if not isinstance(file, dict) or not isinstance(file.get('name'), str) or not file['name']:
+                raise ChunkError(f'Invalid file in upload: {file!r}')
+            size = file.get('size')
+            if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                raise ChunkError(f'Invalid size for {file["name"]}: {size!r}')
+            checked.append({"name": file['name'], "size": size})
+        try:
+            chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, int(chunk_size)))
+        except (TypeError, ValueError):
+            raise ChunkError(f'Invalid chunk size: {chunk_size!r}')
+
+        self.prune()
+        session = UploadSession(os.path.join(self.root, uuid.uuid4().hex), checked, chunk_size)
+        with self._lock:
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, upload_id: str) -> UploadSession|None:
+        with self._lock:
+            return self._sessions.get(upload_id)
+
+    def claim(self, upload_id: str) -> UploadSession|None:
+        """Return a session for the job that will process its files, or None if it is unknown or already claimed."""
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is None or session.claimed:
+                return None
+            session.claimed = True
+            return session
+
+    def remove(self, upload_id: str):
+        """Close and forget a session."""
+        with self._lock:
+            session = self._sessions.pop(upload_id, None)
+        if session is not None:
+            session.close()
+
+    def prune(self):
+        """Remove sessions that no job has claimed and that have not received a chunk within the idle timeout."""
+        now = time.monotonic()
+        with self._lock:
+            stale = [upload_id for upload_id, session in self._sessions.items() if not session.claimed and now - session.updated_at > self.idle_timeout]
+        for upload_id in stale:
+            self.remove(upload_id)
@@ -0,0 +1,61 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import importlib
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+
+# Seconds spent importing each module loaded through this module, in import order
+import_times: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def import_module(module_name: str):
+    """Import a module, recording how long the import took if it was not already loaded."""
+    # Always go through importlib, it waits for modules another thread is still initializing
+    loaded = module_name in sys.modules
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if not loaded:
+        with _lock:
+            import_times.setdefault(module_name, time.perf_counter() - started)
+    return module
+
+
+class LazyFunction:
+    """
+    Stand-in for a function whose module is only imported the first time it is called. Used for backends that
+    pull in large libraries so the server can start without them.
+    """
+    __slots__ = ('module_name', 'name', '_fn')
+
+    def __init__(self, module_name: str, name: str):
+        self.module_name = module_name
+        self.name = name
+        self._fn = None
+
+    def resolve(self) -> Callable:
+        """Import the module if needed and return the real function."""
+        if self._fn is None:
+            self._fn = getattr(import_module(self.module_name), self.name)
+        return self._fn
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        return f'<lazy {self.module_name}.{self.name}>'
+
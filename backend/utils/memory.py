@@ -0,0 +1,90 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import sys
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def memory_usage() -> dict[str, int|None]:
+    """
+    Resident memory of this process in bytes: {"rss": current, "peak": highest so far}. Uses psutil if it is
+    installed, otherwise /proc on Linux, the Win32 API on Windows or getrusage elsewhere. Values that can't be
+    read are None.
+    """
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        # Only Windows reports the peak, getrusage has it elsewhere
+        peak = getattr(info, 'peak_wset', None) or _max_rss()
+        return {"rss": info.rss, "peak": max(peak, info.rss) if peak else None}
+    if sys.platform == 'win32':
+        return _windows_memory()
+    rss, peak = _proc_status()
+    if peak is None:
+        peak = _max_rss()
+    return {"rss": rss, "peak": peak}
+
+def _proc_status() -> tuple[int|None, int|None]:
+    """Current and peak resident memory from /proc/self/status, or None where there is no /proc."""
+    values = {}
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    name, value = line.split(':', 1)
+                    values[name] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return values.get('VmRSS'), values.get('VmHWM')
+
+def _max_rss() -> int|None:
+    """Peak resident memory from getrusage, which reports it in kilobytes on Linux and in bytes on macOS."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _windows_memory() -> dict[str, int|None]:
+    """Working set and peak working set of this process from GetProcessMemoryInfo."""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t),
+        ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return {"rss": None, "peak": None}
+    return {"rss": counters.WorkingSetSize, "peak": counters.PeakWorkingSetSize}
+
+def megabytes(size: int|None) -> float|None:
+    """Bytes as megabytes rounded to one decimal, for reports."""
+    return round(size / (1024 * 1024), 1) if size is not None else None
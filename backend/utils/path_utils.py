@@ -11,9 +11,11 @@
 # GNU General Public License for more details.
 #
 # You should have received a copy of the GNU General Public License
+import hashlib
 import os
 from pathlib import Path
 import re
+import tempfile
 from werkzeug.utils import secure_filename
 
 def directory_check(path, create_dir=False):
@@ -73,4 +75,42 @@ def custom_secure_filename(filename: str):
     
     # Sanitize the rest of the filename, if any
     sanitized_part = re.sub(r'[^a-zA-Z0-9._-]', '', filename.replace(preserved_part, ''))
-    return preserved_part + sanitized_part
\ No newline at end of file
+    return preserved_part + sanitized_part
+
+def upload_filename(filename: str, extension: str, skip_do_not_roll: bool=False):
+    """
+    Apply the upload filename rules. Returns the secured filename, or None if the file should be skipped because it
+    is a temporary '~' file, does not have the given extension or, optionally, is marked 'DO NOT ROLL'.
+
+    :param filename: uploaded filename.
+    :param extension: required file extension, ie. '.docx'.
+    :param skip_do_not_roll: [Optional] skip files with 'DO NOT ROLL' in the filename. Default is False.
+    """
+    secured = custom_secure_filename(filename)
+    # Check the original name too, secure_filename strips the leading '~$' of Word lock files
+    if filename.startswith('~') or secured.startswith('~') or not secured.endswith(extension):
+        return None
+    # Secured filenames have spaces replaced with underscores
+    if skip_do_not_roll and 'DO NOT ROLL' in ' '.join(secured.split('_')).upper():
+        return None
+    return secured
+
+def unique_path(directory: str, filename: str) -> str:
+    """
+    Return a path for filename in a new subdirectory of directory, so files of the same name, ie. from different
+    folders of one upload, never overwrite each other.
+    """
+    return os.path.join(tempfile.mkdtemp(dir=directory), filename)
+
+def file_hash(path: str, chunk_size: int=1024 * 1024) -> str:
+    """
+    Return the sha256 hex digest of a file's contents.
+
+    :param path: path to the file.
+    :param chunk_size: [Optional] bytes read at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
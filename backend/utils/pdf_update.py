@@ -0,0 +1,208 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import shutil
+from typing import Any
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, NumberObject, PdfObject, StreamObject
+
+
+# Bytes at the end of a PDF searched for its last 'startxref'
+TAIL_SIZE = 1024
+
+
+class UpdateError(ValueError):
+    """Raised when a PDF can't be changed with an incremental update, ie. because it is encrypted or damaged."""
+
+
+def last_xref(path: str) -> tuple[int, bool]:
+    """
+    Return the offset of a PDF's last cross-reference section and whether it is a cross-reference stream. Only the end
+    of the file and the start of that section are read.
+    """
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(max(0, size - TAIL_SIZE))
+        tail = file.read()
+        index = tail.rfind(b'startxref')
+        if index < 0:
+            raise UpdateError('startxref not found')
+        try:
+            offset = int(tail[index + len(b'startxref'):].split()[0])
+        except (IndexError, ValueError):
+            raise UpdateError('startxref offset is not a number')
+        if not 0 <= offset < size:
+            raise UpdateError(f'startxref offset {offset} is outside the file')
+        file.seek(offset)
+        head = file.read(32).lstrip()
+    if head.startswith(b'xref'):
+        return offset, False
+    # Cross-reference streams start with their object header, ie. '12 0 obj'
+    parts = head.split(None, 3)
+    if len(parts) >= 3 and parts[0].isdigit() and parts[1].isdigit() and parts[2].startswith(b'obj'):
+        return offset, True
+    raise UpdateError(f'No cross-reference section at offset {offset}')
+
+
+def _runs(numbers: list[int]) -> list[tuple[int, int]]:
+    """(first, count) of each run of consecutive object numbers."""
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][0] + runs[-1][1] == number:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((number, 1))
+    return runs
+
+
+class IncrementalUpdate:
+    """
+    Changes to a PDF written as an incremental update: the new and changed objects, a cross-reference section and a
+    trailer are appended after the original bytes, which are copied untouched. Writing and memory cost the size of the
+    changes, not of the document.
+
+    Objects of the original document keep their references. Objects from other PDFs, ie. a signature stamp, are copied
+    in with `import_object`.
+    """
+
+    def __init__(self, reader: PdfReader, source_path: str):
+        """
+        :param reader: reader of source_path, opened on a file object so the document is not read into memory.
+        :param source_path: path of the PDF being updated.
+        """
+        if reader.is_encrypted:
+            raise UpdateError('Encrypted PDFs are not updated incrementally')
+        self.reader = reader
+        self.source_path = source_path
+        self._prev, self._xref_stream = last_xref(source_path)
+        self._size = self._object_count(reader)
+        # Objects to write by object number, with their generation number
+        self._objects: dict[int, tuple[int, PdfObject]] = {}
+        # References of objects already copied from other PDFs
+        self._imported: dict[tuple[int, int, int], IndirectObject] = {}
+
+    @staticmethod
+    def _object_count(reader: PdfReader) -> int:
+        """Trailer /Size, which PyPDF2 leaves out of trailers read from cross-reference streams."""
+        if '/Size' in reader.trailer:
+            return int(reader.trailer['/Size'])
+        numbers = [number for section in reader.xref.values() for number in section]
+        numbers += list(reader.xref_objStm)
+        if not numbers:
+            raise UpdateError('Object count is unknown')
+        return max(numbers) + 1
+
+    def _reserve(self) -> IndirectObject:
+        number = self._size
+        self._size += 1
+        return IndirectObject(number, 0, None)
+
+    def add(self, obj: PdfObject) -> IndirectObject:
+        """Add a new object and return a reference to it."""
+        ref = self._reserve()
+        self._objects[ref.idnum] = (0, obj)
+        return ref
+
+    def replace(self, ref: IndirectObject, obj: PdfObject):
+        """Replace an object of the original document."""
+        self._objects[ref.idnum] = (ref.generation, obj)
+
+    def import_object(self, obj: Any) -> Any:
+        """Copy an object from another PDF, adding every object it references to the update."""
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            ref = self._imported.get(key)
+            if ref is None:
+                # Reserved first so objects that refer back to each other are copied once
+                ref = self._imported[key] = self._reserve()
+                self._objects[ref.idnum] = (0, self.import_object(obj.get_object()))
+            return ref
+        if isinstance(obj, StreamObject):
+            copy = type(obj)()
+            copy._data = obj._data
+            for key, value in obj.items():
+                if key != '/Length':
+                    copy[NameObject(key)] = self.import_object(value)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({NameObject(key): self.import_object(value) for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(value) for value in obj)
+        return obj
+
+    def write(self, output_path: str):
+        """Write the original document followed by the update to output_path."""
+        # Copied by the OS without passing through Python
+        shutil.copyfile(self.source_path, output_path)
+        try:
+            with open(output_path, 'r+b') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) not in (b'\n', b'\r'):
+                    file.write(b'\n')
+                offsets = {}
+                for number in sorted(self._objects):
+                    generation, obj = self._objects[number]
+                    offsets[number] = (file.tell(), generation)
+                    file.write(b'%d %d obj\n' % (number, generation))
+                    obj.write_to_stream(file, None)
+                    file.write(b'\nendobj\n')
+                xref_offset = file.tell()
+                if self._xref_stream:
+                    self._write_xref_stream(file, offsets, xref_offset)
+                else:
+                    self._write_xref_table(file, offsets)
+                file.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+        except BaseException:
+            os.remove(output_path)
+            raise
+
+    def _trailer(self) -> DictionaryObject:
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(self._size),
+            NameObject('/Prev'): NumberObject(self._prev),
+        })
+        for key in ('/Root', '/Info', '/ID'):
+            value = self.reader.trailer.raw_get(key) if key in self.reader.trailer else None
+            if value is not None:
+                trailer[NameObject(key)] = value
+        return trailer
+
+    def _write_xref_table(self, file, offsets: dict[int, tuple[int, int]]):
+        file.write(b'xref\n')
+        for first, count in _runs(sorted(offsets)):
+            file.write(b'%d %d\n' % (first, count))
+            for number in range(first, first + count):
+                offset, generation = offsets[number]
+                file.write(b'%010d %05d n\r\n' % (offset, generation))
+        file.write(b'trailer\n')
+        self._trailer().write_to_stream(file, None)
+        file.write(b'\n')
+
+    def _write_xref_stream(self, file, offsets: dict[int, tuple[int, int]], xref_offset: int):
+        # Documents with cross-reference streams are updated with one, which also lists itself
+        number = self._reserve().idnum
+        offsets[number] = (xref_offset, 0)
+        width = max(1, (xref_offset.bit_length() + 7) // 8)
+        numbers = sorted(offsets)
+        stream = DecodedStreamObject()
+        stream._data = b''.join(b'\x01' + offsets[n][0].to_bytes(width, 'big') + offsets[n][1].to_bytes(2, 'big') for n in numbers)
+        stream.update(self._trailer())
+        stream[NameObject('/Type')] = NameObject('/XRef')
+        stream[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)])
+        stream[NameObject('/Index')] = ArrayObject(NumberObject(value) for run in _runs(numbers) for value in run)
+        file.write(b'%d 0 obj\n' % number)
+        stream.write_to_stream(file, None)
+        file.write(b'\nendobj\n')
@@ -0,0 +1,157 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import csv
+import io
+import re
+from typing import Any, Iterable, Iterator
+from xml.sax.saxutils import escape
+
+from backend.utils.zip_stream import stream_zip
+
+
+# Characters that are not allowed in XML 1.0 documents
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+# Leading characters that make Excel and other spreadsheets read a cell as a formula
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+# Rows written to the worksheet between yields, so compression works on more than one row at a time
+ROWS_PER_CHUNK = 100
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+# Style 0 is the default, style 1 is bold for the header row, style 2 wraps text for multi line cells. Styles 3 and 4
+# are 0 and 2 with a quote prefix, so text that looks like a formula stays text when the cell is edited
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="5">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" applyAlignment="1"><alignment wrapText="1" vertical="top"/></xf>'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" quotePrefix="1"/>'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" applyAlignment="1" quotePrefix="1"><alignment wrapText="1" vertical="top"/></xf>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+
+def _is_formula(value: Any) -> bool:
+    """Whether a text value would be read as a formula by a spreadsheet, ie. '=HYPERLINK(...)' in a client name."""
+    return isinstance(value, str) and value.startswith(_FORMULA_PREFIXES)
+
+
+def _cell(value: Any, style: int=0) -> str:
+    text = _INVALID_XML.sub('', '' if value is None else str(value))
+    if style == 0 and '\n' in text:
+        style = 2
+    if style in (0, 2) and _is_formula(value):
+        style += 3
+    style_attr = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def _sheet_xml(header: list[str], rows: Iterable[list[Any]], widths: list[int]|None) -> Iterator[bytes]:
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        # Keep the header row visible while scrolling
+        '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>'
+    ]
+    if widths:
+        parts.append('<cols>' + ''.join(f'<col min="{i}" max="{i}" width="{width}" customWidth="1"/>' for i, width in enumerate(widths, 1)) + '</cols>')
+    parts.append('<sheetData><row>' + ''.join(_cell(value, 1) for value in header) + '</row>')
+    for count, row in enumerate(rows, 1):
+        parts.append('<row>' + ''.join(_cell(value) for value in row) + '</row>')
+        if count % ROWS_PER_CHUNK == 0:
+            yield ''.join(parts).encode('utf-8')
+            parts.clear()
+    parts.append('</sheetData></worksheet>')
+    yield ''.join(parts).encode('utf-8')
+
+
+def stream_xlsx(header: list[str], rows: Iterable[list[Any]], sheet_name: str='Sheet1', widths: list[int]|None=None) -> Iterator[bytes]:
+    """
+    Generate a single sheet XLSX workbook chunk by chunk. Rows are read lazily and written as inline strings, so memory
+    use does not grow with the number of rows.
+
+    :param header: column names, written in bold as the first row.
+    :param rows: iterable of rows, each a list of cell values. Values are written as text, those that look like
+    formulas with a quote prefix.
+    :param sheet_name: [Optional] name of the worksheet.
+    :param widths: [Optional] width of each column in characters.
+    :return: iterator of workbook bytes.
+    """
+    name = escape(_INVALID_XML.sub('', sheet_name)[:31], {'"': '&quot;'})
+    entries = [
+        ('[Content_Types].xml', lambda: [_CONTENT_TYPES.encode('utf-8')]),
+        ('_rels/.rels', lambda: [_ROOT_RELS.encode('utf-8')]),
+        ('xl/workbook.xml', lambda: [_WORKBOOK.format(name=name).encode('utf-8')]),
+        ('xl/_rels/workbook.xml.rels', lambda: [_WORKBOOK_RELS.encode('utf-8')]),
+        ('xl/styles.xml', lambda: [_STYLES.encode('utf-8')]),
+        ('xl/worksheets/sheet1.xml', lambda: _sheet_xml(header, rows, widths)),
+    ]
+    # Excel warns about zip64 members in small workbooks, a sheet over 2 GB is not expected
+    return stream_zip(entries, zip64=False)
+
+
+def stream_csv(header: list[str], rows: Iterable[list[Any]]) -> Iterator[bytes]:
+    """
+    Generate a UTF-8 CSV file row by row. Starts with a byte order mark so Excel detects the encoding. Text starting
+    with =, +, -, @, a tab or a carriage return is prefixed with ' so it is not run as a formula when the file is opened.
+
+    :param header: column names, written as the first row.
+    :param rows: iterable of rows, each a list of cell values.
+    :return: iterator of CSV bytes.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield '\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(['' if value is None else f"'{value}" if _is_formula(value) else value for value in row])
+        yield buffer.getvalue().encode('utf-8')
@@ -0,0 +1,127 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+from typing import IO, Callable, Iterator
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from backend.utils.path_utils import unique_path
+
+
+class UploadError(ValueError):
+    """Raised when a form field of an upload is too large or invalid."""
+
+
+class StreamingUpload:
+    """
+    Incrementally parse a multipart/form-data request body. Each file part is written to disk while it is received
+    and handed to the caller as soon as it is complete, so processing can start before the upload finishes.
+    Parts that are rejected are discarded without being buffered.
+    """
+    CHUNK_SIZE = 64 * 1024
+    # Large enough for the knownFiles list of a few thousand files
+    MAX_FIELD_SIZE = 1024 * 1024
+
+    def __init__(self, stream: IO[bytes], content_type: str, content_length: int|None=None):
+        """
+        :param stream: request body stream, ie. `request.stream`.
+        :param content_type: request content type header including the multipart boundary.
+        :param content_length: [Optional] request content length, used to report upload progress.
+        """
+        mimetype, options = parse_options_header(content_type)
+        boundary = options.get('boundary')
+        if mimetype != 'multipart/form-data' or not boundary:
+            raise ValueError('Expected a multipart/form-data request with a boundary.')
+
+        self.stream = stream
+        self.content_length = content_length
+        self.bytes_read = 0
+        # Non-file form fields seen so far
+        self.form: dict[str, str] = {}
+        # Fields longer than MAX_FIELD_SIZE, they are left out of form
+        self.oversized: set[str] = set()
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'))
+
+    @property
+    def fraction(self) -> float:
+        """Fraction of the request body received so far. 0 if the content length is unknown."""
+        if not self.content_length:
+            return 0.0
+        return min(1.0, self.bytes_read / self.content_length)
+
+    def _events(self):
+        """Yield decoder events, reading from the stream whenever more data is needed."""
+        ended = False
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                if ended:
+                    raise ValueError('Unexpected end of multipart body.')
+                chunk = self.stream.read(self.CHUNK_SIZE)
+                self.bytes_read += len(chunk)
+                ended = not chunk
+                self._decoder.receive_data(chunk if chunk else None)
+                continue
+            if isinstance(event, Epilogue):
+                return
+            yield event
+
+    def files(self, field_name: str, directory: str, accept: Callable[[str], str|None]) -> Iterator[tuple[str, str]]:
+        """
+        Yield each completed file of field_name as it is received.
+
+        :param field_name: form field name of the file input.
+        :param directory: directory to write accepted files to, each in a subdirectory of its own, see `unique_path`.
+        :param accept: called with the uploaded filename. Returns the filename to save the file as, or None to skip it.
+        :return: iterator of (saved filename, saved file path).
+        """
+        current = None
+        field = None
+        field_data = []
+        try:
+            for event in self._events():
+                if isinstance(event, File):
+                    field = None
+                    if event.name == field_name and event.filename:
+                        filename = accept(os.path.basename(event.filename.replace('\\', '/')))
+                        if filename:
+                            path = unique_path(directory, filename)
+                            current = (filename, path, open(path, 'wb'))
+                elif isinstance(event, Field):
+                    field, field_data = event.name, []
+                elif isinstance(event, Data):
+                    if current is not None:
+                        current[2].write(event.data)
+                        if not event.more_data:
+                            filename, path, handle = current
+                            handle.close()
+                            current = None
+                            yield filename, path
+                    elif field is not None:
+                        if field not in self.oversized:
+                            field_data.append(event.data)
+                            if sum(len(d) for d in field_data) > self.MAX_FIELD_SIZE:
+                                self.oversized.add(field)
+                                field_data = []
+                        if not event.more_data:
+                            if field not in self.oversized:
+                                self.form[field] = b''.join(field_data).decode('utf-8', 'replace')
+                            field = None
+        finally:
+            if current is not None:
+                # Body ended in the middle of a file, drop the partial file
+                current[2].close()
+                os.remove(current[1])
+                os.rmdir(os.path.dirname(current[1]))
@@ -0,0 +1,117 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import shutil
+import time
+from typing import Callable, Iterable, Iterator
+import zipfile
+
+from backend.utils.path_utils import unique_path
+
+
+# Formats that are already compressed and are stored in archives as is
+STORED_EXTENSIONS = {'.docx', '.xlsx', '.pdf', '.zip', '.png', '.jpg', '.jpeg'}
+CHUNK_SIZE = 64 * 1024
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class _ChunkBuffer:
+    """
+    Write-only file object that collects what zipfile writes so it can be yielded. zipfile treats it as
+    unseekable and writes data descriptors instead of seeking back to patch member headers.
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def compress_type_for(filename: str) -> int:
+    """Return ZIP_STORED for formats that are already compressed and ZIP_DEFLATED otherwise."""
+    if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries: Iterable[tuple[str, str|Callable[[], Iterable[bytes]]]], zip64: bool=True) -> Iterator[bytes]:
+    """
+    Generate a zip archive chunk by chunk without writing it anywhere. Entries are read lazily, so the archive can
+    be streamed while its members are still being produced.
+
+    :param entries: iterable of (archive name, source). Source is a file path or a callable returning an iterable of bytes.
+    :param zip64: [Optional] write members from callables with zip64 headers, as their size is not known in advance.
+    Without them each such member is limited to 2 GB. Default is True.
+    :return: iterator of archive bytes.
+    """
+    return (chunk for chunk in _zip_chunks(entries, zip64) if chunk)
+
+
+def _zip_chunks(entries: Iterable[tuple[str, str|Callable[[], Iterable[bytes]]]], zip64: bool) -> Iterator[bytes]:
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for arcname, source in entries:
+            info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+            info.compress_type = compress_type_for(arcname)
+            if isinstance(source, str):
+                size = os.path.getsize(source)
+                info.date_time = time.localtime(os.path.getmtime(source))[:6]
+                with open(source, 'rb') as src, archive.open(info, 'w', force_zip64=size > ZIP64_LIMIT) as dest:
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        yield buffer.drain()
+            else:
+                with archive.open(info, 'w', force_zip64=zip64) as dest:
+                    for chunk in source():
+                        dest.write(chunk)
+                        yield buffer.drain()
+            yield buffer.drain()
+    # Central directory
+    yield buffer.drain()
+
+
+def extract_members(zip_path: str, directory: str, accept: Callable[[str], str|None]) -> Iterator[tuple[str, str]]:
+    """
+    Extract the accepted members of a zip archive one at a time. Folder structure inside the archive is flattened.
+
+    :param zip_path: path to the zip archive.
+    :param directory: directory to extract members to, each in a subdirectory of its own so members of the same name
+    in different folders don't overwrite each other.
+    :param accept: called with each member's filename. Returns the filename to save as, or None to skip the member.
+    :return: iterator of (saved filename, saved file path).
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            filename = accept(os.path.basename(member.filename))
+            if not filename:
+                continue
+            path = unique_path(directory, filename)
+            with archive.open(member) as src, open(path, 'wb') as dest:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+            yield filename, path
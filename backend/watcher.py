@@ -0,0 +1,338 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from concurrent.futures import Future, ProcessPoolExecutor
+import json
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from backend.cli import emit, load_user_config, output_directory, rollover_options, run_file, sign_in_docx
+from backend.utils.path_utils import file_hash, get_full_path, upload_filename
+
+try:
+    # Native file system events, ie. inotify. Falls back to polling if watchdog is not installed.
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+STATE_PATH = 'temp/watch/state.json'
+
+
+def _inside(path: str, directory: str) -> bool:
+    """True if path is directory or anywhere below it."""
+    path, directory = os.path.normcase(os.path.abspath(path)), os.path.normcase(os.path.abspath(directory))
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def process_letter(path: str, directories: dict[str, str], options: dict[str, Any]) -> dict[str, Any]:
+    """
+    Roll over one letter, then optionally print it to PDF, with or without signatures. Runs in a worker process.
+
+    :param directories: output directory of each step to run, keyed by 'rollover', 'print-pdf' and 'print-sign'.
+    :param options: backend options of each step, keyed the same way.
+    """
+    started = time.perf_counter()
+    record = {"type": "result", "command": "watch", "file": path, "outputs": [], "error": None}
+    letter = path
+    for step in ('rollover', 'print-pdf', 'print-sign'):
+        if step not in directories:
+            continue
+        # Both print steps start from the rolled over letter
+        result = run_file(step, letter, directories[step], options.get(step, {}))
+        if result["error"] is not None:
+            record["error"] = f'{step}: {result["error"]}'
+            break
+        if step == 'rollover':
+            letter = result["output"]
+        record["outputs"].append(result["output"])
+    record["seconds"] = round(time.perf_counter() - started, 4)
+    return record
+
+
+class _EventHandler:
+    """Passes watchdog events for files to the watcher."""
+
+    def __init__(self, watcher: 'Watcher'):
+        self.watcher = watcher
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == 'deleted':
+            self.watcher.forget(event.src_path)
+        elif event.event_type == 'moved':
+            self.watcher.forget(event.src_path)
+            self.watcher.touch(event.dest_path)
+        elif event.event_type in ('created', 'modified', 'closed'):
+            self.watcher.touch(event.src_path)
+
+
+class Watcher:
+    """
+    Watch a directory for new or changed engagement letters and process each one once its writes have settled.
+
+    Files are compared to a state file of content hashes, so letters that were already processed are skipped
+    after a restart and a folder scan only hashes files whose size or modification time changed.
+    """
+
+    def __init__(self, source: str, directories: dict[str, str], options: dict[str, Any], workers: int=1,
+                 debounce: float=2.0, poll_interval: float=5.0, state_path: str|None=None,
+                 use_events: bool=True, on_result: Callable[[dict[str, Any]], None]=emit):
+        """
+        :param source: directory to watch, including subdirectories.
+        :param directories: output directory of each step to run, see `process_letter`.
+        :param options: backend options of each step.
+        :param workers: [Optional] number of worker processes.
+        :param debounce: [Optional] seconds a file's size and modification time must stay unchanged before it is processed.
+        :param poll_interval: [Optional] seconds between folder scans when polling.
+        :param state_path: [Optional] path of the state file. Default is temp/watch/state.json.
+        :param use_events: [Optional] use native file system events if watchdog is installed. Default is True.
+        :param on_result: [Optional] called with each result. Default writes JSON lines to stdout.
+        """
+        self.source = os.path.abspath(source)
+        self.directories = directories
+        # Output directories inside the watched directory are skipped, or each rolled over letter would be rolled
+        # over again. An output directory that is the watched directory itself is refused by `run`
+        self.excluded = sorted({os.path.abspath(directory) for directory in directories.values() if _inside(directory, self.source)})
+        self.options = options
+        self.workers = max(1, workers)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.state_path = state_path or get_full_path(STATE_PATH)
+        self.polling = not use_events or Observer is None
+        self.on_result = on_result
+        # Processed files: relative path -> {sha256, size, mtime, outputs, error}
+        self.state: dict[str, dict[str, Any]] = self._load_state()
+        # Files waiting for their writes to settle: path -> (size, mtime, stable since)
+        self._pending: dict[str, tuple[int, int, float]] = {}
+        # Last seen size and modification time of every file, used to detect changes when polling
+        self._seen: dict[str, tuple[int, int]] = {}
+        self._running: dict[str, Future] = {}
+        # Deleted files, removed from the state by the watch loop
+        self._deleted: set[str] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def _load_state(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.state_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        """Write the state file atomically so a crash never leaves it half written."""
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.state, file, indent=4)
+        os.replace(temp_path, self.state_path)
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(path, self.source).replace(os.sep, '/')
+
+    def accepts(self, path: str) -> bool:
+        """Only letters the rollover form would accept are processed, and never the watcher's own outputs."""
+        path = os.path.abspath(path)
+        if not path.startswith(self.source + os.sep) or any(_inside(path, directory) for directory in self.excluded):
+            return False
+        return upload_filename(os.path.basename(path), '.docx', skip_do_not_roll=True) is not None
+
+    def touch(self, path: str):
+        """Mark a file as possibly changed. It is processed once its writes settle."""
+        if not self.accepts(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._pending[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+        self._wake.set()
+
+    def forget(self, path: str):
+        """Mark a file as deleted. It is dropped from the state by the watch loop."""
+        with self._lock:
+            self._deleted.add(os.path.abspath(path))
+        self._wake.set()
+
+    def _remove_deleted(self):
+        with self._lock:
+            deleted, self._deleted = self._deleted, set()
+            for path in deleted:
+                self._pending.pop(path, None)
+                self._seen.pop(path, None)
+        removed = [self.state.pop(self._key(path), None) for path in deleted if not os.path.exists(path)]
+        if any(recorded is not None for recorded in removed):
+            self._save_state()
+
+    def scan(self):
+        """
+        Walk the watched directory and mark files whose size or modification time changed since they were last seen,
+        or since they were processed for the first scan.
+        """
+        seen = {}
+        for root, dirs, files in os.walk(self.source):
+            dirs[:] = [name for name in dirs if not any(_inside(os.path.join(root, name), directory) for directory in self.excluded)]
+            for name in files:
+                path = os.path.join(root, name)
+                if not self.accepts(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                seen[path] = (stat.st_size, stat.st_mtime_ns)
+                previous = self._seen.get(path)
+                if previous is None:
+                    recorded = self.state.get(self._key(path))
+                    previous = (recorded['size'], recorded['mtime']) if recorded else None
+                if previous != seen[path]:
+                    self.touch(path)
+        for path in set(self._seen) - set(seen):
+            self.forget(path)
+        self._seen = seen
+
+    def _settled(self) -> list[str]:
+        """Return pending files whose size and modification time stayed the same for the debounce period."""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (size, mtime, since) in list(self._pending.items()):
+                if path in self._running:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del self._pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                    self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - since >= self.debounce:
+                    del self._pending[path]
+                    ready.append(path)
+        return ready
+
+    def _submit(self, pool: ProcessPoolExecutor, path: str):
+        """Hash a settled file and process it if its contents changed."""
+        try:
+            stat = os.stat(path)
+            digest = file_hash(path)
+        except OSError:
+            # Still locked by the program writing it, try again after another debounce period
+            self.touch(path)
+            return
+        key = self._key(path)
+        recorded = self.state.get(key)
+        if recorded and recorded['sha256'] == digest:
+            # Same contents, only the modification time changed
+            recorded.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+            self._save_state()
+            return
+        future = pool.submit(process_letter, path, self.directories, self.options)
+        future.add_done_callback(lambda _: self._wake.set())
+        with self._lock:
+            self._running[path] = future
+        self.state[key] = {"sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns, "outputs": [], "error": None, "pending": True}
+
+    def _collect(self):
+        """Record finished files in the state and report them."""
+        with self._lock:
+            finished = [(path, future) for path, future in self._running.items() if future.done()]
+            for path, _ in finished:
+                del self._running[path]
+        for path, future in finished:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"type": "result", "command": "watch", "file": path, "outputs": [], "error": str(e), "seconds": 0.0}
+            recorded = self.state.get(self._key(path))
+            if recorded is not None:
+                # Failed files are not retried until their contents change
+                recorded.update(outputs=result["outputs"], error=result["error"])
+                recorded.pop('pending', None)
+            self._save_state()
+            self.on_result(result)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run(self):
+        """Watch until `stop` is called or the process is interrupted."""
+        # Files that were submitted but never finished before the last shutdown are processed again
+        self.state = {key: value for key, value in self.state.items() if not value.get('pending')}
+        observer = None
+        if not self.polling:
+            observer = Observer()
+            observer.schedule(_EventHandler(self), self.source, recursive=True)
+            observer.start()
+        mode = 'polling' if self.polling else 'file system events'
+        self.on_result({"type": "watching", "source": self.source, "mode": mode, "steps": list(self.directories)})
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                # Catch up on changes made while the watcher was not running
+                self.scan()
+                next_scan = time.monotonic() + self.poll_interval
+                while not self._stop.is_set():
+                    self._wake.wait(min(self.debounce / 2, self.poll_interval) or 0.1)
+                    self._wake.clear()
+                    if self.polling and time.monotonic() >= next_scan:
+                        self.scan()
+                        next_scan = time.monotonic() + self.poll_interval
+                    self._remove_deleted()
+                    for path in self._settled():
+                        self._submit(pool, path)
+                    self._collect()
+                # Finish files already submitted
+                for future in list(self._running.values()):
+                    future.exception()
+                self._collect()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+
+def run(args) -> int:
+    """Run the watch command from main.py."""
+    config = load_user_config(args.config)
+    source = args.source or config.get('WATCH_DIRECTORY')
+    if not source or not os.path.isdir(source):
+        emit({"type": "error", "command": "watch", "error": f"Watch directory not found: {source!r}. Pass a directory or set WATCH_DIRECTORY."})
+        return 2
+
+    directories = {'rollover': output_directory('rollover', config)}
+    options = {'rollover': rollover_options(config)}
+    if args.print_pdf:
+        directories['print-pdf'] = output_directory('print-pdf', config)
+    if args.sign:
+        directories['print-sign'] = output_directory('print-sign', config)
+        options['print-sign'] = {"signatures_dir": os.path.abspath(args.signatures), "sign_in_docx": sign_in_docx(args, config)}
+    for step, directory in directories.items():
+        if _inside(directory, source) and _inside(source, directory):
+            emit({"type": "error", "command": "watch", "error": f"The {step} output directory is the watch directory {directory!r}, its outputs would be rolled over again. Choose another directory."})
+            return 2
+
+    watcher = Watcher(source, directories, options, workers=args.workers, debounce=args.debounce,
+                      poll_interval=args.poll_interval, state_path=args.state, use_events=not args.poll)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
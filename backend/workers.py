@@ -0,0 +1,474 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import collections
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Any
+
+from backend import cancellation, tracing
+from backend.fingerprint import hit_rate, template_stats
+from backend.tasks import add_optimization_reports, get_task, optimization_reports
+from backend.tracing import Trace, span
+from backend.utils.memory import megabytes, memory_usage
+
+
+# Seconds a worker is given to stop a cancelled task on its own before it is killed and replaced
+CANCEL_GRACE = 5.0
+# Recycled workers kept in the pool's history, see `WorkerPool.stats`
+RETIRED_HISTORY = 20
+# Tasks that parse letters through the document cache, only they are sent back to the worker that last ran the file
+AFFINITY_TASKS = {'rollover', 'preview', 'extract'}
+# Seconds a file waits for the worker that last ran it, whose caches hold its parsed letter, when another worker is
+# idle, and the number of files whose worker is remembered
+AFFINITY_WAIT = 0.02
+AFFINITY_HISTORY = 10_000
+
+
+def _run_task(conn, cancel_event, task: str, input_path: str, output_dir: str|None, options: dict[str, Any], traced: bool=False):
+    """
+    Run one task in a worker process and send back ('result', result, error, reports, cancelled, memory, templates,
+    trace). trace is the task's spans, see `Trace.to_json`, if the job is traced, otherwise None.
+    """
+    # The server sets cancel_event when the task's job is cancelled, it cancels the task's token here
+    token = cancellation.CancelToken()
+    finished = threading.Event()
+    def watch():
+        while not finished.is_set():
+            if cancel_event.wait(0.1):
+                token.cancel()
+                return
+    threading.Thread(target=watch, name='cancel-watch', daemon=True).start()
+
+    result, error, reports, cancelled = None, None, [], False
+    trace = Trace(task) if traced else None
+    try:
+        with tracing.activate(trace), cancellation.activate(token), optimization_reports() as reports:
+            result, error = get_task(task)(input_path, output_dir, **options)
+    except cancellation.Cancelled:
+        cancelled = True
+    except Exception as e:
+        error = str(e)
+    finally:
+        finished.set()
+    # Free the task's documents before measuring, so the pool sees what the worker holds on to between files
+    gc.collect()
+    conn.send(('result', result, error, reports, cancelled, memory_usage(), template_stats(), trace.to_json() if trace else None))
+
+def _worker_main(conn, cancel_event, init: dict[str, Any]):
+    """
+    Entry point of a worker process. Imports the backends and restores the cache snapshot before reporting ready,
+    then runs tasks sent by the pool until told to stop.
+    """
+    # Ctrl+C and service managers signal the whole process group, workers are stopped by the server once it has
+    # drained, or exit when its end of the pipe closes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    started = time.perf_counter()
+    from backend.utils.lazy_import import import_module
+    errors = []
+    for module_name in init.get('preload', []):
+        try:
+            import_module(module_name)
+        except Exception as e:
+            errors.append(f'Unable to import {module_name}: {e}')
+
+    from backend import converter, snapshot
+    from backend.doc_cache import configure_documents
+    if init.get('convert_lock') is not None:
+        converter.share_convert_lock(init['convert_lock'])
+    if init.get('documents'):
+        configure_documents(*init['documents'])
+    restored = None
+    if init.get('snapshot'):
+        saved, error = snapshot.load_snapshot(init['snapshot'])
+        if error:
+            errors.append(error)
+        elif saved is not None:
+            restored = snapshot.restore(saved)
+    conn.send(('ready', os.getpid(), round(time.perf_counter() - started, 3), restored, errors, memory_usage()))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        if message[0] == 'run':
+            _run_task(conn, cancel_event, *message[1:])
+        elif message[0] == 'snapshot':
+            conn.send(('snapshot', snapshot.collect()))
+
+
+class _Worker:
+    """A worker process of a pool and the pipe to it."""
+
+    def __init__(self, context, index: int, init: dict[str, Any]):
+        self.index = index
+        self.conn, child = context.Pipe()
+        self.cancel_event = context.Event()
+        self.process = context.Process(target=_worker_main, args=(child, self.cancel_event, init), name=f'pel-worker-{index}', daemon=True)
+        self.process.start()
+        child.close()
+        self.pid = self.process.pid
+        self.tasks = 0
+        self.started_at = time.time()
+        # Resident memory after the last task and the highest seen, in bytes, as reported by the worker
+        self.rss: int|None = None
+        self.peak_rss: int|None = None
+        # Template cache statistics of the worker's rollovers, see backend.fingerprint
+        self.templates: dict[str, Any] = {}
+
+    def update_memory(self, memory: dict[str, int|None]):
+        self.rss = memory.get('rss')
+        peaks = [size for size in (self.peak_rss, memory.get('peak'), self.rss) if size is not None]
+        self.peak_rss = max(peaks) if peaks else None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "worker": self.index,
+            "pid": self.pid,
+            "tasks": self.tasks,
+            "alive": self.process.is_alive(),
+            "started": self.started_at,
+            "rss_mb": megabytes(self.rss),
+            "peak_rss_mb": megabytes(self.peak_rss)
+        }
+
+    def stop(self, timeout: float):
+        """Ask the worker to exit after its current task, killing it if it doesn't within timeout seconds."""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes that run tasks from backend.tasks for the scheduler's threads. Workers are started ahead of time
+    with the backends imported and the caches restored, so the first files after a restart are as fast as later ones.
+    Each worker runs one task at a time, a scheduler thread hands it a file and waits for the result. A file goes back
+    to the worker that last ran it, found by the file's sha256, so ie. an entity check and the rollover of the same
+    folder parse each letter once.
+
+    Workers are recycled between files once they have run max_tasks tasks or their resident memory is over
+    max_rss_mb, so memory left behind by backends stays bounded however long a batch is. The replacement starts while
+    the other workers carry on, and the file that took the worker over its limit keeps its result.
+    """
+
+    def __init__(self, size: int, preload: list[str]|None=None, documents: tuple|None=None, snapshot: str|None=None, logger: logging.Logger|None=None,
+                 max_tasks: int|None=None, max_rss_mb: int|None=None):
+        """
+        :param size: number of worker processes, usually the number of scheduler threads.
+        :param preload: [Optional] modules each worker imports before it is ready, see BACKEND_MODULES.
+        :param documents: [Optional] arguments of backend.doc_cache.configure_documents for each worker.
+        :param snapshot: [Optional] path of a cache snapshot each worker restores before it is ready.
+        :param logger: [Optional] logger for workers starting and exiting.
+        :param max_tasks: [Optional] tasks a worker runs before it is replaced. Default never replaces it.
+        :param max_rss_mb: [Optional] resident memory in megabytes after a task above which a worker is replaced.
+        Default never replaces it.
+        """
+        self.size = max(1, size)
+        self.logger = logger or logging.getLogger(__name__)
+        # Workers are started fresh rather than forked from the threaded server, the same on every platform
+        self._context = multiprocessing.get_context('spawn')
+        self._init = {
+            "preload": list(preload or []),
+            "documents": documents,
+            "snapshot": snapshot,
+            "convert_lock": self._context.Lock()
+        }
+        # Idle workers by slot, guarded by _cond
+        self._idle: dict[int, _Worker] = {}
+        # Slot and process id of the worker that last ran each file, by sha256
+        self._affinity: collections.OrderedDict[str, tuple[int, int]] = collections.OrderedDict()
+        self._workers: dict[int, _Worker] = {}
+        self._cond = threading.Condition()
+        self._ready = 0
+        self._closing = False
+        self.max_tasks = max_tasks or None
+        self.max_rss = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+        self.recycled = 0
+        self._retired: collections.deque[dict[str, Any]] = collections.deque(maxlen=RETIRED_HISTORY)
+        # Last cache snapshot of each slot's recycled worker, so recycling doesn't empty the snapshot saved on shutdown
+        self._retired_snapshots: dict[int, dict[str, Any]] = {}
+        # Template cache counts of workers that were recycled or replaced
+        self._retired_templates: dict[str, int] = {}
+
+    def start(self):
+        """Start every worker. Workers become available as each finishes starting, see `wait_ready`."""
+        for index in range(self.size):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        worker = _Worker(self._context, index, self._init)
+        with self._cond:
+            self._workers[index] = worker
+        threading.Thread(target=self._await_ready, args=(worker,), name=f'pel-worker-{index}-start', daemon=True).start()
+
+    def _await_ready(self, worker: _Worker):
+        try:
+            _, pid, seconds, restored, errors, memory = worker.conn.recv()
+        except (EOFError, OSError):
+            self.logger.error(f'Worker process {worker.index} exited while starting')
+            return
+        for error in errors:
+            self.logger.error(f'Worker {worker.index} (pid {pid}): {error}')
+        restored_text = f', restored {restored["documents"]} letter(s) and {restored["rules"]} rule set(s)' if restored else ''
+        worker.update_memory(memory)
+        self.logger.info(f'Worker {worker.index} (pid {pid}) ready in {seconds:.2f}s using {megabytes(worker.rss)} MB{restored_text}')
+        if self.max_rss is not None and worker.rss is not None and worker.rss > self.max_rss:
+            self.logger.warning(f'Worker {worker.index} starts above the {megabytes(self.max_rss)} MB memory limit and is recycled after every file')
+        with self._cond:
+            self._ready += 1
+            self._cond.notify_all()
+        self._release(worker)
+
+    def wait_ready(self, timeout: float|None=None) -> int:
+        """
+        Wait until every worker has started.
+
+        :param timeout: [Optional] seconds to wait. Default waits forever.
+        :return: number of workers ready.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._ready >= self.size, timeout)
+            return self._ready
+
+    def _acquire(self, sha256: str|None=None) -> _Worker:
+        """
+        Wait for an idle worker, giving up with Cancelled if the thread's job is cancelled. If the worker that last ran
+        the file is busy while another is idle, it is waited for up to AFFINITY_WAIT seconds.
+
+        :param sha256: [Optional] hash of the task's input file, None for no preference.
+        """
+        deadline = time.monotonic() + AFFINITY_WAIT
+        with self._cond:
+            preferred = self._affinity.get(sha256) if sha256 else None
+            while True:
+                # A slot whose worker was replaced since has lost the file's cached letter
+                if preferred is not None and (preferred[0] not in self._workers or self._workers[preferred[0]].pid != preferred[1]):
+                    preferred = None
+                if preferred is not None and preferred[0] in self._idle:
+                    return self._idle.pop(preferred[0])
+                remaining = deadline - time.monotonic()
+                if self._idle and (preferred is None or remaining <= 0):
+                    return self._idle.pop(next(iter(self._idle)))
+                self._cond.wait(min(0.1, remaining) if self._idle else 0.1)
+                cancellation.check()
+
+    def _release(self, worker: _Worker):
+        """Return a worker to the idle workers."""
+        with self._cond:
+            self._idle[worker.index] = worker
+            self._cond.notify_all()
+
+    def _remember(self, sha256: str, worker: _Worker):
+        """Record the worker that ran a file, see `_acquire`."""
+        with self._cond:
+            self._affinity[sha256] = (worker.index, worker.pid)
+            self._affinity.move_to_end(sha256)
+            while len(self._affinity) > AFFINITY_HISTORY:
+                self._affinity.popitem(last=False)
+
+    def _retire_templates(self, worker: _Worker):
+        """Keep the template cache counts of a worker leaving the pool. Caller holds the lock."""
+        for name, count in worker.templates.items():
+            if name not in ('templates', 'hit_rate'):
+                self._retired_templates[name] = self._retired_templates.get(name, 0) + count
+
+    def _replace(self, worker: _Worker, reason: str):
+        """Start a new worker in place of one that exited or was killed."""
+        with self._cond:
+            self._retire_templates(worker)
+            self._ready -= 1
+            if self._closing:
+                return
+        self.logger.warning(f'Replacing worker {worker.index} (pid {worker.pid}): {reason}')
+        worker.conn.close()
+        self._spawn(worker.index)
+
+    def _recycle_reason(self, worker: _Worker) -> str|None:
+        """Why the worker should be replaced before its next task, or None if it is within its limits."""
+        if self.max_rss is not None and worker.rss is not None and worker.rss > self.max_rss:
+            return f'using {megabytes(worker.rss)} MB, over the {megabytes(self.max_rss)} MB limit'
+        if self.max_tasks is not None and worker.tasks >= self.max_tasks:
+            return f'ran {worker.tasks} tasks'
+        return None
+
+    def _recycle(self, worker: _Worker, reason: str):
+        """Start a new worker in place of one over its limits and stop the old one once it is out of the pool."""
+        with self._cond:
+            if self._closing:
+                self._release(worker)
+                return
+            self._retire_templates(worker)
+            self._ready -= 1
+            self.recycled += 1
+            self._retired.append({**worker.stats(), "alive": False, "retired": time.time(), "reason": reason})
+        self.logger.info(f'Recycling worker {worker.index} (pid {worker.pid}) after {worker.tasks} task(s), peak {megabytes(worker.peak_rss)} MB: {reason}')
+        self._spawn(worker.index)
+        threading.Thread(target=self._retire, args=(worker,), name=f'pel-worker-{worker.index}-stop', daemon=True).start()
+
+    def _retire(self, worker: _Worker):
+        try:
+            worker.conn.send(('snapshot',))
+            snapshot = worker.conn.recv()[1]
+            with self._cond:
+                self._retired_snapshots[worker.index] = snapshot
+        except (EOFError, OSError) as e:
+            self.logger.warning(f'Unable to read the cache snapshot of recycled worker {worker.index}: {e}')
+        worker.stop(CANCEL_GRACE)
+
+    def run(self, task: str, input_path: str, output_dir: str|None, options: dict[str, Any], trace: Trace|None=None, sha256: str|None=None) -> tuple[Any, str|None, list[dict[str, Any]]]:
+        """
+        Run a task on the next idle worker. Cancelling the thread's job cancels the task in the worker, a worker that
+        doesn't stop within CANCEL_GRACE seconds is killed and replaced.
+
+        :param trace: [Optional] trace of the task's job, the spans the worker records are merged into it.
+        :param sha256: [Optional] hash of the input file, as recorded in the job's journal. AFFINITY_TASKS on a file
+        with a hash prefer the worker that last ran the file, see `_acquire`.
+        :return: (result, error, reports of the PDFs the task optimized).
+        """
+        if task not in AFFINITY_TASKS:
+            sha256 = None
+        worker = self._acquire(sha256)
+        worker.cancel_event.clear()
+        killer = threading.Timer(CANCEL_GRACE, worker.process.kill)
+        killer.daemon = True
+        def cancel():
+            worker.cancel_event.set()
+            killer.start()
+        try:
+            sent = time.perf_counter()
+            worker.conn.send(('run', task, input_path, output_dir, options, trace is not None))
+            with cancellation.on_cancel(cancel):
+                message = worker.conn.recv()
+        except (EOFError, OSError):
+            killer.cancel()
+            if self._closing:
+                # The worker was stopped by `close`, the scheduler leaves the file unfinished in its journal
+                raise cancellation.ShuttingDown()
+            self._replace(worker, 'exited while running a task')
+            cancellation.check()
+            return None, f'Worker process exited while processing {os.path.basename(input_path)}', []
+        killer.cancel()
+        _, result, error, reports, cancelled, memory, templates, worker_trace = message
+        if trace is not None and worker_trace is not None:
+            trace.merge(worker_trace, sent, f'worker {worker.index} (pid {worker.pid})')
+        worker.tasks += 1
+        worker.update_memory(memory)
+        worker.templates = templates
+        reason = self._recycle_reason(worker)
+        if reason:
+            self._recycle(worker, reason)
+        else:
+            if sha256 is not None:
+                self._remember(sha256, worker)
+            self._release(worker)
+        if cancelled:
+            raise cancellation.Cancelled()
+        return result, error, reports
+
+    def snapshots(self) -> list[dict[str, Any]]:
+        """
+        Cache snapshots of the idle workers and the last recycled worker of each slot, see backend.snapshot. Workers
+        still running a task are left out.
+        """
+        with self._cond:
+            snapshots = list(self._retired_snapshots.values())
+            workers = list(self._idle.values())
+            self._idle.clear()
+        for worker in workers:
+            try:
+                worker.conn.send(('snapshot',))
+                snapshots.append(worker.conn.recv()[1])
+            except (EOFError, OSError) as e:
+                self.logger.warning(f'Unable to read the cache snapshot of worker {worker.index}: {e}')
+            self._release(worker)
+        return snapshots
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Process id, tasks run, start time and resident memory after the last task and at its peak of each worker,
+        the limits workers are recycled at and the most recently recycled workers.
+        """
+        with self._cond:
+            workers = list(self._workers.values())
+            retired = list(self._retired)
+        return {
+            "max_tasks": self.max_tasks,
+            "max_rss_mb": megabytes(self.max_rss),
+            "recycled": self.recycled,
+            "workers": [worker.stats() for worker in workers],
+            "retired": retired
+        }
+
+    def template_stats(self) -> dict[str, Any]:
+        """Template cache statistics of every worker, including recycled ones, added together. See backend.fingerprint."""
+        stats = {"letters": 0, "hits": 0, "misses": 0, "fallbacks": 0, "audits": 0, "templates": 0}
+        with self._cond:
+            counts = [self._retired_templates] + [worker.templates for worker in self._workers.values()]
+        for worker_stats in counts:
+            for name, count in worker_stats.items():
+                if name in stats:
+                    stats[name] += count
+        stats['hit_rate'] = hit_rate(stats)
+        return stats
+
+    def close(self, timeout: float=5.0):
+        """
+        Stop every worker. Idle workers exit straight away, workers still running a task are killed after timeout
+        seconds and their files are left unfinished.
+        """
+        with self._cond:
+            self._closing = True
+            workers = list(self._workers.values())
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.stop(max(0.0, deadline - time.monotonic()))
+
+
+class PoolTask:
+    """
+    Stand-in for a task in backend.tasks that runs it on a worker process of a pool. Called like the task itself,
+    the worker reads the input from and writes outputs to the same directories.
+    """
+
+    def __init__(self, pool: WorkerPool, task: str, sha256: str|None=None):
+        """
+        :param sha256: [Optional] hash of the input file, see `WorkerPool.run`.
+        """
+        self.pool = pool
+        self.task = task
+        self.sha256 = sha256
+
+    def __call__(self, input_path: str, output_dir: str|None, **options) -> tuple[Any, str|None]:
+        with span('worker process'):
+            result, error, reports = self.pool.run(self.task, input_path, output_dir, options, tracing.current(), self.sha256)
+        add_optimization_reports(reports)
+        return result, error
+
+    def __repr__(self):
+        return f'<worker {self.task}>'
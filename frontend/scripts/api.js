@@ -169,13 +169,169 @@ class PELApi {
         }
     }
 
+    /**
+     * Add the id of a chunked upload to a process endpoint, the process reads its files from the upload.
+     * @param {string} endpoint
+     * @param {string|null} upload - upload id, or null for files sent in the request body
+     * @returns {string} endpoint
+     */
+    #withUpload(endpoint, upload) {
+        if (!upload) {
+            return endpoint;
+        }
+        return `${endpoint}${endpoint.includes('?') ? '&' : '?'}upload=${encodeURIComponent(upload)}`;
+    }
+
+    /**
+     * Start a chunked upload
+     * @param {Object[]} files - name and size of each file
+     * @param {string} csrf - the csrf token
+     * @returns response object with 'upload_id', 'chunk_size' and the chunks missing from each file in 'files'
+     */
+    async createUpload(files, csrf) {
+        const endpoint = '/uploads';
+        const url = this.apiURL(endpoint);
+        try {
+            const resp = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRF-Token': csrf
+                },
+                body: JSON.stringify({ files })
+            });
+            const respData = await resp.json();
+            return respData;
+        } catch (error) {
+            this.logToServer('error', `An error occurred while starting an upload: ${error}`);
+            console.error(`An error occurred while starting an upload: ${error}`);
+        }
+    }
+
+    /**
+     * Return the chunks the server is still missing from each file of a chunked upload
+     * @param {string} upload - upload id
+     * @returns response object with the chunks missing from each file in 'files'
+     */
+    async uploadStatus(upload) {
+        const endpoint = `/uploads/${encodeURIComponent(upload)}`;
+        const url = this.apiURL(endpoint);
+        try {
+            const resp = await fetch(url);
+            const respData = await resp.json();
+            return respData;
+        } catch (error) {
+            console.error(`An error occurred while checking an upload: ${error}`);
+        }
+    }
+
+    /**
+     * Send one chunk of a file in a chunked upload
+     * @param {string} upload - upload id
+     * @param {number} index - file number in the upload
+     * @param {number} chunk - chunk number in the file
+     * @param {Blob} data - the chunk
+     * @param {string} sha256 - sha256 hex digest of the chunk
+     * @param {string} csrf - the csrf token
+     * @returns response object, with status 'error' if the chunk has to be sent again
+     */
+    async uploadChunk(upload, index, chunk, data, sha256, csrf) {
+        const endpoint = `/uploads/${encodeURIComponent(upload)}/${index}/${chunk}`;
+        const url = this.apiURL(endpoint);
+        try {
+            const resp = await fetch(url, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'X-Chunk-SHA256': sha256,
+                    'X-CSRF-Token': csrf
+                },
+                body: data
+            });
+            const respData = await resp.json();
+            return respData;
+        } catch (error) {
+            // Usually a dropped connection, the chunk is sent again
+            console.warn(`Chunk ${chunk} of file ${index} failed: ${error}`);
+            return { status: 'error', message: String(error) };
+        }
+    }
+
+    /**
+     * Cancel a chunked upload, its process finishes with the files that were complete
+     * @param {string} upload - upload id
+     * @param {string} csrf - the csrf token
+     */
+    async cancelUpload(upload, csrf) {
+        const endpoint = `/uploads/${encodeURIComponent(upload)}`;
+        const url = this.apiURL(endpoint);
+        try {
+            await fetch(url, {
+                method: 'DELETE',
+                headers: {
+                    'X-CSRF-Token': csrf
+                }
+            });
+        } catch (error) {
+            console.error(`An error occurred while cancelling an upload: ${error}`);
+        }
+    }
+
+    /**
+     * Cancel a job, its queued files are dropped and files being processed are stopped
+     * @param {string} jobId - job id
+     * @returns {Promise<Object>} response object, with status 'error' if the job had already finished
+     */
+    cancelJob(jobId) {
+        return new Promise((resolve) => {
+            if (!this.socket) {
+                resolve({ status: 'error', message: 'Not connected to the server.' });
+                return;
+            }
+            // The server acknowledges with the same response as POST /jobs/<job_id>/cancel
+            this.socket.emit('cancel', { job_id: jobId }, resolve);
+        });
+    }
+
+    /**
+     * Ask which files the server already has results for under the current settings
+     * @param {string} process - process name
+     * @param {string[]} hashes - sha256 hex digests of the files about to be uploaded
+     * @param {string} csrf - the csrf token
+     * @param {boolean} sign - print and sign, for the pdf printer
+     * @param {boolean} dryRun - rollover preview, for the rollover
+     * @returns response object with the hashes that have results in 'known'
+     */
+    async knownHashes(process, hashes, csrf, sign = false, dryRun = false) {
+        const endpoint = '/jobs/known-hashes';
+        const url = this.apiURL(endpoint);
+        try {
+            const resp = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRF-Token': csrf
+                },
+                body: JSON.stringify({ process, hashes, sign, dryRun })
+            });
+            const respData = await resp.json();
+            return respData;
+        } catch (error) {
+            this.logToServer('error', `An error occurred while checking for earlier results: ${error}`);
+            console.error(`An error occurred while checking for earlier results: ${error}`);
+        }
+    }
+
     /**
      * Send uploaded files to backend to process engagement letters
      * @param {FormData} formData - Form data for processEngagementLetters form
      * @param {string} csrf - the CSRF token
+     * @param {string|null} upload - id of the chunked upload with the letters, if they are not in formData
+     * @param {boolean} dryRun - only return the changes each letter would get, nothing is written
+     * @returns response object
      */
-    async processLetters(formData, csrf) {
-        const endpoint = '/engagementLetters/document-rollover';
+    async processLetters(formData, csrf, upload = null, dryRun = false) {
+        const endpoint = this.#withUpload(dryRun ? '/engagementLetters/document-rollover?dry_run=1' : '/engagementLetters/document-rollover', upload);
         const url = this.apiURL(endpoint);
         try {
             const resp = await fetch(url, {
@@ -186,13 +342,14 @@ class PELApi {
                 body: formData
             });
             const respData = await resp.json();
-            if (respData.status == 'success') {
+            if (respData.status == 'success' || respData.status == 'cancelled') {
                 console.log(respData.message);
             } else if (respData.status == 'error') {
                 console.error(respData.message);
             } else {
                 console.error(`Unknown error: ${JSON.stringify(respData)}`);
             }
+            return respData;
         } catch (error) {
             this.logToServer('error', `An error occurred while saving settings: ${error}`);
             console.error(`An error occurred while saving settings: ${error}`);
@@ -244,9 +401,11 @@ class PELApi {
      * Send uploaded files to backend to extract entity information
      * @param {FormData} formData - Form data for entityChecker form
      * @param {string} csrf - the CSRF token
+     * @param {string|null} upload - id of the chunked upload with the letters, if they are not in formData
+     * @returns response object with the extracted info of each letter in 'entities'
      */
-    async checkEntities(formData, csrf) {
-        const endpoint = '/entityChecker/check-entities';
+    async checkEntities(formData, csrf, upload = null) {
+        const endpoint = this.#withUpload('/entityChecker/check-entities?format=json', upload);
         const url = this.apiURL(endpoint);
         try {
             const resp = await fetch(url, {
@@ -256,22 +415,51 @@ class PELApi {
                 },
                 body: formData
             });
-            const respText = await resp.text();
-            return respText.trim();
+            const respData = await resp.json();
+            return respData;
         } catch (error) {
             this.logToServer('error', `An error occurred while checking entities: ${error}`);
             console.error(`An error occurred while checking entities: ${error}`);
         }
     }
 
+    /**
+     * Compare the entities of two entity checks
+     * @param {string} prior - job id of the prior year's entity check
+     * @param {string} current - job id of the current year's entity check
+     * @param {string} csrf - the CSRF token
+     * @returns response object with the matched letters and their added, removed and changed entities
+     */
+    async reconcileEntities(prior, current, csrf) {
+        const endpoint = '/entityChecker/reconcile';
+        const url = this.apiURL(endpoint);
+        try {
+            const resp = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRF-Token': csrf
+                },
+                body: JSON.stringify({ prior, current })
+            });
+            const respData = await resp.json();
+            return respData;
+        } catch (error) {
+            this.logToServer('error', `An error occurred while comparing entities: ${error}`);
+            console.error(`An error occurred while comparing entities: ${error}`);
+        }
+    }
+
     /**
      * Send uploaded files to backend to be printed to pdf
      * @param {FormData} formData - Form data for pdfPrinter form
      * @param {string} csrf - the csrf token
+     * @param {boolean} sign - add partner signatures while printing
+     * @param {string|null} upload - id of the chunked upload with the letters, if they are not in formData
      * @returns 
      */
-    async printToPdf(formData, csrf) {
-        const endpoint = '/pdfPrinter/print-to-pdf';
+    async printToPdf(formData, csrf, sign = false, upload = null) {
+        const endpoint = this.#withUpload(sign ? '/pdfPrinter/print-to-pdf?sign=1' : '/pdfPrinter/print-to-pdf', upload);
         const url = this.apiURL(endpoint);
         try {
             const resp = await fetch(url, {
@@ -293,10 +481,11 @@ class PELApi {
      * Send uploaded df files to have signatures added to them
      * @param {FormData} formData - the form data for pdfSignatures form data
      * @param {string} csrf - the csrf token
+     * @param {string|null} upload - id of the chunked upload with the pdfs, if they are not in formData
      * @returns response object
      */
-    async addSignature(formData, csrf) {
-        const endpoint = '/pdfSignatures/add-signatures';
+    async addSignature(formData, csrf, upload = null) {
+        const endpoint = this.#withUpload('/pdfSignatures/add-signatures', upload);
         const url = this.apiURL(endpoint);
         try {
             const resp = await fetch(url, {
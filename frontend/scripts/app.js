@@ -12,7 +12,26 @@ GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License */
 import { api } from '../scripts/api.js';
-import { AlertModal, AlertStatus } from '../scripts/ui.js';
+import { AlertModal, AlertStatus, FrameBatcher, VirtualList } from '../scripts/ui.js';
+
+// Upload field and filename rules of each process, see backend.utils.path_utils.upload_filename
+const UPLOAD_RULES = {
+    processEngagementLetters: { field: 'currentYearDirectory', extension: '.docx', skipDoNotRoll: true },
+    entityChecker: { field: 'entityCheckDirectory', extension: '.docx', skipDoNotRoll: false },
+    pdfPrinter: { field: 'pdfPrintDirectory', extension: '.docx', skipDoNotRoll: false },
+    pdfSignatures: { field: 'pdfSignaturesDirectory', extension: '.pdf', skipDoNotRoll: false }
+};
+// Number of files hashed at the same time before uploading
+const HASH_CONCURRENCY = 8;
+// Batches of at least this many bytes are sent as a resumable chunked upload, see #sendUpload
+const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024;
+// Chunks sent at the same time, leaving browser connections for the process request and socket
+const CHUNK_CONCURRENCY = 3;
+// Rounds of retries without any chunk getting through before an upload is given up
+const CHUNK_RETRIES = 8;
+
+// Compares names with numbers in numeric order, much faster than localeCompare when sorting thousands of rows
+const collator = new Intl.Collator(undefined, { numeric: true, sensitivity: 'base' });
 
 class PELApp {
     static #instance
@@ -35,6 +54,24 @@ class PELApp {
         // format {"error": "error_name", "message": "error_message", "process": "process_name", "method": "method_name"}
         this.lastExecutionError = null;
 
+        // Results and progress events are applied once per animation frame
+        this.resultsBatcher = new FrameBatcher((results) => this.#applyResults(results));
+        this.progressBatcher = new FrameBatcher((progress) => {
+            // Only the latest progress of a frame is shown
+            this.progress = progress[progress.length - 1];
+            this.setProgress();
+        });
+        // VirtualList of results for each process, by process name
+        this.resultLists = {};
+        // Number of results received, used to keep arrival order
+        this.resultCount = 0;
+        // VirtualList of the entity check table
+        this.entityList = null;
+        // Cancelled flag of the chunked upload being sent for each process, by process name
+        this.uploadCancels = {};
+        // Entity checks run on this page, format {"jobId": "job_id", "label": "folder name", "letters": number}
+        this.entityChecks = [];
+
         // property names to inject into document
         this.propNames = [
             '--primary',
@@ -72,6 +109,529 @@ class PELApp {
         alertPlaceholder.appendChild(alert);
     }
 
+    /**
+     * Return the results list of a process, creating it on first use. Returns null if the page has no results for the process.
+     * @param {string} process process name
+     * @returns {VirtualList|null}
+     */
+    #resultList(process) {
+        if (process in this.resultLists) {
+            return this.resultLists[process];
+        }
+        const container = document.getElementById(`${process}-results`);
+        if (container === null) {
+            return null;
+        }
+        const countEl = document.getElementById(`${process}-resultsCount`);
+        const list = new VirtualList(container, {
+            rowHeight: 24,
+            createRow: () => {
+                const row = document.createElement('div');
+                row.className = 'results-row';
+                return row;
+            },
+            renderRow: (row, result) => {
+                row.className = `results-row ${result.status === 'success' ? 'success-text' : 'error-text'}`;
+                row.textContent = `${result.status === 'success' ? 'Processed' : 'Failed'}: ${result.filename}`;
+            },
+            onChange: (shown) => {
+                if (countEl !== null) {
+                    countEl.textContent = shown === list.items.length ? `${shown} results` : `${shown} of ${list.items.length} results`;
+                }
+            }
+        });
+        this.resultLists[process] = list;
+
+        // Filter and sort controls
+        const filterEl = document.getElementById(`${process}-resultsFilter`);
+        const statusEl = document.getElementById(`${process}-resultsStatus`);
+        const sortEl = document.getElementById(`${process}-resultsSort`);
+        const applyFilter = () => {
+            const text = filterEl !== null ? filterEl.value.trim().toLowerCase() : '';
+            const status = statusEl !== null ? statusEl.value : 'all';
+            if (text === '' && status === 'all') {
+                list.setFilter(null);
+            } else {
+                list.setFilter((result) => (status === 'all' || result.status === status) && (text === '' || result.key.includes(text)));
+            }
+        };
+        if (filterEl !== null) filterEl.addEventListener('input', applyFilter);
+        if (statusEl !== null) statusEl.addEventListener('change', applyFilter);
+        if (sortEl !== null) {
+            sortEl.addEventListener('change', () => {
+                const compares = {
+                    filename: (a, b) => collator.compare(a.key, b.key),
+                    // Failed files first
+                    status: (a, b) => (a.status === b.status ? a.seq - b.seq : a.status === 'failed' ? -1 : 1)
+                };
+                list.setSort(compares[sortEl.value] || null);
+            });
+        }
+        return list;
+    }
+
+    /**
+     * Add a frame's worth of process-results events to the results lists.
+     * @param {Object[]} results event details
+     */
+    #applyResults(results) {
+        const byProcess = {};
+        for (const result of results) {
+            (byProcess[result.process] ||= []).push({
+                status: result.status,
+                filename: result.filename,
+                key: String(result.filename).toLowerCase(),
+                seq: this.resultCount++
+            });
+        }
+        for (const [process, items] of Object.entries(byProcess)) {
+            const list = this.#resultList(process);
+            if (list !== null) {
+                list.append(items);
+            }
+        }
+    }
+
+    /**
+     * Show extracted entity info in the entity check table. Only the rows in view are rendered, clicking a row shows
+     * its address and entities below the table.
+     * @param {Object[]} entities extracted info of each letter, see backend.extractor.process_document
+     */
+    #showEntities(entities) {
+        const container = document.getElementById('entityChecker-rows');
+        const details = document.getElementById('entityChecker-details');
+        const countEl = document.getElementById('entityChecker-count');
+        if (this.entityList === null) {
+            this.entityList = new VirtualList(container, {
+                rowHeight: 36,
+                createRow: () => {
+                    const row = document.createElement('div');
+                    row.className = 'virtual-table-row clickable-row';
+                    for (let i = 0; i < 3; i++) {
+                        row.appendChild(document.createElement('span'));
+                    }
+                    return row;
+                },
+                renderRow: (row, item) => {
+                    row.children[0].textContent = item.filename;
+                    row.children[1].textContent = item.address.replace(/\n/g, ', ');
+                    row.children[2].textContent = item.entities.length;
+                },
+                onChange: (shown) => {
+                    const total = this.entityList.items.length;
+                    countEl.textContent = shown === total ? `${shown} letters` : `${shown} of ${total} letters`;
+                }
+            });
+            container.addEventListener('click', (event) => {
+                const row = event.target.closest('.virtual-table-row');
+                if (row === null) {
+                    return;
+                }
+                this.#showEntityDetails(details, this.entityList.itemAt(Number(row.dataset.index)));
+            });
+
+            const filterEl = document.getElementById('entityChecker-filter');
+            filterEl.addEventListener('input', () => {
+                const text = filterEl.value.trim().toLowerCase();
+                this.entityList.setFilter(text === '' ? null : (item) => item.key.includes(text));
+            });
+            const sortEl = document.getElementById('entityChecker-sort');
+            sortEl.addEventListener('change', () => {
+                const compares = {
+                    filename: (a, b) => collator.compare(a.filename, b.filename),
+                    address: (a, b) => collator.compare(a.address, b.address),
+                    entities: (a, b) => b.entities.length - a.entities.length
+                };
+                this.entityList.setSort(compares[sortEl.value] || null);
+            });
+        }
+
+        details.hidden = true;
+        this.entityList.clear();
+        this.entityList.append(entities.map((item) => ({
+            ...item,
+            // Text searched by the filter
+            key: [item.filename, item.address, ...item.entities.map((entity) => entity.name_of_entity)].join('\n').toLowerCase()
+        })));
+    }
+
+    /**
+     * Show the address and entities of one letter.
+     * @param {HTMLElement} details details element
+     * @param {Object} item extracted info of the letter
+     */
+    #showEntityDetails(details, item) {
+        details.innerHTML = '';
+        const title = document.createElement('h4');
+        title.className = 'title is-4';
+        title.textContent = item.filename;
+        const address = document.createElement('p');
+        address.className = 'entity-address';
+        address.textContent = item.address;
+        const list = document.createElement('ul');
+        for (const entity of item.entities) {
+            const listItem = document.createElement('li');
+            listItem.textContent = `${entity.name_of_entity}: ${entity.type_of_return}`;
+            list.appendChild(listItem);
+        }
+        details.append(title, address, list);
+        details.hidden = false;
+    }
+
+    /**
+     * Offer to compare the latest entity check with an earlier check run on this page, ie. last year's letters.
+     * @param {string} csrf the CSRF token
+     */
+    #showReconcileOptions(csrf) {
+        const container = document.getElementById('entityChecker-reconcile');
+        if (container === null || this.entityChecks.length < 2) {
+            return;
+        }
+        const current = this.entityChecks[this.entityChecks.length - 1];
+        container.innerHTML = '';
+        const label = document.createElement('label');
+        label.textContent = `Compare ${current.label} with `;
+        const select = document.createElement('select');
+        select.className = 'input';
+        for (const check of this.entityChecks.slice(0, -1).reverse()) {
+            const option = document.createElement('option');
+            option.value = check.jobId;
+            option.textContent = `${check.label} (${check.letters} letters)`;
+            select.appendChild(option);
+        }
+        label.appendChild(select);
+        const button = document.createElement('button');
+        button.className = 'btn btn-secondary';
+        button.type = 'button';
+        button.textContent = 'Compare Entities';
+        const results = document.createElement('div');
+        button.addEventListener('click', async () => {
+            button.disabled = true;
+            const resp = await api.reconcileEntities(select.value, current.jobId, csrf);
+            button.disabled = false;
+            if (resp && resp.status == 'success') {
+                this.#showReconciliation(results, resp);
+            } else {
+                console.error(resp ? resp.message : 'Could not compare entities');
+            }
+        });
+        container.append(label, button, results);
+        container.hidden = false;
+    }
+
+    /**
+     * Show the entities added, removed and changed between two entity checks. Letters are only listed by name until
+     * they are opened, so comparisons of thousands of letters stay responsive.
+     * @param {HTMLElement} container element to show the comparison in
+     * @param {Object} report response of /entityChecker/reconcile
+     */
+    #showReconciliation(container, report) {
+        container.innerHTML = '';
+        const summary = report.summary;
+        const text = document.createElement('p');
+        text.textContent = `${summary.matched} letters matched, ${summary.changed_letters} with changed entities: `
+            + `${summary.added} added, ${summary.removed} removed, ${summary.changed} with a new return type. `
+            + `${summary.missing_entities} prior year entities are missing from the current letters.`;
+        container.appendChild(text);
+
+        const entityText = (entity) => `${entity.name_of_entity}: ${entity.type_of_return}`;
+        const groups = [
+            [report.letters, 'with changed entities', (letter) => `${letter.prior} → ${letter.current}`, (letter) => [
+                ...letter.removed.map((entity) => ['error-text', `Removed ${entityText(entity)}`]),
+                ...letter.added.map((entity) => ['success-text', `Added ${entityText(entity)}`]),
+                ...letter.changed.map((entity) => ['', `${entity.name_of_entity}: ${entity.prior_type} → ${entity.current_type}`])
+            ]],
+            [report.prior_only, 'only in the prior year', (letter) => letter.filename, (letter) => letter.entities.map((entity) => ['error-text', entityText(entity)])],
+            [report.current_only, 'only in the current year', (letter) => letter.filename, (letter) => letter.entities.map((entity) => ['success-text', entityText(entity)])],
+            [[...report.failed.prior, ...report.failed.current], 'could not be read', (failure) => `${failure.filename}: ${failure.error}`, () => []]
+        ];
+        for (const [letters, description, title, lines] of groups) {
+            if (letters.length === 0) {
+                continue;
+            }
+            const group = document.createElement('details');
+            const groupTitle = document.createElement('summary');
+            groupTitle.textContent = `${letters.length} ${letters.length === 1 ? 'letter' : 'letters'} ${description}`;
+            group.appendChild(groupTitle);
+            group.addEventListener('toggle', () => {
+                if (!group.open || group.childElementCount > 1) {
+                    return;
+                }
+                const list = document.createElement('ul');
+                for (const letter of letters) {
+                    const item = document.createElement('li');
+                    const name = document.createElement('strong');
+                    name.textContent = title(letter);
+                    item.appendChild(name);
+                    for (const [className, line] of lines(letter)) {
+                        const span = document.createElement('span');
+                        span.className = className;
+                        span.textContent = line;
+                        item.appendChild(span);
+                    }
+                    list.appendChild(item);
+                }
+                group.appendChild(list);
+            });
+            container.appendChild(group);
+        }
+    }
+
+    /**
+     * Show the changes a rollover preview found. The changes of a letter are only rendered when it is opened, so
+     * previews of a whole folder stay responsive.
+     * @param {Object} preview response of a dry run rollover, with 'files', 'skipped' and 'failed'
+     */
+    #showPreview(preview) {
+        const container = document.getElementById('processEngagementLetters-preview');
+        if (container === null) {
+            return;
+        }
+        container.innerHTML = '';
+        const summary = document.createElement('p');
+        summary.textContent = preview.message;
+        container.appendChild(summary);
+
+        for (const file of preview.files) {
+            const details = document.createElement('details');
+            const title = document.createElement('summary');
+            title.textContent = `${file.filename} (${file.changes.length} ${file.changes.length === 1 ? 'change' : 'changes'})`;
+            details.appendChild(title);
+            details.addEventListener('toggle', () => {
+                if (!details.open || details.childElementCount > 1) {
+                    return;
+                }
+                const list = document.createElement('ul');
+                for (const change of file.changes) {
+                    const item = document.createElement('li');
+                    const rules = document.createElement('strong');
+                    rules.textContent = `Paragraph ${change.paragraph + 1} (${change.rules.join(', ')})`;
+                    const before = document.createElement('del');
+                    before.className = 'error-text';
+                    before.textContent = change.text;
+                    const after = document.createElement('ins');
+                    after.className = 'success-text';
+                    after.textContent = change.new_text;
+                    item.append(rules, before, after);
+                    list.appendChild(item);
+                }
+                details.appendChild(list);
+            });
+            container.appendChild(details);
+        }
+
+        const lists = [
+            [preview.skipped, 'would not be updated', (name) => name],
+            [preview.failed, 'could not be read', (failure) => `${failure.filename}: ${failure.error}`]
+        ];
+        for (const [items, text, format] of lists) {
+            if (items.length === 0) {
+                continue;
+            }
+            const details = document.createElement('details');
+            const title = document.createElement('summary');
+            title.textContent = `${items.length} ${items.length === 1 ? 'letter' : 'letters'} ${text}`;
+            const list = document.createElement('ul');
+            for (const item of items) {
+                const listItem = document.createElement('li');
+                listItem.textContent = format(item);
+                list.appendChild(listItem);
+            }
+            details.append(title, list);
+            container.appendChild(details);
+        }
+        container.hidden = false;
+    }
+
+    /**
+     * Check a filename against the server's upload rules.
+     * @param {string} name filename
+     * @param {Object} rules upload rules of the process, see UPLOAD_RULES
+     * @returns {boolean} true if the server would accept the file
+     */
+    #acceptUpload(name, rules) {
+        if (name.startsWith('~') || !name.endsWith(rules.extension)) {
+            return false;
+        }
+        return !(rules.skipDoNotRoll && name.replace(/_/g, ' ').toUpperCase().includes('DO NOT ROLL'));
+    }
+
+    /**
+     * Return the sha256 hex digest of a file or chunk.
+     * @param {Blob} blob
+     * @returns {Promise<string>}
+     */
+    async #sha256(blob) {
+        const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    /**
+     * Return the sha256 hex digest of each file.
+     * @param {File[]} files
+     * @returns {Promise<string[]>}
+     */
+    async #hashFiles(files) {
+        const hashes = new Array(files.length);
+        let next = 0;
+        const hashNext = async () => {
+            while (next < files.length) {
+                const i = next++;
+                hashes[i] = await this.#sha256(files[i]);
+            }
+        };
+        await Promise.all(Array.from({ length: Math.min(HASH_CONCURRENCY, files.length) }, hashNext));
+        return hashes;
+    }
+
+    /**
+     * Leave out files the server would skip and files it already has results for under the current settings. Files
+     * with earlier results are listed in the 'knownFiles' field so their results are still reported.
+     * @param {string} process process name
+     * @param {FormData} formData form data without the csrf token
+     * @param {string} csrf the csrf token
+     * @param {boolean} sign print and sign, for the pdf printer
+     * @param {boolean} dryRun rollover preview, for the rollover
+     * @returns {Promise<FormData>} form data to upload
+     */
+    async #prepareUpload(process, formData, csrf, sign = false, dryRun = false) {
+        const rules = UPLOAD_RULES[process];
+        const files = formData.getAll(rules.field).filter((file) => file instanceof File && file.name);
+        // Archives are extracted by the server and always uploaded
+        const archives = files.filter((file) => file.name.toLowerCase().endsWith('.zip') && !file.name.startsWith('~'));
+        const letters = files.filter((file) => this.#acceptUpload(file.name, rules));
+
+        const known = [];
+        let missing = letters;
+        // Hashing needs a secure context (https or localhost), otherwise every accepted file is uploaded
+        if (letters.length > 0 && window.crypto && crypto.subtle) {
+            const hashes = await this.#hashFiles(letters);
+            const resp = await api.knownHashes(process, [...new Set(hashes)], csrf, sign, dryRun);
+            if (resp && resp.status == 'success') {
+                const knownHashes = new Set(resp.known);
+                missing = [];
+                letters.forEach((file, i) => {
+                    if (knownHashes.has(hashes[i])) {
+                        known.push({ name: file.name, sha256: hashes[i] });
+                    } else {
+                        missing.push(file);
+                    }
+                });
+            }
+        }
+
+        const upload = new FormData();
+        // Listed before the files
+        upload.append('knownFiles', JSON.stringify(known));
+        for (const [name, value] of formData.entries()) {
+            if (name !== rules.field) {
+                upload.append(name, value);
+            }
+        }
+        const sent = missing.concat(archives);
+        sent.forEach((file) => upload.append(rules.field, file));
+
+        const totalBytes = files.reduce((total, file) => total + file.size, 0);
+        const sentBytes = sent.reduce((total, file) => total + file.size, 0);
+        api.logToServer('info', `Uploading ${sent.length} of ${files.length} files for ${process} (${files.length - letters.length - archives.length} skipped by filename, ${known.length} with earlier results), ${sentBytes} of ${totalBytes} bytes`);
+        return upload;
+    }
+
+    /**
+     * Send an upload form with request. Large batches are sent as a chunked upload alongside the request, so a dropped
+     * connection only costs the chunks in flight. Smaller batches, or browsers that can't hash, post the files in the
+     * request itself.
+     * @param {string} process process name
+     * @param {FormData} formData form data from #prepareUpload
+     * @param {string} csrf the csrf token
+     * @param {function(FormData, string|null): Promise} request sends the form, with the id of a chunked upload
+     * @returns {Promise} the response of request
+     */
+    async #sendUpload(process, formData, csrf, request) {
+        const field = UPLOAD_RULES[process].field;
+        const files = formData.getAll(field).filter((file) => file instanceof File);
+        const totalBytes = files.reduce((total, file) => total + file.size, 0);
+        if (totalBytes < CHUNKED_UPLOAD_THRESHOLD || !(window.crypto && crypto.subtle)) {
+            return request(formData, null);
+        }
+
+        const upload = await api.createUpload(files.map((file) => ({ name: file.name, size: file.size })), csrf);
+        if (!upload || upload.status != 'success') {
+            return request(formData, null);
+        }
+        // The process reads the files from the upload as each one completes
+        formData.delete(field);
+        const response = request(formData, upload.upload_id);
+        const cancel = { cancelled: false };
+        this.uploadCancels[process] = cancel;
+        const sent = await this.#sendChunks(upload, files, csrf, cancel);
+        if (cancel.cancelled) {
+            // The server closed the upload when the job was cancelled
+            return response;
+        }
+        if (!sent) {
+            api.logToServer('error', `Gave up on upload ${upload.upload_id} for ${process}, processing the files that were complete`);
+            await api.cancelUpload(upload.upload_id, csrf);
+        }
+        return response;
+    }
+
+    /**
+     * Send the missing chunks of a chunked upload. Failed chunks are retried with backoff, resuming from the chunks
+     * the server has acknowledged.
+     * @param {Object} upload upload status from the server, with 'upload_id', 'chunk_size' and 'files'
+     * @param {File[]} files the upload's files, in the order they were listed
+     * @param {string} csrf the csrf token
+     * @param {{cancelled: boolean}} cancel set when the job is cancelled, no more chunks are sent
+     * @returns {Promise<boolean>} true once every chunk has been acknowledged
+     */
+    async #sendChunks(upload, files, csrf, cancel) {
+        const missing = (status) => status.files.flatMap((file, index) => file.missing.map((chunk) => ({ index, chunk })));
+        let queue = missing(upload);
+        let retries = 0;
+        while (queue.length > 0) {
+            const failed = [];
+            let next = 0;
+            const sendNext = async () => {
+                while (next < queue.length && !cancel.cancelled) {
+                    const { index, chunk } = queue[next++];
+                    const start = chunk * upload.chunk_size;
+                    const data = files[index].slice(start, start + upload.chunk_size);
+                    const resp = await api.uploadChunk(upload.upload_id, index, chunk, data, await this.#sha256(data), csrf);
+                    if (!resp || resp.status != 'success') {
+                        failed.push({ index, chunk });
+                    }
+                }
+            };
+            await Promise.all(Array.from({ length: Math.min(CHUNK_CONCURRENCY, queue.length) }, sendNext));
+            if (failed.length === 0 || cancel.cancelled) {
+                return failed.length === 0;
+            }
+
+            // Only give up after several rounds in a row where nothing got through
+            retries = failed.length < queue.length ? 1 : retries + 1;
+            if (retries > CHUNK_RETRIES) {
+                return false;
+            }
+            await new Promise((resolve) => setTimeout(resolve, Math.min(30000, 1000 * 2 ** (retries - 1))));
+            const status = await api.uploadStatus(upload.upload_id);
+            queue = status && status.status == 'success' ? missing(status) : failed;
+        }
+        return true;
+    }
+
+    /**
+     * Remove the cancel button of a process once its job has finished or was cancelled.
+     * @param {string} process process name
+     */
+    #removeCancelButton(process) {
+        const container = document.getElementById(`${process}-download`);
+        const button = container !== null ? container.querySelector('.cancel-job') : null;
+        if (button !== null) {
+            button.remove();
+        }
+    }
+
     /**
      * Add custom event listeners to handle socket io events.
      */
@@ -99,6 +659,7 @@ class PELApp {
 
         api.addCustomEventListener('complete', (event) => {
             // format "detail": "message"
+            this.#removeCancelButton(this.runningProcess.process);
             if (this.alertStatus.alert !== null) {
                 this.alertStatus.deleteAlert();
             }
@@ -109,8 +670,7 @@ class PELApp {
 
         api.addCustomEventListener('progress', (event) => {
             // format "detail": {"process": "process_name", "value": number}
-            this.progress = event.detail;
-            this.setProgress();
+            this.progressBatcher.push(event.detail);
         });
 
         api.addCustomEventListener('process-error', (event) => {
@@ -145,17 +705,60 @@ class PELApp {
         });
 
         api.addCustomEventListener('process-results', (event) => {
-            const resultContainer = document.getElementById(`${event.detail.process}-results`);
-            const fileStatus = event.detail.status;
-            const filename = event.detail.filename;
-
-            const listItem = document.createElement('li');
-            listItem.className = fileStatus === 'success' ? 'success-text' : 'error-text';
-            listItem.textContent = `${fileStatus === 'success' ? 'Processed' : 'Failed'}: ${filename}`;
+            // format "detail": {"process": "process_name", "status": "success" | "failed", "filename": "filename"}
+            this.resultsBatcher.push(event.detail);
+        });
 
-            console.log(listItem);
+        api.addCustomEventListener('cancelled', (event) => {
+            // format "detail": {"process": "process_name", "job_id": "job_id", "message": "display_message"}
+            this.#removeCancelButton(event.detail.process);
+            if (this.alertStatus.alert !== null) {
+                this.alertStatus.hideAlert();
+                this.alertStatus.deleteAlert();
+            }
+            this.alertStatus.createAlert(event.detail.message, ['alert-info']);
+            this.sendAlert(`${event.detail.process}-alertPlaceholder`, this.alertStatus.getAlert());
+            this.alertStatus.showAlert();
+        });
 
-            resultContainer.appendChild(listItem);
+        api.addCustomEventListener('job', (event) => {
+            // format "detail": {"process": "process_name", "job_id": "job_id", "download": "download_url", "export": "export_url" optional}
+            const downloadContainer = document.getElementById(`${event.detail.process}-download`);
+            if (downloadContainer === null) {
+                return;
+            }
+            downloadContainer.innerHTML = '';
+            // Entity checks have no output files, their results are exported as a table instead. Rollover previews have neither.
+            const links = event.detail.dry_run
+                ? []
+                : event.detail.export
+                ? [[`${event.detail.export}?format=csv`, 'Export results (.csv)'], [`${event.detail.export}?format=xlsx`, 'Export results (.xlsx)']]
+                : [[event.detail.download, 'Download results (.zip)']];
+            for (const [url, text] of links) {
+                const link = document.createElement('a');
+                link.href = api.apiURL(url);
+                link.textContent = text;
+                link.className = 'btn btn-primary';
+                downloadContainer.appendChild(link);
+            }
+            const process = event.detail.process;
+            const cancelButton = document.createElement('button');
+            cancelButton.type = 'button';
+            cancelButton.textContent = 'Cancel';
+            cancelButton.className = 'btn btn-secondary cancel-job';
+            cancelButton.addEventListener('click', async () => {
+                cancelButton.disabled = true;
+                // Stop sending chunks straight away, the server closes the upload
+                if (this.uploadCancels[process]) {
+                    this.uploadCancels[process].cancelled = true;
+                }
+                const resp = await api.cancelJob(event.detail.job_id);
+                if (resp.status != 'success') {
+                    console.error(resp.message);
+                    this.#removeCancelButton(process);
+                }
+            });
+            downloadContainer.appendChild(cancelButton);
         });
 
         api.addCustomEventListener('form-feedback', (event) => {
@@ -455,6 +1058,21 @@ class PELApp {
         return regex.test(name);
     }
 
+    /**
+     * Validates that rollover rules are a JSON list of objects with a name and a pattern.
+     * Patterns are compiled by the backend when the settings are saved.
+     * @param {string} value - The JSON text to validate.
+     * @returns {boolean} True if the rules are valid, false otherwise.
+     */
+    isValidRules(value) {
+        try {
+            const rules = JSON.parse(value);
+            return Array.isArray(rules) && rules.every(rule => typeof rule.name === 'string' && typeof rule.pattern === 'string');
+        } catch (error) {
+            return false;
+        }
+    }
+
     /**
      * 
      * @param {string} rate - The rate string to format and validate.
@@ -582,6 +1200,15 @@ class PELApp {
                 input.value = isValid !== true ? input.value : trimmedValue;
                 errorMessage = isValid !== true ? 'Name must be a string containing only alphanumeric and common non-alphanumeric characters.' : undefined;
                 break;
+            case 'ADDRESS_SCAN_LINES':
+                isValid = /^\d+$/.test(trimmedValue) && parseInt(trimmedValue) > 0;
+                input.value = isValid !== true ? input.value : trimmedValue;
+                errorMessage = isValid !== true ? 'Address scan lines must be a whole number greater than 0.' : undefined;
+                break;
+            case 'ROLLOVER_RULES':
+                isValid = this.isValidRules(trimmedValue);
+                errorMessage = isValid !== true ? 'Rules must be a JSON list of rules, each with a name and a pattern.' : undefined;
+                break;
             case 'COMPLIANCE_PARTNER_RATES_rate[]':
             case 'COMPLIANCE_BOOKKEEPING_RATES':
             case 'CONSULTING_PARTNER_RATES_rate[]':
@@ -601,7 +1228,7 @@ class PELApp {
      */
     validateUserSettingsInput() {
         // Validate each input
-        const inputs = document.querySelectorAll('input[type="text"]');
+        const inputs = document.querySelectorAll('input[type="text"], textarea');
         inputs.forEach(input => {
             input.addEventListener('change', (event) => {
                 let {isValid, errorMessage} = this.validateInput(input)
@@ -626,7 +1253,7 @@ class PELApp {
             event.preventDefault();
 
             let isFormValid = true;
-            userSettingsForm.querySelectorAll('input[type="text"]').forEach(input => {
+            userSettingsForm.querySelectorAll('input[type="text"], textarea').forEach(input => {
                 let {isValid, errorMessage} = this.validateInput(input);
                 this.markInputValidity(input, isValid, errorMessage);
                 if (!isValid) {
@@ -663,19 +1290,32 @@ class PELApp {
             const filePickerId = inputId + '-picker';
             document.getElementById(filePickerId).click();
         }
+
+        const selectZip = (inputId) => {
+            const filePickerId = inputId + '-zipPicker';
+            document.getElementById(filePickerId).click();
+        }
     
         const folderSelected = (inputId, pickerId) => {
             const folderPicker = document.getElementById(pickerId);
             const folderInput = document.getElementById(inputId);
+            // Only one of the folder and zip pickers is uploaded at a time
+            document.querySelectorAll(`input[type="file"][name="${folderPicker.name}"]`).forEach((picker) => {
+                if (picker !== folderPicker) {
+                    picker.value = '';
+                }
+            });
             if (folderPicker.files.length > 0) {
-                const folderName = folderPicker.files[0].webkitRelativePath.split('/')[0];
+                const firstFile = folderPicker.files[0];
+                // Zip archives are selected as a single file without a relative path
+                const folderName = firstFile.webkitRelativePath ? firstFile.webkitRelativePath.split('/')[0] : firstFile.name;
                 folderInput.value = folderName + ' (' + folderPicker.files.length + ' files)';
             } else {
                 folderInput.value = '';
             }
         }
 
-        return {selectFolder, folderSelected};
+        return {selectFolder, selectZip, folderSelected};
     }
 
     /**
@@ -698,7 +1338,23 @@ class PELApp {
     async processEngagementLetters(formData) {
         const csrf = formData.get('csrf-token');
         formData.delete('csrf-token');
-        api.processLetters(formData, csrf);
+        formData = await this.#prepareUpload('processEngagementLetters', formData, csrf);
+        this.#sendUpload('processEngagementLetters', formData, csrf, (form, upload) => api.processLetters(form, csrf, upload));
+    }
+
+    /**
+     * Preview a rollover: show the changes each letter would get and the letters that would not be updated, without
+     * writing anything.
+     * @param {FormData} formData - the form data
+     */
+    async previewRollover(formData) {
+        const csrf = formData.get('csrf-token');
+        formData.delete('csrf-token');
+        formData = await this.#prepareUpload('processEngagementLetters', formData, csrf, false, true);
+        const resp = await this.#sendUpload('processEngagementLetters', formData, csrf, (form, upload) => api.processLetters(form, csrf, upload, true));
+        if (resp && resp.status == 'success') {
+            this.#showPreview(resp);
+        }
     }
 
     /**
@@ -736,6 +1392,21 @@ class PELApp {
                     value: listItems
                 });
 
+                data.push(formattedData);
+            } else if (type === 'json') {
+                let label = formElement.querySelector('label');
+                let input = formElement.querySelector('textarea');
+                let small = formElement.querySelector('small');
+
+                let formattedData = Object.assign({}, {
+                    id: input.id,
+                    name: label.innerText,
+                    config_name: input.name,
+                    description: small.innerText,
+                    type: type,
+                    value: JSON.parse(input.value)
+                });
+
                 data.push(formattedData);
             } else {
                 let label = formElement.querySelector('label');
@@ -764,19 +1435,25 @@ class PELApp {
     async entityChecker(formData) {
         const csrf = formData.get('csrf-token');
         formData.delete('csrf-token');
+        formData = await this.#prepareUpload('entityChecker', formData, csrf);
 
-        const html = await api.checkEntities(formData, csrf);
-        const tableContainer = document.getElementById('entityCheckerUpdate');
-        tableContainer.innerHTML = html;
-
-        const rows = tableContainer.querySelectorAll(".clickable-row");
-        rows.forEach((row) => {
-            row.addEventListener('click', () => {
-                const nextContent = row.nextElementSibling;
-                nextContent.classList.toggle('d-none');
-                nextContent.classList.toggle('d-table-row');
+        const resp = await this.#sendUpload('entityChecker', formData, csrf, (form, upload) => api.checkEntities(form, csrf, upload));
+        if (resp.status == 'success') {
+            this.#showEntities(resp.entities);
+            const folder = document.getElementById('entityCheckDirectory');
+            this.entityChecks.push({
+                jobId: resp.job_id,
+                label: (folder && folder.value) || `Check ${this.entityChecks.length + 1}`,
+                letters: resp.entities.length
             });
-        });
+            this.#showReconcileOptions(csrf);
+        } else if (resp.status == 'cancelled') {
+            console.log(resp.message);
+        } else if (resp.status == 'error') {
+            console.error(resp.message);
+        } else {
+            console.error(`Unknown error: ${JSON.stringify(resp)}`);
+        }
     }
 
     /**
@@ -786,9 +1463,12 @@ class PELApp {
     async pdfPrinter(formData) {
         const csrf = formData.get('csrf-token');
         formData.delete('csrf-token');
+        const sign = formData.get('signLetters') === 'on';
+        formData.delete('signLetters');
+        formData = await this.#prepareUpload('pdfPrinter', formData, csrf, sign);
 
-        const resp = await api.printToPdf(formData, csrf);
-        if (resp.status == 'success') {
+        const resp = await this.#sendUpload('pdfPrinter', formData, csrf, (form, upload) => api.printToPdf(form, csrf, sign, upload));
+        if (resp.status == 'success' || resp.status == 'cancelled') {
             console.log(resp.message);
         } else if (resp.status == 'error') {
             console.error(resp.message);
@@ -804,9 +1484,10 @@ class PELApp {
     async pdfSignatures(formData) {
         const csrf = formData.get('csrf-token');
         formData.delete('csrf-token');
+        formData = await this.#prepareUpload('pdfSignatures', formData, csrf);
 
-        const resp = await api.addSignature(formData, csrf);
-        if (resp.status == 'success') {
+        const resp = await this.#sendUpload('pdfSignatures', formData, csrf, (form, upload) => api.addSignature(form, csrf, upload));
+        if (resp.status == 'success' || resp.status == 'cancelled') {
             console.log(resp.message);
         } else if (resp.status == 'error') {
             console.error(resp.message);
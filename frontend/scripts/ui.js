@@ -132,4 +132,240 @@ export class AlertStatus {
         }
     }
 }
-  
\ No newline at end of file
+  
+/**
+ * @class FrameBatcher
+ * Buffers items and applies them together once per animation frame, so bursts of socket events cause one DOM update.
+ */
+export class FrameBatcher {
+    /**
+     * @param {function(Array): void} apply Called with the items buffered since the last frame
+     */
+    constructor(apply) {
+        this.apply = apply;
+        this.items = [];
+        this.scheduled = false;
+    }
+
+    /**
+     * Buffer an item to be applied on the next animation frame.
+     * @param {*} item
+     */
+    push(item) {
+        this.items.push(item);
+        if (!this.scheduled) {
+            this.scheduled = true;
+            requestAnimationFrame(() => this.flush());
+        }
+    }
+
+    /**
+     * Apply buffered items now.
+     */
+    flush() {
+        this.scheduled = false;
+        if (this.items.length === 0) {
+            return;
+        }
+        const items = this.items;
+        this.items = [];
+        this.apply(items);
+    }
+}
+
+/**
+ * @class VirtualList
+ * Scrollable list that only renders the rows in view, so it stays fast with tens of thousands of items. Rows have a
+ * fixed height and their elements are reused while scrolling. Items can be filtered and sorted without touching
+ * the items themselves.
+ */
+export class VirtualList {
+    /**
+     * @param {HTMLElement} container Scrollable element with a fixed height
+     * @param {Object} options
+     * @param {number} options.rowHeight Height of every row in pixels
+     * @param {function(): HTMLElement} options.createRow Create an empty row element
+     * @param {function(HTMLElement, *, number): void} options.renderRow Fill a row element with an item and its index in the view
+     * @param {number} [options.overscan] Rows rendered above and below the visible rows. Default is 10.
+     * @param {function(number): void} [options.onChange] Called with the number of items shown after they change
+     */
+    constructor(container, { rowHeight, createRow, renderRow, overscan = 10, onChange = null }) {
+        this.container = container;
+        this.rowHeight = rowHeight;
+        this.createRow = createRow;
+        this.renderRow = renderRow;
+        this.overscan = overscan;
+        this.onChange = onChange;
+
+        // Every item in arrival order, and the filtered and sorted items shown
+        this.items = [];
+        this.view = [];
+        this.filter = null;
+        this.compare = null;
+
+        this.rows = [];
+        this.rendered = [];
+        this.spacer = document.createElement('div');
+        this.spacer.className = 'virtual-list-spacer';
+        this.container.appendChild(this.spacer);
+
+        this.renderScheduled = false;
+        this.container.addEventListener('scroll', () => this.scheduleRender(), { passive: true });
+    }
+
+    /**
+     * Number of items shown.
+     * @returns {number}
+     */
+    get length() {
+        return this.view.length;
+    }
+
+    /**
+     * Return the item shown at index.
+     * @param {number} index
+     */
+    itemAt(index) {
+        return this.view[index];
+    }
+
+    /**
+     * Add items to the end of the list. Keeps the list scrolled to the bottom if it already was.
+     * @param {Array} items
+     */
+    append(items) {
+        const atBottom = this.container.scrollTop + this.container.clientHeight >= this.container.scrollHeight - this.rowHeight;
+        const matched = [];
+        for (const item of items) {
+            this.items.push(item);
+            if (this.filter === null || this.filter(item)) {
+                matched.push(item);
+            }
+        }
+        for (const item of matched) {
+            if (this.compare === null) {
+                this.view.push(item);
+            } else {
+                this.#insertSorted(item);
+            }
+        }
+        this.#resize();
+        if (atBottom && this.compare === null) {
+            this.container.scrollTop = this.container.scrollHeight;
+        }
+        this.render();
+    }
+
+    /**
+     * Remove every item.
+     */
+    clear() {
+        this.items = [];
+        this.view = [];
+        this.#resize();
+        this.render();
+    }
+
+    /**
+     * Only show items for which filter returns true.
+     * @param {function(*): boolean|null} filter Pass null to show every item
+     */
+    setFilter(filter) {
+        this.filter = filter;
+        this.#rebuild();
+    }
+
+    /**
+     * Sort the items shown.
+     * @param {function(*, *): number|null} compare Pass null to show items in arrival order
+     */
+    setSort(compare) {
+        this.compare = compare;
+        this.#rebuild();
+    }
+
+    /**
+     * Render on the next animation frame.
+     */
+    scheduleRender() {
+        if (!this.renderScheduled) {
+            this.renderScheduled = true;
+            requestAnimationFrame(() => {
+                this.renderScheduled = false;
+                this.render();
+            });
+        }
+    }
+
+    /**
+     * Render the rows in view.
+     */
+    render() {
+        const first = Math.max(0, Math.floor(this.container.scrollTop / this.rowHeight) - this.overscan);
+        const last = Math.min(this.view.length, Math.ceil((this.container.scrollTop + this.container.clientHeight) / this.rowHeight) + this.overscan);
+        const count = Math.max(0, last - first);
+
+        while (this.rows.length < count) {
+            const row = this.createRow();
+            row.style.position = 'absolute';
+            row.style.left = '0';
+            row.style.right = '0';
+            row.style.height = `${this.rowHeight}px`;
+            this.spacer.appendChild(row);
+            this.rows.push(row);
+            this.rendered.push(null);
+        }
+
+        for (let i = 0; i < this.rows.length; i++) {
+            const row = this.rows[i];
+            if (i >= count) {
+                row.hidden = true;
+                this.rendered[i] = null;
+                continue;
+            }
+            const index = first + i;
+            const item = this.view[index];
+            row.hidden = false;
+            row.style.transform = `translateY(${index * this.rowHeight}px)`;
+            row.dataset.index = index;
+            // Rows still showing the same item are not rendered again
+            if (this.rendered[i] !== item) {
+                this.renderRow(row, item, index);
+                this.rendered[i] = item;
+            }
+        }
+    }
+
+    #rebuild() {
+        this.view = this.filter === null ? this.items.slice() : this.items.filter(this.filter);
+        if (this.compare !== null) {
+            this.view.sort(this.compare);
+        }
+        this.container.scrollTop = 0;
+        this.#resize();
+        this.render();
+    }
+
+    #resize() {
+        this.spacer.style.height = `${this.view.length * this.rowHeight}px`;
+        if (this.onChange !== null) {
+            this.onChange(this.view.length);
+        }
+    }
+
+    /**
+     * Insert an item into the sorted view after any equal items.
+     */
+    #insertSorted(item) {
+        let low = 0, high = this.view.length;
+        while (low < high) {
+            const mid = (low + high) >>> 1;
+            if (this.compare(item, this.view[mid]) < 0) {
+                high = mid;
+            } else {
+                low = mid + 1;
+            }
+        }
+        this.view.splice(low, 0, item);
+    }
+}
@@ -11,25 +11,36 @@
 # GNU General Public License for more details.
 #
 # You should have received a copy of the GNU General Public License
+import time
+
+# Process start, for the startup time report
+STARTED_AT = time.perf_counter()
+
 import argparse
+import sys
 
 from dotenv import load_dotenv
 
-from backend.PELServer import Server
+from backend import cli
 from backend.utils.path_utils import get_full_path
 
 
 def main(host, port, debug):
+    # Flask is only imported when serving, batch commands run without it
+    from backend.PELServer import Server
     server = Server()
-    server.run(host, port, debug)
+    server.run(host, port, debug, STARTED_AT)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Run the Flask application.')
+    parser = argparse.ArgumentParser(description='Run the Flask application, or process a directory of letters from the command line.')
     parser.add_argument('--host', type=str, default='localhost', help='The host address to run the server on.')
     parser.add_argument('--port', type=int, default=5000, help='The port number to run the server on.')
     parser.add_argument('--debug', type=bool, default=False, help='Whether to run the server in debug mode.')
+    cli.add_commands(parser)
 
     load_dotenv(get_full_path('.env'))
 
     args = parser.parse_args()
+    if args.command:
+        sys.exit(cli.run(args))
     main(args.host, args.port, args.debug)
\ No newline at end of file
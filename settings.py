@@ -22,4 +22,50 @@ CACHE_TYPE = "FileSystemCache"
 DAILY_LIMIT = 1000
 HOURLY_LIMIT = 240
 
-PROCESSED_FILES_DIRECTORY = "temp/complete"
\ No newline at end of file
+PROCESSED_FILES_DIRECTORY = "temp/complete"
+
+# Number of lines at the top of a letter searched for the address when checking entities
+ADDRESS_SCAN_LINES = 40
+
+# Optimization of signed PDFs that are rewritten rather than updated incrementally, see backend.pdf_optimizer. Overridden by user-config.json
+PDF_OPTIMIZATION = {"enabled": True, "compress_streams": True, "deduplicate": True, "linearize": False}
+
+# Place signature images in letters before printing them instead of stamping the printed PDFs. Overridden by user-config.json
+PDF_SIGN_IN_DOCX = False
+
+# Number of worker threads shared by all running batches
+SCHEDULER_WORKERS = 4
+# Tasks per second of queue wait subtracted from a job's remaining work when scheduling
+SCHEDULER_AGING = 5.0
+# Run tasks on SCHEDULER_WORKERS worker processes started with the backends imported before the server accepts
+# connections, instead of on the server's threads, and seconds to wait for them to start
+WORKER_PROCESSES = True
+WORKER_START_TIMEOUT = 60
+# Tasks a worker process runs, and megabytes of resident memory it may hold after a task, before it is replaced by
+# a fresh one between files. Set to 0 for no limit
+WORKER_MAX_TASKS = 500
+WORKER_MAX_RSS_MB = 1024
+
+# Seconds a file sent to a worker through the broker (Broker URL setting) may take to be queued, run and returned
+# before it fails. Set to 0 to wait forever
+BROKER_TASK_TIMEOUT = 3600
+
+# Seconds running files are given to finish when the server shuts down, and the file parsed letters and compiled
+# rollover rules are saved to on shutdown and restored from at the next start. Set to "" to always start cold
+SHUTDOWN_DRAIN_SECONDS = 30
+CACHE_SNAPSHOT_PATH = "temp/cache-snapshot.json.gz"
+
+# Bytes per chunk of chunked uploads, and seconds without a chunk after which an upload is abandoned
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_IDLE_TIMEOUT = 300
+
+# Memory used by parsed letters shared by the entity checker and rollover, and an optional directory to also save
+# them to so they survive a restart, ie. "_cache/documents"
+DOCUMENT_CACHE_MB = 64
+DOCUMENT_CACHE_DIR = ""
+
+# Days the journals of finished jobs are kept in temp/jobs
+JOB_JOURNAL_RETENTION_DAYS = 7
+
+# Fraction of jobs that record a timeline trace, downloadable from /jobs/<job_id>/trace
+TRACE_SAMPLE_RATE = 0.05
@@ -0,0 +1,56 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+"""
+Benchmark of address parsing on normal and adversarial letters, the original whole-letter regex against
+backend.extractor.parse_address. Run from the repository root with `python tests/bench_address.py`.
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.extractor import parse_address
+
+# extract_address before addresses were parsed line by line
+BASELINE_PATTERN = r'\n(.+)\n(.+),\s+([A-Z]{2})\s+(\d{5})\n'
+
+NORMAL_LETTER = ['January 1, 2024', '', 'John Smith', '123 Main St', 'Springfield, IL 62704', '', 'Dear John,'] + \
+    [f'Paragraph {i} of the engagement letter, with terms, fees, and responsibilities.' for i in range(300)]
+ADVERSARIAL_LETTERS = {
+    "2000 long comma lines, no address": ['a, ' * 60 + 'b' for _ in range(2000)],
+    "500 lines of 400 commas, no address": [',' * 400 for _ in range(500)],
+    "2000 lines of 60 commas within the line length limit": ['a,' * 59 + 'a' for _ in range(2000)],
+    "address after 5000 paragraphs": ['Lorem ipsum, dolor sit amet'] * 5000 + ['123 Main St', 'Springfield, IL 62704', ''],
+    "one 100000 character paragraph": ['x, ' * 33333],
+}
+
+
+def baseline(paragraphs: list[str]):
+    return re.search(BASELINE_PATTERN, '\n'.join(paragraphs))
+
+def milliseconds(fn, paragraphs: list[str], number: int=5) -> float:
+    return min(timeit.repeat(lambda: fn(paragraphs), number=1, repeat=number)) * 1000
+
+def main():
+    letters = {"normal letter, 300 paragraphs": NORMAL_LETTER, **ADVERSARIAL_LETTERS}
+    width = max(len(name) for name in letters)
+    print(f'{"letter":<{width}}  {"baseline ms":>12}  {"parse_address ms":>16}')
+    for name, paragraphs in letters.items():
+        print(f'{name:<{width}}  {milliseconds(baseline, paragraphs):>12.2f}  {milliseconds(parse_address, paragraphs):>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import time
+
+from backend.broker import RemoteTask, SQLiteBroker
+
+
+def test_renewed_lease_is_not_given_to_another_worker(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / 'broker.db'))
+    task_id = broker.put('extract', 'letter.docx', b'letter', None, {})
+    assert broker.claim('worker-1', 0.2)["id"] == task_id
+    time.sleep(0.3)
+    assert broker.renew(task_id, 'worker-1', 60)
+    assert broker.claim('worker-2', 60) is None
+    assert not broker.renew(task_id, 'worker-2', 60)
+
+def test_expired_lease_is_given_to_another_worker(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / 'broker.db'))
+    task_id = broker.put('extract', 'letter.docx', b'letter', None, {})
+    broker.claim('worker-1', 0.1)
+    time.sleep(0.2)
+    assert broker.claim('worker-2', 60)["id"] == task_id
+    assert not broker.renew(task_id, 'worker-1', 60)
+
+def test_remote_task_times_out(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / 'broker.db'))
+    input_path = tmp_path / 'letter.docx'
+    input_path.write_bytes(b'letter')
+    result, error = RemoteTask(broker, 'extract', timeout=0.3)(str(input_path), None)
+    assert result is None and 'within' in error
+    assert broker.stats() == {"queued": 0, "running": 0}
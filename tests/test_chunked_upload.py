@@ -0,0 +1,64 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import hashlib
+import io
+
+import pytest
+
+from backend.utils.chunked_upload import MIN_CHUNK_SIZE, ChunkError, UploadSessions
+
+
+def send(session, index: int, chunk: int, data: bytes, sha256: str|None=None) -> bool:
+    return session.write_chunk(index, chunk, io.BytesIO(data), sha256 or hashlib.sha256(data).hexdigest(), len(data))
+
+def test_corrupted_chunk_stays_missing_until_it_is_sent_again(tmp_path):
+    data = bytes(range(256)) * (MIN_CHUNK_SIZE * 3 // 256) + b'tail'
+    chunks = [data[offset:offset + MIN_CHUNK_SIZE] for offset in range(0, len(data), MIN_CHUNK_SIZE)]
+    sessions = UploadSessions(str(tmp_path / 'uploads'))
+    session = sessions.create([{"name": "Letter.docx", "size": len(data)}], MIN_CHUNK_SIZE)
+    assert session.status()["files"][0]["missing"] == [0, 1, 2, 3]
+
+    assert not send(session, 0, 0, chunks[0])
+    with pytest.raises(ChunkError, match='checksum'):
+        send(session, 0, 2, b'x' * MIN_CHUNK_SIZE, hashlib.sha256(chunks[2]).hexdigest())
+    with pytest.raises(ChunkError, match='ended after'):
+        session.write_chunk(0, 1, io.BytesIO(chunks[1][:100]), hashlib.sha256(chunks[1]).hexdigest())
+    assert not send(session, 0, 3, chunks[3])
+
+    # A client that lost its connection asks which chunks are still missing and only sends those
+    status = sessions.get(session.id).status()
+    assert status["files"][0]["missing"] == [1, 2]
+    assert status["bytes_received"] == len(chunks[0]) + len(chunks[3])
+    assert not send(session, 0, 2, chunks[2])
+    assert send(session, 0, 1, chunks[1])
+    # A chunk sent again after its acknowledgement was lost is not counted twice
+    assert send(session, 0, 1, chunks[1])
+    assert session.bytes_received == len(data)
+
+    completed = list(session.completed(idle_timeout=1))
+    assert [name for name, _ in completed] == ['Letter.docx']
+    with open(completed[0][1], 'rb') as handle:
+        assert handle.read() == data
+
+def test_files_are_handed_on_as_they_complete(tmp_path):
+    sessions = UploadSessions(str(tmp_path / 'uploads'))
+    session = sessions.create([{"name": "a.docx", "size": 3}, {"name": "b.docx", "size": 3}], MIN_CHUNK_SIZE)
+    assert sessions.claim(session.id) is session
+    assert sessions.claim(session.id) is None
+    send(session, 1, 0, b'bbb')
+    # The first file never arrives, the session stops waiting after the idle timeout
+    assert [name for name, _ in session.completed(idle_timeout=0.2)] == ['b.docx']
+    sessions.remove(session.id)
+    with pytest.raises(ChunkError, match='closed'):
+        send(session, 0, 0, b'aaa')
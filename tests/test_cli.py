@@ -0,0 +1,58 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import argparse
+import json
+import os
+
+from backend import cli
+from test_processor import make_letter
+
+
+def run_cli(capsys, *argv) -> tuple[int, list[dict]]:
+    parser = argparse.ArgumentParser()
+    cli.add_commands(parser)
+    code = cli.run(parser.parse_args(argv))
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert lines[-1]["type"] == 'summary'
+    return code, lines
+
+def crash(*args):
+    os._exit(1)
+
+def test_same_named_letters_in_different_folders_keep_their_output(tmp_path, capsys):
+    for client, folder in enumerate(('a', 'b'), 1):
+        (tmp_path / 'source' / folder).mkdir(parents=True)
+        make_letter(tmp_path / 'source' / folder / 'Client 2023 Engagement Letter.docx', client)
+    code, lines = run_cli(capsys, 'rollover', str(tmp_path / 'source'), '--output', str(tmp_path / 'out'), '--workers', '1')
+    assert code == 0 and lines[-1]["succeeded"] == 2
+    outputs = sorted(line["output"] for line in lines[:-1])
+    assert outputs == [str(tmp_path / 'out' / folder / 'Client 2024 Engagement Letter.docx') for folder in ('a', 'b')]
+
+def test_crashed_worker_is_a_failed_file(tmp_path, capsys, monkeypatch):
+    (tmp_path / 'source').mkdir()
+    make_letter(tmp_path / 'source' / 'Client 2023 Engagement Letter.docx', 1)
+    monkeypatch.setattr(cli, 'run_file', crash)
+    code, lines = run_cli(capsys, 'extract', str(tmp_path / 'source'), '--workers', '1')
+    assert code == 1
+    assert lines[0]["type"] == 'result' and 'Worker process exited' in lines[0]["error"]
+    assert lines[-1]["failed"] == 1
+
+def test_signing_in_the_letter_is_opt_in():
+    parser = argparse.ArgumentParser()
+    cli.add_commands(parser)
+    args = lambda *flags: parser.parse_args(['print-sign', 'source', *flags])
+    assert cli.command_options(args(), {})["sign_in_docx"] is False
+    assert cli.command_options(args(), {"PDF_SIGN_IN_DOCX": True})["sign_in_docx"] is True
+    assert cli.command_options(args('--stamp-pdf'), {"PDF_SIGN_IN_DOCX": True})["sign_in_docx"] is False
+    assert cli.command_options(args('--sign-in-docx'), {})["sign_in_docx"] is True
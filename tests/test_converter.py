@@ -0,0 +1,48 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from backend import cancellation, converter
+
+# Stands in for a Word instance that stopped responding
+HUNG_WORD = [sys.executable, '-c', 'import time; time.sleep(60)']
+
+
+def hung_conversion(monkeypatch):
+    """Make conversions report a Word process that never finishes, and return that process."""
+    word = subprocess.Popen(HUNG_WORD)
+    monkeypatch.setattr(converter, '_CONVERT_SCRIPT', f"import time; print('WORD_PID {word.pid}', flush=True); time.sleep(60)")
+    return word
+
+def test_stuck_conversion_times_out_and_stops_word(monkeypatch):
+    word = hung_conversion(monkeypatch)
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match='did not finish'):
+        converter._convert('letter.docx', 'letter.pdf', timeout=0.5)
+    assert time.monotonic() - started < 10
+    assert word.wait(5) is not None
+
+def test_cancel_stops_word(monkeypatch):
+    word = hung_conversion(monkeypatch)
+    token = cancellation.CancelToken()
+    threading.Timer(0.5, token.cancel).start()
+    with pytest.raises(cancellation.Cancelled):
+        with cancellation.activate(token):
+            converter._convert('letter.docx', 'letter.pdf', timeout=30)
+    assert word.wait(5) is not None
@@ -0,0 +1,69 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import time
+
+from backend.extractor import extract_address, parse_address
+
+# Seconds parse_address may take on the adversarial letters of bench_address.py, far above what it needs
+ADVERSARIAL_BUDGET = 0.05
+
+
+def test_multi_line_address():
+    address = parse_address(['January 1, 2024', '', 'John Smith', '123 Main St', 'Suite 200', 'Springfield, IL 62704-1234'])
+    assert address == {
+        "recipient": "John Smith",
+        "care_of": None,
+        "street": ["123 Main St", "Suite 200"],
+        "city": "Springfield",
+        "state": "IL",
+        "zip": "62704-1234"
+    }
+
+def test_single_line_address():
+    address = parse_address(['John Smith', '123 Main St, Springfield, IL 62704'])
+    assert address["recipient"] == "John Smith"
+    assert address["street"] == ["123 Main St"]
+    assert address["city"] == "Springfield"
+    assert extract_address(['John Smith', '123 Main St, Springfield, IL 62704']) == '123 Main St\nSpringfield, IL 62704'
+
+def test_single_line_address_with_recipient_and_suite():
+    address = parse_address(['Acme, LLC, 123 Main St, Suite 4, Springfield, IL 62704'])
+    assert address["recipient"] == "Acme, LLC"
+    assert address["street"] == ["123 Main St", "Suite 4"]
+    assert address["city"] == "Springfield"
+
+def test_care_of_and_po_box():
+    address = parse_address(['Mary Jones', 'c/o Bob Jones', 'PO Box 5', 'Winston-Salem, NC 27101'])
+    assert address["recipient"] == "Mary Jones"
+    assert address["care_of"] == "c/o Bob Jones"
+    assert address["street"] == ["PO Box 5"]
+
+def test_building_name_street():
+    assert extract_address(['Plaza Tower', 'Springfield, IL 62704']) == 'Plaza Tower\nSpringfield, IL 62704'
+
+def test_no_address():
+    assert parse_address(['Dear client,', 'Thank you for choosing us.']) is None
+    assert extract_address([]) == "Address not found"
+
+def test_address_below_scan_lines_is_ignored():
+    paragraphs = [''] * 50 + ['123 Main St', 'Springfield, IL 62704']
+    assert parse_address(paragraphs) is None
+    assert parse_address(paragraphs, max_lines=60) is not None
+
+def test_adversarial_letters_are_linear():
+    from bench_address import ADVERSARIAL_LETTERS
+    for name, paragraphs in ADVERSARIAL_LETTERS.items():
+        started = time.perf_counter()
+        parse_address(paragraphs)
+        assert time.perf_counter() - started < ADVERSARIAL_BUDGET, name
@@ -0,0 +1,71 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import time
+
+from backend.journal import Journal
+from backend.utils.path_utils import unique_path
+
+
+def queue_inputs(journal: Journal, count: int) -> list[int]:
+    numbers = []
+    for i in range(count):
+        path = unique_path(journal.inputs_dir, f'Client {i} 2023 Engagement Letter.docx')
+        with open(path, 'wb') as file:
+            file.write(f'letter {i}'.encode())
+        numbers.append(journal.queued(path))
+    return numbers
+
+def test_resume_after_a_crash_runs_only_unfinished_files(tmp_path):
+    journal = Journal.create(str(tmp_path), 'owner', 'rollover', 'extract', None)
+    first, second, third = queue_inputs(journal, 3)
+    journal.done(first, ({"entities": []}, None))
+    journal.seal()
+    # The process dies while writing the second file's record
+    journal._file.write(b'{"event": "done", "n": 1, "out')
+    journal._file.close()
+
+    resumed = next(Journal.unfinished(str(tmp_path)))
+    assert resumed.job_id == journal.job_id and resumed.sealed
+    assert [n for n, _ in resumed.remaining()] == [second, third]
+    assert [entry['n'] for entry in resumed.completed()] == [first]
+
+    # Records written after the restart start on a new line and are replayed
+    resumed.done(second, (None, 'Not updated'))
+    assert [entry['status'] for entry in Journal.load(journal.directory).completed()] == ['success', 'failed']
+
+def test_finished_job_is_not_resumed_and_its_inputs_are_deleted(tmp_path):
+    journal = Journal.create(str(tmp_path), 'owner', 'rollover', 'extract', None)
+    (n,) = queue_inputs(journal, 1)
+    journal.done(n, ({"entities": []}, None))
+    journal.seal()
+    journal.finish()
+    assert list(Journal.unfinished(str(tmp_path))) == []
+    assert not os.path.exists(journal.inputs_dir)
+
+def test_prune_only_deletes_old_finished_journals(tmp_path):
+    finished = Journal.create(str(tmp_path), 'owner', 'rollover', 'extract', None)
+    finished.seal()
+    finished.finish()
+    unfinished = Journal.create(str(tmp_path), 'owner', 'rollover', 'extract', None)
+    queue_inputs(unfinished, 1)
+    recent = Journal.create(str(tmp_path), 'owner', 'rollover', 'extract', None)
+    recent.seal()
+    recent.finish()
+    old = time.time() - 3600
+    for journal in (finished, unfinished):
+        os.utime(journal.path, (old, old))
+
+    Journal.prune(str(tmp_path), 60)
+    assert sorted(os.listdir(tmp_path)) == sorted([unfinished.job_id, recent.job_id])
@@ -0,0 +1,103 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import zlib
+
+import pdfplumber
+import pytest
+from PyPDF2 import PdfReader
+
+from backend.pdf_optimizer import optimize_pdf
+from backend.pdf_signature import sign_pdf
+
+SIGNATURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images', 'signatures')
+LETTER = ['Dear Client,', 'We are pleased to confirm our engagement.', 'Very truly yours,', 'Mike Taylor']
+
+
+def make_pdf(path, lines: list[str], xref_stream: bool=False, copies: int=1) -> bytes:
+    """
+    Write a PDF with one page per copy showing lines in Helvetica, with a cross-reference table or, like PDFs saved by
+    newer versions of Word, a cross-reference stream. Each page has its own copy of the font so there is something to
+    deduplicate.
+    """
+    text = b'BT /F1 12 Tf 72 720 Td 14 TL ' + b' '.join(b'(%s) Tj T*' % line.encode() for line in lines) + b' ET'
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', b'']
+    kids = []
+    for _ in range(copies):
+        page = len(objects) + 1
+        kids.append(b'%d 0 R' % page)
+        objects += [
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>' % (page + 2, page + 1),
+            b'<< /Length %d >>\nstream\n%s\nendstream' % (len(text) + 1, text),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        ]
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), copies)
+
+    data = bytearray(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+    xref = len(data)
+    size = len(objects) + 1
+    if xref_stream:
+        offsets.append(xref)
+        rows = zlib.compress(b'\x00\x00\x00\x00' + b''.join(b'\x01' + offset.to_bytes(2, 'big') + b'\x00' for offset in offsets))
+        data += b'%d 0 obj\n<< /Type /XRef /Size %d /Root 1 0 R /W [1 2 1] /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream\nendobj\n' % (size, size + 1, len(rows), rows)
+    else:
+        data += b'xref\n0 %d\n0000000000 65535 f \n' % size + b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        data += b'trailer\n<< /Size %d /Root 1 0 R >>\n' % size
+    data += b'startxref\n%d\n%%%%EOF\n' % xref
+    with open(path, 'wb') as file:
+        file.write(data)
+    return bytes(data)
+
+@pytest.mark.parametrize('xref_stream', [False, True])
+def test_incremental_signature_is_read_strictly(tmp_path, xref_stream):
+    original = make_pdf(tmp_path / 'Client_2024_Engagement_Letter.pdf', LETTER, xref_stream)
+    output, error = sign_pdf(str(tmp_path / 'Client_2024_Engagement_Letter.pdf'), str(tmp_path), SIGNATURES_DIR, incremental=True)
+    assert error is None and output == 'Client 2024 Engagement Letter.pdf'
+
+    with open(tmp_path / output, 'rb') as file:
+        signed = file.read()
+    # The update is appended after the original bytes, which are left untouched
+    assert signed.startswith(original) and len(signed) > len(original)
+    reader = PdfReader(tmp_path / output, strict=True)
+    assert len(reader.pages) == 1
+    page = reader.pages[0]
+    assert '/PELSignature' in page['/Resources']['/XObject']
+    assert b'/PELSignature Do' in b''.join(stream.get_object().get_data() for stream in page['/Contents'])
+    assert 'Mike Taylor' in page.extract_text()
+
+def rendering(path) -> list[list[tuple]]:
+    """Each character drawn on each page, with its font, size and position."""
+    with pdfplumber.open(path) as pdf:
+        return [[(char['text'], char['fontname'], char['size'], round(char['x0'], 3), round(char['top'], 3)) for char in page.chars] for page in pdf.pages]
+
+def test_optimized_pdf_renders_the_same(tmp_path):
+    path = tmp_path / 'letter.pdf'
+    original = make_pdf(path, LETTER * 3, copies=3)
+    before = rendering(path)
+    contents = [page.get_contents().get_data() for page in PdfReader(path).pages]
+
+    report, error = optimize_pdf(str(path))
+    assert error is None
+    assert report["streams_compressed"] > 0 and report["objects_merged"] > 0
+    assert 0 < report["bytes_after"] < len(original)
+    reader = PdfReader(path, strict=True)
+    assert [page.get_contents().get_data() for page in reader.pages] == contents
+    # Each page keeps its own page object, only the identical fonts and content streams are shared
+    assert len({page.indirect_reference.idnum for page in reader.pages}) == 3
+    assert len({page['/Resources'].raw_get('/Font').raw_get('/F1').idnum for page in reader.pages}) == 1
+    assert rendering(path) == before
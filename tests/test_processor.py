@@ -0,0 +1,79 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import docx
+
+from backend.doc_cache import DocumentCache
+from backend.fingerprint import TemplateCache
+from backend.processor import letter_updates, rollover_updates
+from backend.rules import compile_rules
+
+
+def make_letter(path, client: int, boilerplate: str='We will prepare your returns.'):
+    doc = docx.Document()
+    doc.add_paragraph('January 1, 2023')
+    doc.add_paragraph(f'Client {client}')
+    doc.add_paragraph(f'{client} Main St')
+    doc.add_paragraph('Springfield, IL 62704')
+    doc.add_heading('Engagement', level=1)
+    doc.add_paragraph(boilerplate)
+    doc.add_paragraph('Returns for the 2023 tax year.')
+    doc.save(str(path))
+
+def parse_letters(tmp_path, count: int):
+    cache = DocumentCache()
+    letters = []
+    for client in range(count):
+        path = tmp_path / f'Client {client} 2023 Engagement Letter.docx'
+        make_letter(path, client)
+        letters.append(cache.load(str(path)))
+    return cache, letters
+
+def test_letters_of_a_template_share_a_fingerprint(tmp_path):
+    _, letters = parse_letters(tmp_path, 3)
+    assert letters[0].template is not None
+    assert len({letter.template for letter in letters}) == 1
+
+def test_template_updates_match_a_full_scan(tmp_path):
+    _, letters = parse_letters(tmp_path, 10)
+    rule_set = compile_rules(None, {})
+    templates = TemplateCache(learn_after=2, audit_every=0)
+    for letter in letters:
+        assert letter_updates(letter, rule_set, templates) == rollover_updates(letter.paragraphs, rule_set)
+    stats = templates.stats()
+    assert stats['hits'] == 8 and stats['misses'] == 2
+
+def test_changed_boilerplate_falls_back_to_a_full_scan(tmp_path):
+    cache, letters = parse_letters(tmp_path, 3)
+    rule_set = compile_rules(None, {})
+    templates = TemplateCache(learn_after=2, audit_every=0)
+    for letter in letters:
+        letter_updates(letter, rule_set, templates)
+    path = tmp_path / 'Edited 2023 Engagement Letter.docx'
+    make_letter(path, 99, boilerplate='Fees for 2023 are unchanged.')
+    edited = cache.load(str(path))
+    assert letter_updates(edited, rule_set, templates) == rollover_updates(edited.paragraphs, rule_set)
+    assert templates.stats()['fallbacks'] == 1
+
+def test_learning_never_changes_a_template_in_use():
+    templates = TemplateCache(learn_after=2, audit_every=0)
+    texts = ['Dear Client 1,', 'Returns for the 2023 tax year.', 'Boilerplate']
+    templates.learn('key', texts, {1})
+    templates.learn('key', ['Dear Client 2,', *texts[1:]], {1})
+    in_use = templates.lookup('key')
+    layout = (in_use.hot, in_use.variable, in_use.boilerplate)
+    # A letter where the hot paragraph didn't match moves it from hot to variable
+    templates.learn('key', texts, set())
+    assert (in_use.hot, in_use.variable, in_use.boilerplate) == layout
+    learned = templates.lookup('key')
+    assert learned.hot == frozenset() and learned.variable == {0, 1} and learned.boilerplate == (2,)
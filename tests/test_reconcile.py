@@ -0,0 +1,69 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+from backend.reconcile import reconcile
+
+
+def letter(filename: str, street: str, zip_code: str, *entities: tuple[str, str]) -> dict:
+    return {
+        "filename": filename,
+        "address": f'{street}\nSpringfield, IL {zip_code}',
+        "address_fields": {"recipient": None, "street": [street], "zip": zip_code},
+        "entities": [{"name_of_entity": name, "type_of_return": return_type} for name, return_type in entities]
+    }
+
+PRIOR = [
+    letter('Smith 2023 Engagement Letter.docx', '1 Main Street', '62701', ('Smith LLC', 'Form 1065'), ('Smith Trust', 'Form 1041')),
+    letter('Jones 2023 Engagement Letter.docx', '2 Oak Avenue', '62702', ('Jones Inc', 'Form 1120')),
+    letter('Acme 2023 Engagement Letter.docx', '3 Elm Road', '62703', ('Acme Holdings', 'Form 1120')),
+    letter('Brown 2023 Engagement Letter.docx', '4 Pine Lane', '62704', ('Brown LP', 'Form 1065')),
+    letter('Gone 2023 Engagement Letter.docx', '5 Birch Court', '62705', ('Gone LLC', 'Form 1065'), ('Gone Trust', 'Form 1041')),
+]
+CURRENT = [
+    # Same client and address, written differently
+    letter('Smith 2024 Engagement Letter.docx', '1 Main St.', '62701-1234', ('smith, l.l.c.', 'Form 1120S'), ('Smith Family Foundation', 'Form 990')),
+    # Moved
+    letter('Jones 2024 Engagement Letter.docx', '20 Cedar Drive', '62710', ('Jones Inc', 'Form 1120'), ('Jones Rentals', 'Form 1065')),
+    # Renamed
+    letter('Acme Group 2024 Engagement Letter.docx', '3 Elm Rd', '62703', ('Acme Holdings', 'Form 1120')),
+    letter('Brown 2024 Engagement Letter.docx', '4 Pine Ln', '62704', ('Brown LP', 'Form 1065')),
+    letter('New Client 2024 Engagement Letter.docx', '6 Maple Place', '62706', ('New Client LLC', 'Form 1065')),
+]
+
+
+def test_added_removed_and_changed_entities_of_each_match_pass():
+    result = reconcile(PRIOR, CURRENT)
+    letters = {letter['client']: letter for letter in result['letters']}
+    assert sorted(letters) == ['jones', 'smith']
+
+    smith = letters['smith']
+    assert smith['match'] == 'name_and_address'
+    assert [entity['name_of_entity'] for entity in smith['added']] == ['Smith Family Foundation']
+    assert [entity['name_of_entity'] for entity in smith['removed']] == ['Smith Trust']
+    assert smith['changed'] == [{"name_of_entity": 'smith, l.l.c.', "prior_type": 'Form 1065', "current_type": 'Form 1120S'}]
+    assert letters['jones']['match'] == 'name'
+    assert [entity['name_of_entity'] for entity in letters['jones']['added']] == ['Jones Rentals']
+
+    assert [letter['filename'] for letter in result['prior_only']] == ['Gone 2023 Engagement Letter.docx']
+    assert [letter['filename'] for letter in result['current_only']] == ['New Client 2024 Engagement Letter.docx']
+    summary = result['summary']
+    assert (summary['matched'], summary['changed_letters'], summary['added'], summary['removed'], summary['changed']) == (4, 2, 2, 1, 1)
+    # Smith Trust and both entities of the client without a current letter
+    assert summary['missing_entities'] == 3
+
+def test_unchanged_letters_are_listed_on_request():
+    letters = {letter['client']: letter for letter in reconcile(PRIOR, CURRENT, include_unchanged=True)['letters']}
+    assert letters['acme group']['match'] == 'address'
+    assert letters['acme group']['prior'] == 'Acme 2023 Engagement Letter.docx'
+    assert not any(letters['brown'][change] for change in ('added', 'removed', 'changed'))
+    assert letters['brown']['match'] == 'name_and_address'
@@ -0,0 +1,77 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import re
+
+import pytest
+
+from backend.rules import DEFAULT_RULES, RuleError, compile_rules
+
+RATE_OPTIONS = {
+    "COMPLIANCE_PARTNER_RATES": [{"name": "Jane Doe", "rate": "$450"}, {"name": "John Roe", "rate": "$400"}],
+    "CONSULTING_PARTNER_RATES": [{"name": "Jane Doe", "rate": "$500"}, {"name": "John Roe", "rate": "$475"}],
+    "COMPLIANCE_ASSOCIATE_RATES": "$150-250",
+    "COMPLIANCE_BOOKKEEPING_RATES": "$90-110",
+    "CONSULTING_ASSOCIATE_RATES": "$200-300",
+}
+
+PARAGRAPHS = [
+    'Dear Client,',
+    'This letter confirms our engagement for the tax year ended December 31, 2024 and the 2025 estimates.',
+    'Partner hourly rates are: Jane Doe–$400, John Roe–$350. Our Associate hourly rates range from $140-240. Our bookkeeping rate is $80-100 per hour.',
+    'Partner hourly rates are: Jane Doe–$450, John Roe–$425. Our Associate hourly rates range from $190-290.',
+    'For 2024, Partner hourly rates are: Jane Doe–$400, John Roe–$350. Our Associate hourly rates range from $140-240 .',
+    'Fees for 2023 and 2024 are due within 30 days. Invoice 2024-17 refers to $2000.',
+    'Sincerely,',
+]
+
+
+def baseline_rollover(text: str, **rate_options) -> str|None:
+    """The date, compliance and consulting substitutions of the original processor, applied one after another."""
+    date_pattern = re.compile(r"\s(20[0-9][0-9])")
+    compliance_rates_pattern = re.compile(r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.\s*Our bookkeeping rate is \$\d+-\d+\s*per hour\.")
+    consulting_rates_pattern = re.compile(r"Partner hourly rates are:\s*.*Our Associate hourly rates range from \$\d+-\d+\s*\.")
+    def partners(rates):
+        return ', '.join(f"{rate.get('name')}–{rate.get('rate')}" for rate in rates)
+    updated = False
+    if date_pattern.search(text):
+        text = date_pattern.sub(lambda m: f" {int(m.group(1)) + 1}", text)
+        updated = True
+    if compliance_rates_pattern.search(text):
+        text = compliance_rates_pattern.sub(
+            f"Partner hourly rates are: {partners(rate_options['COMPLIANCE_PARTNER_RATES'])}. Our Associate hourly rates range from "
+            f"{rate_options['COMPLIANCE_ASSOCIATE_RATES']}. Our bookkeeping rate is {rate_options['COMPLIANCE_BOOKKEEPING_RATES']} per hour.", text)
+        updated = True
+    elif consulting_rates_pattern.search(text):
+        text = consulting_rates_pattern.sub(
+            f"Partner hourly rates are: {partners(rate_options['CONSULTING_PARTNER_RATES'])}. Our Associate hourly rates range from "
+            f"{rate_options['CONSULTING_ASSOCIATE_RATES']}.", text)
+        updated = True
+    return text if updated else None
+
+@pytest.mark.parametrize('text', PARAGRAPHS)
+def test_default_rules_match_the_original_substitutions(text):
+    assert compile_rules(None, RATE_OPTIONS).apply(text) == baseline_rollover(text, **RATE_OPTIONS)
+
+def test_numeric_backreferences_are_rejected():
+    rules = [{"name": "Doubled word", "pattern": r"\b(\w+) \1\b", "literals": [], "action": "replace", "replacement": "x"}]
+    with pytest.raises(RuleError, match='by number'):
+        compile_rules(rules)
+
+def test_named_backreferences_are_allowed():
+    rules = [{"name": "Doubled word", "pattern": r"\b(?P<word>\w+) (?P=word)\b", "action": "replace", "replacement": "{CONSULTING_ASSOCIATE_RATES}"}]
+    assert compile_rules(DEFAULT_RULES + rules, RATE_OPTIONS).apply('the the 2024') == '$200-300 2025'
+
+def test_rate_entries_must_be_objects():
+    with pytest.raises(RuleError, match='COMPLIANCE_PARTNER_RATES'):
+        compile_rules(None, {**RATE_OPTIONS, "COMPLIANCE_PARTNER_RATES": ['Jane Doe $450']})
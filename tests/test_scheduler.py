@@ -0,0 +1,71 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import threading
+import time
+
+import pytest
+
+from backend.scheduler import Scheduler
+
+
+def wait_for(condition, timeout: float=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def test_owner_with_fewer_running_tasks_goes_first():
+    scheduler = Scheduler(workers=2)
+    started = []
+    release_a, release_b = threading.Event(), threading.Event()
+    def block(name, event):
+        started.append(name)
+        event.wait(5)
+    scheduler.submit(scheduler.create_job('a', 'rollover'), block, 'a-block', release_a)
+    scheduler.submit(scheduler.create_job('b', 'rollover'), block, 'b-block', release_b)
+    wait_for(lambda: len(started) == 2)
+
+    # a's job is smaller, but a still has a task running and b does not
+    small = scheduler.create_job('a', 'rollover')
+    scheduler.submit(small, started.append, 'a-small')
+    big = scheduler.create_job('b', 'rollover')
+    for i in range(5):
+        scheduler.submit(big, started.append, f'b-big-{i}')
+    release_b.set()
+    wait_for(lambda: len(started) >= 3)
+    release_a.set()
+    for job in (small, big):
+        job.seal()
+        assert job.wait(5)
+    assert started[2] == 'b-big-0'
+
+@pytest.mark.parametrize('aging, first', [(0.0, 'small'), (100.0, 'big-0')])
+def test_aging_lets_a_long_waiting_job_overtake_a_smaller_one(aging, first):
+    scheduler = Scheduler(workers=1, aging=aging)
+    started = []
+    release = threading.Event()
+    blocker = scheduler.create_job('a', 'rollover')
+    scheduler.submit(blocker, lambda: release.wait(5))
+    big = scheduler.create_job('b', 'rollover')
+    for i in range(5):
+        scheduler.submit(big, started.append, f'big-{i}')
+    time.sleep(0.2)
+    # Waiting 0.2s at 100 tasks per second outweighs the 4 tasks the big job has over the small one
+    small = scheduler.create_job('c', 'rollover')
+    scheduler.submit(small, started.append, 'small')
+    release.set()
+    for job in (blocker, big, small):
+        job.seal()
+        assert job.wait(5)
+    assert started[0] == first
@@ -0,0 +1,106 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds from launching main.py until the home page is served, worker processes included
+FIRST_RESPONSE_BUDGET = 10.0
+# Modules only the document backends import, none of them may be loaded before the first response
+BACKEND_PACKAGES = ['docx', 'docx2pdf', 'PyPDF2', 'pdfplumber']
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def server_env() -> dict[str, str]:
+    env = {**os.environ, "SECRET_KEY": os.environ.get('SECRET_KEY') or 'test'}
+    # The server opens the home page in a browser on start, open it with a command that does nothing instead
+    env.pop('CHROME_PATH', None)
+    env['BROWSER'] = f'{shlex.quote(sys.executable)} -c pass'
+    return env
+
+def stop(process: subprocess.Popen):
+    if process.poll() is not None:
+        return
+    # A terminate signal drains the server like Ctrl+C does, Windows has no such signal
+    if sys.platform == 'win32':
+        process.kill()
+    else:
+        process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def test_importing_server_does_not_import_backends():
+    code = f'import sys, backend.PELServer; print(",".join(m for m in {BACKEND_PACKAGES!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=server_env(), capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ''
+
+def test_time_to_first_response():
+    port = free_port()
+    url = f'http://localhost:{port}/'
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py', '--port', str(port)], cwd=ROOT, env=server_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        status = None
+        while time.perf_counter() - started < FIRST_RESPONSE_BUDGET and process.poll() is None:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    status = response.status
+                break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        assert process.poll() is None, f'Server exited with code {process.returncode}'
+        assert status == 200, f'No response within {FIRST_RESPONSE_BUDGET}s'
+        assert elapsed < FIRST_RESPONSE_BUDGET
+    finally:
+        stop(process)
+
+def test_shutdown_route_drains_and_exits():
+    port = free_port()
+    url = f'http://localhost:{port}'
+    process = subprocess.Popen([sys.executable, 'main.py', '--port', str(port)], cwd=ROOT, env=server_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        deadline = time.perf_counter() + FIRST_RESPONSE_BUDGET
+        # The home page is cached, so it sets no session to check the CSRF token against
+        while True:
+            try:
+                with opener.open(f'{url}/settings', timeout=1) as response:
+                    page = response.read().decode('utf-8')
+                break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                assert time.perf_counter() < deadline and process.poll() is None, 'Server did not start'
+                time.sleep(0.05)
+        csrf = page.split('id="csrf-token" value="', 1)[1].split('"', 1)[0]
+        request = urllib.request.Request(f'{url}/shutdown', data=b'', method='POST', headers={'X-CSRF-Token': csrf})
+        with opener.open(request, timeout=30) as response:
+            assert response.status == 200 and response.read() == b'Server shutting down...'
+        assert process.wait(30) == 0
+    finally:
+        stop(process)
@@ -0,0 +1,34 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import csv
+import io
+import zipfile
+
+from backend.utils.table_stream import stream_csv, stream_xlsx
+
+ROWS = [['=HYPERLINK("http://example.com","Client")', '+1', '-2', '@SUM(A1)', 'Smith & Co', 3, -4]]
+
+
+def test_csv_formulas_are_written_as_text():
+    text = b''.join(stream_csv(['a', 'b', 'c', 'd', 'e', 'f', 'g'], ROWS)).decode('utf-8-sig')
+    rows = list(csv.reader(io.StringIO(text)))
+    assert rows[1] == ["'=HYPERLINK(\"http://example.com\",\"Client\")", "'+1", "'-2", "'@SUM(A1)", 'Smith & Co', '3', '-4']
+
+def test_xlsx_formulas_are_quote_prefixed():
+    workbook = zipfile.ZipFile(io.BytesIO(b''.join(stream_xlsx(['a'] * 7, ROWS))))
+    sheet = workbook.read('xl/worksheets/sheet1.xml').decode('utf-8')
+    styles = workbook.read('xl/styles.xml').decode('utf-8')
+    cells = sheet.split('<row>')[2].split('</c>')[:-1]
+    assert [' s="3"' in cell for cell in cells] == [True] * 4 + [False] * 3
+    assert '<f>' not in sheet and 'quotePrefix="1"' in styles
@@ -0,0 +1,69 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import io
+import zipfile
+
+from backend.journal import Journal
+from backend.utils.upload_stream import StreamingUpload
+from backend.utils.zip_stream import extract_members
+
+BOUNDARY = 'pel-test-boundary'
+
+
+def multipart(files: list[tuple[str, bytes]], field_name: str='currentYearDirectory') -> bytes:
+    body = b''
+    for filename, data in files:
+        body += (
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode() + data + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+def test_same_named_files_from_different_folders_are_all_kept(tmp_path):
+    body = multipart([('2024/a/Client 2023 Engagement Letter.docx', b'first'), ('2024/b/Client 2023 Engagement Letter.docx', b'second')])
+    upload = StreamingUpload(io.BytesIO(body), f'multipart/form-data; boundary={BOUNDARY}', len(body))
+    saved = list(upload.files('currentYearDirectory', str(tmp_path), lambda name: name))
+    assert [filename for filename, _ in saved] == ['Client 2023 Engagement Letter.docx'] * 2
+    assert saved[0][1] != saved[1][1]
+    assert [open(path, 'rb').read() for _, path in saved] == [b'first', b'second']
+
+def test_same_named_zip_members_are_all_kept(tmp_path):
+    zip_path = tmp_path / 'letters.zip'
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        archive.writestr('a/Client 2023 Engagement Letter.docx', b'first')
+        archive.writestr('b/Client 2023 Engagement Letter.docx', b'second')
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    saved = list(extract_members(str(zip_path), str(inputs), lambda name: name))
+    assert [open(path, 'rb').read() for _, path in saved] == [b'first', b'second']
+
+def test_journal_resumes_each_same_named_input(tmp_path):
+    journal = Journal.create(str(tmp_path), 'owner', 'rollover', 'rollover', None)
+    body = multipart([('a/Letter.docx', b'first'), ('b/Letter.docx', b'second')])
+    upload = StreamingUpload(io.BytesIO(body), f'multipart/form-data; boundary={BOUNDARY}', len(body))
+    for _, path in upload.files('currentYearDirectory', journal.inputs_dir, lambda name: name):
+        journal.queued(path)
+    remaining = Journal.load(journal.directory).remaining()
+    assert [open(path, 'rb').read() for _, path in remaining] == [b'first', b'second']
+
+def test_oversized_fields_are_reported_instead_of_truncated(tmp_path, monkeypatch):
+    monkeypatch.setattr(StreamingUpload, 'MAX_FIELD_SIZE', 16)
+    body = b''
+    for name, value in (('knownFiles', '[' + ', '.join(['{"name": "Letter.docx"}'] * 4) + ']'), ('dryRun', 'true')):
+        body += f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    body += multipart([('Letter.docx', b'letter')])
+    upload = StreamingUpload(io.BytesIO(body), f'multipart/form-data; boundary={BOUNDARY}', len(body))
+    assert len(list(upload.files('currentYearDirectory', str(tmp_path), lambda name: name))) == 1
+    assert upload.oversized == {'knownFiles'}
+    assert upload.form == {'dryRun': 'true'}
@@ -0,0 +1,40 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import os
+
+from backend.watcher import Watcher
+
+
+def make_watcher(tmp_path, output_dir):
+    return Watcher(str(tmp_path), {'rollover': str(output_dir)}, {}, state_path=str(tmp_path / 'state.json'), use_events=False, on_result=lambda result: None)
+
+def test_output_directory_inside_source_is_not_watched(tmp_path):
+    output_dir = tmp_path / 'complete'
+    output_dir.mkdir()
+    (tmp_path / 'clients').mkdir()
+    watcher = make_watcher(tmp_path, output_dir)
+    assert watcher.accepts(str(tmp_path / 'clients' / 'Smith 2024 Engagement Letter.docx'))
+    assert not watcher.accepts(str(output_dir / 'Smith 2025 Engagement Letter.docx'))
+
+    for path in (tmp_path / 'clients' / 'Smith 2024 Engagement Letter.docx', output_dir / 'Smith 2025 Engagement Letter.docx'):
+        path.write_bytes(b'letter')
+    watcher.scan()
+    assert list(watcher._pending) == [os.path.abspath(tmp_path / 'clients' / 'Smith 2024 Engagement Letter.docx')]
+
+def test_output_directory_outside_source_is_not_excluded(tmp_path):
+    source = tmp_path / 'incoming'
+    source.mkdir()
+    watcher = make_watcher(source, tmp_path / 'complete')
+    assert watcher.excluded == []
+    assert watcher.accepts(str(source / 'Smith 2024 Engagement Letter.docx'))
@@ -0,0 +1,101 @@
+# Copyright (C) 2023 - Neil Crum (nhc.crum@outlook.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+import time
+
+import pytest
+
+from backend import cancellation, tracing
+from backend.scheduler import Scheduler
+from backend.workers import AFFINITY_WAIT, PoolTask, WorkerPool
+from test_processor import make_letter
+
+
+def test_file_stopped_by_shutdown_is_not_recorded():
+    def stopped(input_path):
+        raise cancellation.ShuttingDown()
+
+    scheduler = Scheduler(workers=1)
+    job = scheduler.create_job('owner', 'rollover')
+    recorded = []
+    task = scheduler.submit(job, stopped, 'letter.docx', callback=recorded.append)
+    job.seal()
+    assert job.wait(5)
+    assert recorded == []
+    assert task.error == 'Cancelled'
+
+def test_task_on_closed_pool_raises_shutting_down():
+    pool = WorkerPool(1)
+    pool.start()
+    assert pool.wait_ready(60) == 1
+    pool.close()
+    with pytest.raises(cancellation.ShuttingDown):
+        pool.run('extract', 'letter.docx', None, {})
+
+def test_worker_spans_are_merged_into_the_job_trace(tmp_path):
+    path = tmp_path / 'Client 1 2023 Engagement Letter.docx'
+    make_letter(path, 1)
+    pool = WorkerPool(1)
+    pool.start()
+    assert pool.wait_ready(60) == 1
+    trace = tracing.Trace('job')
+    try:
+        with tracing.activate(trace):
+            result, error = PoolTask(pool, 'extract')(str(path), None)
+    finally:
+        pool.close()
+    assert error is None
+    names = [event["name"] for event in trace.events]
+    assert names[-1] == 'worker process' and 'parse' in names
+    worker_process = trace.events[-1]
+    parse = next(event for event in trace.events if event["name"] == 'parse')
+    assert worker_process["ts"] <= parse["ts"] <= worker_process["ts"] + worker_process["dur"]
+
+def test_a_letter_is_parsed_by_one_worker(tmp_path):
+    path = tmp_path / 'Client 1 2023 Engagement Letter.docx'
+    make_letter(path, 1)
+    (tmp_path / 'out').mkdir()
+    pool = WorkerPool(2)
+    pool.start()
+    assert pool.wait_ready(60) == 2
+    try:
+        for task in ('extract', 'rollover', 'extract'):
+            result, error = PoolTask(pool, task, 'letter-hash')(str(path), str(tmp_path / 'out'))
+            assert error is None
+        sizes = sorted(len(snapshot["documents"]) for snapshot in pool.snapshots())
+    finally:
+        pool.close()
+    assert sizes == [0, 1]
+
+def test_busy_worker_is_waited_for_briefly(tmp_path):
+    path = tmp_path / 'Client 1 2023 Engagement Letter.docx'
+    make_letter(path, 1)
+    pool = WorkerPool(2)
+    pool.start()
+    assert pool.wait_ready(60) == 2
+    try:
+        result, error = PoolTask(pool, 'extract', 'letter-hash')(str(path), None)
+        assert error is None
+        last = pool._affinity['letter-hash']
+        # Tasks that don't parse letters through the cache are not sent back to a worker
+        PoolTask(pool, 'sign', 'other-hash')(str(path), str(tmp_path), signatures_dir=str(tmp_path))
+        assert 'other-hash' not in pool._affinity
+        worker = pool._acquire('letter-hash')
+        assert (worker.index, worker.pid) == last
+        started = time.monotonic()
+        other = pool._acquire('letter-hash')
+        assert other is not worker and time.monotonic() - started < AFFINITY_WAIT + 0.1
+        pool._release(other)
+        pool._release(worker)
+    finally:
+        pool.close()